@@ -1,25 +1,25 @@
 import argparse
-import os
-import pickle
+import logging
 from user import User
 
 from data import collect_all_annotations
-from const import ANNOTATORS_DIR, EXAMPLES
+from storage import storage, JsonlStorage, SQLiteStorage
+from jsonLogging import ConsoleFormatter
+from const import EXAMPLES
 
 
 
 def reload_users() :
-    for annotator in os.listdir(ANNOTATORS_DIR):
-            if os.path.isdir(ANNOTATORS_DIR / annotator) :
-                print(annotator)
-                user: User = User.load_user(annotator)
-                new_user = User(user.token, override_already_existing=True)
-                new_user.passed_tutorials = {key: True for key, _ in EXAMPLES.items()}
-                new_user.done_annotations = user.done_annotations
-                new_user.current_annotation = user.current_annotation
-                new_user.last_used_llm = user.last_used_llm
-                new_user.start_annotation_time = user.start_annotation_time
-                new_user.save_user()
+    for annotator in storage.list_annotators():
+        print(annotator)
+        user: User = User.load_user(annotator)
+        new_user = User(user.token, override_already_existing=True)
+        new_user.passed_tutorials = {key: True for key, _ in EXAMPLES.items()}
+        new_user.done_annotations = user.done_annotations
+        new_user.current_annotation = user.current_annotation
+        new_user.last_used_llm = user.last_used_llm
+        new_user.start_annotation_time = user.start_annotation_time
+        new_user.save_user()
 
     
 
@@ -34,6 +34,13 @@ if __name__ == "__main__" :
         help='Save all data when this flag is used.'
     )
 
+    # Define the --full-rebuild flag (boolean switch)
+    parser.add_argument(
+        '--full-rebuild',
+        action='store_true',  # This makes it a flag (True if present)
+        help='With --save-all, rewrite the aggregated files instead of appending new lines.'
+    )
+
     # Define the --reload-user flag (boolean switch)
     parser.add_argument(
         '--reload-users',
@@ -41,11 +48,35 @@ if __name__ == "__main__" :
         help='Reload users class to update it.'
     )
 
+    # Define the --migrate-sqlite flag (boolean switch)
+    parser.add_argument(
+        '--migrate-sqlite',
+        action='store_true',  # This makes it a flag (True if present)
+        help='Import the annotators directory tree into the SQLite storage (ANNOTATION_STORAGE=sqlite).'
+    )
+
+    # Define the --export-jsonl option
+    parser.add_argument(
+        '--export-jsonl',
+        metavar='DIRECTORY',
+        help='Write the SQLite storage content in the annotators directory layout under DIRECTORY.'
+    )
+
     # Parse the command-line arguments
     args = parser.parse_args()
+    # messages of the storage and collect functions, with their fields as key=value
+    console = logging.StreamHandler()
+    console.setFormatter(ConsoleFormatter("%(levelname)s %(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[console])
 
     if args.save_all :
-        collect_all_annotations()
+        collect_all_annotations(incremental=not args.full_rebuild)
     
     if args.reload_users :
          reload_users()
+
+    if args.migrate_sqlite :
+        SQLiteStorage().import_jsonl(JsonlStorage())
+
+    if args.export_jsonl :
+        SQLiteStorage().export_jsonl(args.export_jsonl)
@@ -1,63 +1,68 @@
-from flask import Flask, request, Response, jsonify
-from logging.config import dictConfig
+from flask import Flask, request, Response, jsonify, g
 from flask_cors import CORS, cross_origin
 import argparse
-import random
-from groqLLM import GroqLLM
-from user import User
-from utils import process_segments, extract_argument, get_token, load_admin_opinion_results, token_is_admin, is_valid_example
+from groqLLM import GroqLLM, default_rate_limiter, LLM_RATE_LIMITS
+from llmCache import LLMCache
+from modelRouter import ModelRouter
+from user import User, user_cache
+from storage import storage
+from utils import process_segments, extract_arguments, iter_arguments, aextract_arguments, aiter_arguments, get_token, load_admin_opinion_results, load_admin_opinion_page, annotation_filters, InvalidCursor, ndjson_chunks, token_is_admin, is_valid_example
 from data import GDNData
-from const import REPORT_FR_TO_EN, ALL_MODELS, EXAMPLES
+from sharedState import SQLiteAssignmentState
+from rateLimiter import SQLiteBuckets
+from tokens import token_registry
+from stats import annotation_stats, SQLiteStatsStore
+from metrics import registry, SQLiteMetricsStore
+from profiling import profile_requested, start_profile, stop_profile, save_profile, list_profiles, SORT_KEYS
+from asyncServer import AsyncServer, AsyncResponse
+from jsonLogging import setup_logging, set_log_level, get_log_level
+from const import REPORT_FR_TO_EN, ALL_MODELS, EXAMPLES, CACHED_MODELS, SHARED_STATE_FILE
 import os
+import sys
+import logging
+import socket
+import json
+import signal
+import time
+import asyncio
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--port", type=int, default=3002)
+parser.add_argument("--workers", type=int, default=1,
+                    help="number of server processes; above 1 they share their assignment state through SQLite")
+parser.add_argument("--threads", type=int, default=4, help="threads serving requests in each server process")
+parser.add_argument("--async", dest="async_mode", action="store_true",
+                    help="serve from an asyncio event loop: LLM calls of /opinion-response(-stream) do not hold a thread")
 args = parser.parse_args()
 
-all_llms = {model: GroqLLM(model) for model in ALL_MODELS}
+llm_cache = LLMCache().register_metrics() if CACHED_MODELS else None
+model_router = ModelRouter(ALL_MODELS).register_metrics()
+all_llms = {model: GroqLLM(model, cache=llm_cache if model in CACHED_MODELS else None, router=model_router) for model in ALL_MODELS}
 
-print("loading data...")
+# before loading the data, so that the startup logs go through the pipeline too
+setup_logging()
+logging.getLogger(__name__).info("loading data")
 all_data = GDNData()
-
-os.makedirs("logs/", exist_ok=True)
-dictConfig({
-    "version": 1,
-    "disable_existing_loggers": False,
-    "formatters": {
-        "default": {
-            "format": "[%(asctime)s] %(levelname)s in %(module)s: %(message)s",
-        },
-        "detailed": {
-            "format": "[%(asctime)s] %(levelname)s [%(name)s:%(lineno)d]: %(message)s",
-        },
-    },
-    "handlers": {
-        "console": {  # Keep console logging
-            "class": "logging.StreamHandler",
-            "formatter": "default",
-            "level": "INFO",
-        },
-        "info_file_handler": {
-            "class": "logging.FileHandler",
-            "formatter": "detailed",
-            "filename": "./logs/info.log",
-            "mode": "a",
-            "level": "INFO",
-        },
-        "error_file_handler": {
-            "class": "logging.FileHandler",
-            "formatter": "detailed",
-            "filename": "./logs/error.log",
-            "mode": "a",
-            "level": "ERROR",
-        },
-    },
-    "root": {
-        "level": "INFO",
-        "handlers": ["console", "info_file_handler", "error_file_handler"],
-    },
-})
-
+annotation_stats.rebuild(all_data.replayed["stats"] if all_data.replayed is not None else None, all_data.data["num_finished_annotations"])
+if args.workers > 1:
+    # built before forking the workers, every worker then opens its own connections
+    all_data.use_shared_state(SQLiteAssignmentState.create(SHARED_STATE_FILE, all_data.data, all_data.lease_ttl))
+    annotation_stats.use_shared_store(SQLiteStatsStore(SHARED_STATE_FILE))
+    # the LLM_RATE_LIMITS are for the whole server, not for each worker
+    default_rate_limiter.use_shared_buckets(SQLiteBuckets.create(SHARED_STATE_FILE, LLM_RATE_LIMITS))
+    # /metrics reaches any worker, it answers with the values of all of them
+    registry.use_shared_store(SQLiteMetricsStore.create(SHARED_STATE_FILE))
+    # a user can hit any worker, so users cannot be cached in one of them
+    user_cache.disable()
+all_data.start_lease_reaper()
+all_data.start_snapshots()
+
+
+CORS_ORIGINS = [
+    "http://localhost:3000",
+    "http://localhost:3001",
+    "https://gdnannotation.isir.upmc.fr:3000"
+]
 
 app = Flask(__name__)
 CORS(
@@ -65,14 +70,10 @@ CORS(
     supports_credentials=True,
     resources={
         r"/*": {
-            "origins": [
-                "http://localhost:3000",
-                "http://localhost:3001",
-                "https://gdnannotation.isir.upmc.fr:3000"
-            ]
+            "origins": CORS_ORIGINS
         }
     },
-    allow_headers=["Content-Type", "Authorization"],
+    allow_headers=["Content-Type", "Authorization", "X-Profile"],
     # expose_headers=["Access-Control-Allow-Private-Network"]
     )
 
@@ -80,32 +81,73 @@ CORS(
 #    response.headers["Access-Control-Allow-Private-Network"] = "true"
 #    return response
 
+request_seconds = registry.histogram("http_request_seconds", "Time to build the response of a route, streamed bodies excluded.", ["method", "route"])
+responses_total = registry.counter("http_responses_total", "Responses by route and status code.", ["method", "route", "status"])
+
+def opinion_counts():
+    counts = all_data.lease_counts()
+    return {
+        ("unannotated",): counts["unannotated_available"],
+        ("once_annotated",): counts["once_annotated_available"],
+        ("reserved",): counts["active"],
+        ("reported",): counts["reported"],
+    }
+
+# read from the shared state with --workers, the same in every process
+registry.gauge("gdn_opinions", "Opinions available for a first or second annotation, reserved, or reported.", opinion_counts, ["state"],
+               aggregate="local")
+
 # --- Logging Middleware ---
 @app.before_request
 def log_request():
-    print("received request")
+    g.request_started = time.perf_counter()
     token = None
     try:
         token = get_token(request)
     except Exception:
         pass  # some requests may not carry a token
-    app.logger.info(
-        f"➡️ Request {request.method} {request.path} "
-        f"Token={token} "
-        f"Size={request.content_length}B"
-    )
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    app.logger.info("request", extra={"method": request.method, "route": route, "path": request.path,
+                                      "token": token, "size": request.content_length})
+    if token is not None and profile_requested(request) and token_is_admin(token):
+        g.profiler = start_profile()
+        if g.profiler is None:
+            g.profile_skipped = "profiler busy"
 
 @app.after_request
 def log_response(response):
-    app.logger.info(
-        f"⬅️ Response {request.method} {request.path} "
-        f"Status={response.status_code}"
-    )
+    # routes rather than paths, so that ids in urls do not make new series
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    seconds = time.perf_counter() - g.request_started if "request_started" in g else None
+    app.logger.info("response", extra={"method": request.method, "route": route, "status": response.status_code,
+                                       "latency_ms": round(seconds * 1000, 2) if seconds is not None else None})
+    if seconds is not None:
+        request_seconds.observe(seconds, method=request.method, route=route)
+    responses_total.inc(method=request.method, route=route, status=response.status_code)
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        response.headers["X-Profile-Id"] = save_profile(profiler, {
+            "route": route,
+            "method": request.method,
+            "path": request.full_path,
+            "token": get_token(request),
+            "status": response.status_code,
+            "duration": time.perf_counter() - g.request_started,
+        })
+    elif "profile_skipped" in g:
+        response.headers["X-Profile-Skipped"] = g.profile_skipped
     return response
 
+@app.teardown_request
+def stop_unsaved_profile(error):
+    # after_request is skipped when building the response failed, the profiler must still be released
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        stop_profile(profiler)
+
 @app.errorhandler(Exception)
 def log_exception(e):
-    app.logger.exception(f"💥 Unhandled exception at {request.path}: {e}")
+    app.logger.exception("unhandled exception", extra={"method": request.method, "path": request.path})
     return jsonify({"error": "Internal server error"}), 500
 
 # --- End Middleware ---
@@ -113,7 +155,6 @@ def log_exception(e):
 @app.before_request
 def handle_preflight():
     if request.method == "OPTIONS":
-        print("received option")
         res = Response()
         res.headers['X-Content-Type-Options'] = '*'
         # res.headers.add('Access-Control-Allow-Origin', 'http://gdnannotation.isir.upmc.fr:3000')
@@ -136,29 +177,31 @@ def get_next():
         return jsonify({'error': 'No token found.'}), 400
     
     user: User = User.load_user(token)
-    app.logger.info(f"Fetching next data for user {token}, current={user.current_annotation}")
+    app.logger.debug("fetching next data", extra={"token": token, "opinionId": user.current_annotation})
 
     example_to_do = user.get_next_examples()
     if example_to_do :
         data_point = EXAMPLES[example_to_do]
-        app.logger.info(f"sending example {example_to_do}")
-        app.logger.info(data_point)
+        app.logger.debug("sending example", extra={"token": token, "opinionId": example_to_do})
         return jsonify(data_point)
     
     
     if user.current_annotation:
-        data_point = all_data.get_data_from_id(user.current_annotation)
-        app.logger.debug(f"User {token} resumes annotation {user.current_annotation}")
-        return jsonify(data_point)
-    
-    else:
-        try:
-            data_point = all_data.next_data(user)
-            app.logger.info(f"User {token} assigned new annotation {data_point['opinionId']}")
-            user.new_opinion(data_point)
-        except OverflowError:
-            app.logger.warning(f"User {token} has no more opinions to annotate")
-            return jsonify({'error': 'No more opinion to annotate.'}), 400
+        data_point = all_data.resume_data(user.current_annotation, token)
+        if data_point is not None:
+            app.logger.debug("resuming annotation", extra={"token": token, "opinionId": user.current_annotation})
+            return jsonify(data_point)
+        # the lease expired and the opinion went to another annotator
+        app.logger.info("lease lost", extra={"token": token, "opinionId": user.current_annotation})
+        user.drop_current_annotation()
+
+    try:
+        data_point = all_data.next_data(user)
+        app.logger.info("opinion assigned", extra={"token": token, "opinionId": data_point['opinionId']})
+        user.new_opinion(data_point)
+    except OverflowError:
+        app.logger.warning("no more opinions to annotate", extra={"token": token})
+        return jsonify({'error': 'No more opinion to annotate.'}), 400
 
     return jsonify(data_point)
 
@@ -172,13 +215,14 @@ def get_data_from_id():
     data = request.json
 
     new_opinion_id = int(data.get("opinionId"))
-    app.logger.info(f"User {token} switching to opinion {new_opinion_id}")
+    app.logger.info("switching opinion", extra={"token": token, "opinionId": new_opinion_id})
 
-    new_opinion = all_data.get_data_from_id(new_opinion_id)
-    all_data.set_opinion_annotation(new_opinion_id)
+    new_opinion = all_data.get_data_from_id(new_opinion_id, token)
 
     current_opinion_id = user.current_annotation
-    all_data.cancel_opinion_annotation(current_opinion_id)
+    if current_opinion_id != new_opinion_id:
+        # only if this annotator still holds it
+        all_data.cancel_opinion_annotation(current_opinion_id, token)
 
     user.new_opinion(new_opinion)
     return jsonify(new_opinion)
@@ -196,7 +240,7 @@ def report():
     reason = data.get("reason")
     reason = REPORT_FR_TO_EN.get(reason)
 
-    app.logger.info(f"User {token} reporting opinion {opinion.get('opinionId')} for reason={reason}")
+    app.logger.info("opinion reported", extra={"token": token, "opinionId": opinion.get('opinionId'), "reason": reason})
 
     output = {
         "opinion": opinion,
@@ -208,14 +252,21 @@ def report():
 
     return jsonify({'message': 'opinion reported successfully'})
 
-@app.route('/opinion-response', methods=['POST'])
-def process_opinion():
-    data = request.json
-    latest_data_point = data
-    token = get_token(request)
+def pick_llm(opinion_id) :
+    "model among the ones not used yet for this opinion, chosen by the model router"
+    if "Example" in str(opinion_id):
+        used_models = []
+    else :
+        used_models = all_data.get_used_llm(int(opinion_id))
+    return model_router.pick([model for model in ALL_MODELS if model not in used_models])
 
-    if token is not None: 
-        user: User = User.load_user(token)
+def prepare_opinion_response(data, token):
+    """
+    Checks an /opinion-response request, renews the lease of its opinion and picks its model.
+    Returns (user or None, opinion_id, model, text, theme, color_grouped_segments),
+    raises ValueError when the text or the segments are missing, or when the opinion went to another annotator.
+    """
+    user = User.load_user(token) if token is not None else None
 
     opinion_id = data.get("opinionId")
     text = data.get('full_text')
@@ -223,33 +274,170 @@ def process_opinion():
     segments = data.get('segments', [])
 
     if not segments or not text:
-        app.logger.warning(f"User {token} sent invalid opinion response: missing text or segments")
-        return jsonify({'error': 'Missing opinionId or segments'}), 400
-    
-    if "Example" in str(opinion_id):
-        used_models = []
-    else :
-        used_models = all_data.get_used_llm(int(opinion_id))
-    random_llm = random.choice([model for model in ALL_MODELS if model not in used_models])
-    app.logger.info(f"User {token} processing opinion {opinion_id} with model={random_llm}")
-
-    color_grouped_segments = process_segments(segments)
-    results = []
-
-    for color, segs in color_grouped_segments.items():
-        app.logger.debug(f"Processing color {color} with {len(segs)} segments")
-        argument = extract_argument(text, segs, theme, all_llms[random_llm])
-        results.append({
-            'segments': segs,
-            'color': color,
-            'LLMtext': argument,
-            'text': argument
-        })
+        app.logger.warning("invalid opinion response: missing text or segments", extra={"token": token, "opinionId": opinion_id})
+        raise ValueError('Missing opinionId or segments')
+
+    if "Example" not in str(opinion_id) and not all_data.renew_lease(int(opinion_id), token):
+        # the lease expired and another annotator took the opinion, the next /next-data assigns a new one
+        app.logger.info("lease lost", extra={"token": token, "opinionId": opinion_id})
+        if user is not None and user.current_annotation == int(opinion_id):
+            user.drop_current_annotation()
+        raise ValueError('This opinion was assigned to another annotator, please ask for a new one.')
+
+    random_llm = pick_llm(opinion_id)
+    return user, opinion_id, random_llm, text, theme, process_segments(segments)
+
+@app.route('/opinion-response', methods=['POST'])
+def process_opinion():
+    data = request.json
+    token = get_token(request)
+
+    try:
+        user, opinion_id, random_llm, text, theme, color_grouped_segments = prepare_opinion_response(data, token)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    app.logger.info("processing opinion", extra={"token": token, "opinionId": opinion_id, "model": random_llm,
+                                                 "colors": len(color_grouped_segments)})
+    results = extract_arguments(text, color_grouped_segments, theme, all_llms[random_llm])
     
-    if token is not None:  
+    if user is not None:  
         user.save_last_llm(random_llm)
     return jsonify({'results': results})
 
+@app.route('/opinion-response-stream', methods=['POST'])
+def process_opinion_stream():
+    """
+    Same as /opinion-response, but answers in NDJSON: one line per argument unit as soon as
+    it is extracted ({index, segments, color, LLMtext, text}), then a summary line
+    {"done": true, "results": [...]} with every result in the color order.
+    """
+    data = request.json
+    token = get_token(request)
+
+    try:
+        user, opinion_id, random_llm, text, theme, color_grouped_segments = prepare_opinion_response(data, token)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    app.logger.info("streaming opinion", extra={"token": token, "opinionId": opinion_id, "model": random_llm})
+
+    # the model is known before the first argument is sent
+    if user is not None:  
+        user.save_last_llm(random_llm)
+
+    def generate() :
+        results = [None] * len(color_grouped_segments)
+        for index, result in iter_arguments(text, color_grouped_segments, theme, all_llms[random_llm]) :
+            results[index] = result
+            yield json.dumps({"index": index, **result}) + "\n"
+        yield json.dumps({"done": True, "results": results}) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+# --- asyncio routes of the --async server ---
+# same contracts as the flask routes above, but the LLM calls are awaited on the event loop,
+# so hundreds of opinions waiting for a model do not hold the threads serving the other routes
+
+async_routes = []
+
+def async_route(method, path):
+    "registers a coroutine route of the --async server, with the logs, metrics and CORS headers of the flask routes"
+    def register(handler):
+        async def handle(req):
+            started = time.perf_counter()
+            token = get_token(req)
+            app.logger.info("request", extra={"method": method, "route": path, "path": path,
+                                              "token": token, "size": len(req.body)})
+            profiler = profile_skipped = response = None
+            if token is not None and profile_requested(req) and await asyncio.to_thread(token_is_admin, token):
+                profiler = start_profile()
+                if profiler is None:
+                    profile_skipped = "profiler busy"
+            try:
+                response = await handler(req)
+            except Exception as e:
+                app.logger.exception("unhandled exception", extra={"method": method, "path": path})
+                response = AsyncResponse.json({"error": "Internal server error"}, 500)
+            finally:
+                if profiler is not None and not isinstance(response, AsyncResponse):
+                    # cancelled, or failed before a response was built
+                    stop_profile(profiler)
+                    profiler = None
+            seconds = time.perf_counter() - started
+            app.logger.info("response", extra={"method": method, "route": path, "status": response.status,
+                                               "latency_ms": round(seconds * 1000, 2)})
+            request_seconds.observe(seconds, method=method, route=path)
+            responses_total.inc(method=method, route=path, status=response.status)
+            if profiler is not None:
+                # a streamed body is produced after the handler returned, only its setup is profiled
+                response.headers["X-Profile-Id"] = save_profile(profiler, {
+                    "route": path,
+                    "method": method,
+                    "path": f"{req.path}?{req.query_string}",
+                    "token": token,
+                    "status": response.status,
+                    "duration": seconds,
+                })
+            elif profile_skipped is not None:
+                response.headers["X-Profile-Skipped"] = profile_skipped
+
+            origin = req.headers.get("Origin")
+            if origin in CORS_ORIGINS:
+                response.headers["Access-Control-Allow-Origin"] = origin
+                response.headers["Access-Control-Allow-Credentials"] = "true"
+                response.headers["Vary"] = "Origin"
+            return response
+        async_routes.append((method, path, handle))
+        return handler
+    return register
+
+@async_route("POST", "/opinion-response")
+async def aprocess_opinion(req):
+    data = req.json
+    token = get_token(req)
+
+    try:
+        # loads the user and renews the lease, both may wait for file locks
+        user, opinion_id, random_llm, text, theme, color_grouped_segments = await asyncio.to_thread(prepare_opinion_response, data, token)
+    except ValueError as e:
+        return AsyncResponse.json({'error': str(e)}, 400)
+    app.logger.info("processing opinion", extra={"token": token, "opinionId": opinion_id, "model": random_llm,
+                                                 "colors": len(color_grouped_segments)})
+
+    results = await aextract_arguments(text, color_grouped_segments, theme, all_llms[random_llm])
+
+    if user is not None:
+        await asyncio.to_thread(user.save_last_llm, random_llm)
+    return AsyncResponse.json({'results': results})
+
+@async_route("POST", "/opinion-response-stream")
+async def aprocess_opinion_stream(req):
+    data = req.json
+    token = get_token(req)
+
+    try:
+        user, opinion_id, random_llm, text, theme, color_grouped_segments = await asyncio.to_thread(prepare_opinion_response, data, token)
+    except ValueError as e:
+        return AsyncResponse.json({'error': str(e)}, 400)
+    app.logger.info("streaming opinion", extra={"token": token, "opinionId": opinion_id, "model": random_llm})
+
+    if user is not None:
+        await asyncio.to_thread(user.save_last_llm, random_llm)
+
+    async def generate() :
+        results = [None] * len(color_grouped_segments)
+        async for index, result in aiter_arguments(text, color_grouped_segments, theme, all_llms[random_llm]) :
+            results[index] = result
+            yield (json.dumps({"index": index, **result}) + "\n").encode("utf-8")
+        yield (json.dumps({"done": True, "results": results}) + "\n").encode("utf-8")
+
+    return AsyncResponse(generate(), content_type="application/x-ndjson")
+
+def make_async_server():
+    server = AsyncServer(app, args.threads)
+    for method, path, handler in async_routes:
+        server.add_route(method, path, handler)
+    return server
+
 @app.route('/user-info', methods=["GET"])
 def get_user_info():
     token = get_token(request)
@@ -258,8 +446,6 @@ def get_user_info():
     
     user: User = User.load_user(token)
 
-    print(user.done_annotations)
-
     done_annotations = {}
     all_annot = user.read_done_annotations()
     
@@ -270,11 +456,12 @@ def get_user_info():
         }
 
     if user.current_annotation :
-        current_annotation_text = all_data.get_data_from_id(user.current_annotation)["text"]
+        # read only, the lease is renewed by /next-data and /opinion-response
+        current_annotation_text = all_data.get_data_info_from_id(user.current_annotation)["text"]
     else :
         current_annotation_text = None
     
-    app.logger.info(f"User {token} requested user-info (done={len(done_annotations)})")
+    app.logger.debug("user info", extra={"token": token, "done": len(done_annotations)})
 
     return jsonify({
         "token": token,
@@ -301,7 +488,7 @@ def get_user_info():
             "annotator": "Mathias"}
 
 def handle_example_summaries(data, token = None) :
-    app.logger.info("Received an introduction example")
+    app.logger.info("introduction example received", extra={"token": token})
 
     if token is None:
          return jsonify({'message': 'Example summaries without token'})
@@ -338,9 +525,12 @@ def save_summaries():
 
         data["llm"] = used_llm
 
-        all_data.add_finished_annotation(data)
+        if not all_data.add_finished_annotation(data, token):
+            app.logger.warning("annotation of a lost lease refused", extra={"token": token, "opinionId": data['opinion']['opinionId']})
+            user.drop_current_annotation()
+            return jsonify({'error': 'This opinion was assigned to another annotator, please ask for a new one.'}), 409
         user.save_annotation(data)
-        app.logger.info(f"User {token} saved summaries for opinion {data['opinion']['opinionId']} using {used_llm}")
+        app.logger.info("summaries saved", extra={"token": token, "opinionId": data['opinion']['opinionId'], "model": used_llm})
 
     return jsonify({'message': 'Summaries saved successfully'})
 
@@ -348,22 +538,16 @@ def save_summaries():
 @app.route('/check-token', methods=['POST'])
 def check_token():
     data = request.json
-    with open("./annotators/allowed_tokens.txt") as f:
-        allowed_tokens = [line.rstrip() for line in f]
-    with open("./annotators/admin_tokens.txt") as f:
-        admin_tokens = [line.rstrip() for line in f]
-        allowed_tokens += admin_tokens
-        
     token = data.get("token")
 
     if token is None: 
         return jsonify({'error': 'No token found.'}), 400
     
-    if token not in allowed_tokens:
-        print(f"not allowed token: {token}")
+    if not token_registry.is_allowed(token):
+        app.logger.warning("token not allowed", extra={"token": token})
         return jsonify({'error': f'token={token} is not allowed.'}), 400
 
-    app.logger.info(f"User connecting with token={token}")
+    app.logger.info("user connecting", extra={"token": token})
     
     if User.token_already_exist(token):
         user = User.load_user(token)
@@ -378,14 +562,11 @@ def check_token():
 @app.route('/get-all-annotations', methods=['POST'])
 def check_admin_token():
     data = request.json
-    with open("./annotators/admin_tokens.txt") as f:
-        tokens = [line.rstrip() for line in f]
-
     token = data.get("token")
 
-    app.logger.info(f"User with token={token} wants to connect to admin.")
+    app.logger.info("admin connecting", extra={"token": token})
     
-    if token in tokens :
+    if token_registry.is_admin(token) :
         return jsonify({'message': 'admin successfully validated'})
 
     return jsonify({'error': f'User token={token} is not admin.'}), 400
@@ -404,17 +585,173 @@ def get_all_annotations():
     if not token_is_admin(token):
         return jsonify({'error': f'Token {token} is not admin.'}), 400
 
+    # optional query arguments:
+    #   annotator, llm, opinionId, date_from, date_to: filters
+    #   limit, cursor: one page of results {"results": [...], "next_cursor": ...}
+    #   format=ndjson: stream every result, gzip-compressed if the client accepts it
+    try:
+        cursor = int(request.args.get("cursor", 0))
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return jsonify({'error': 'cursor and limit must be integers.'}), 400
+    if cursor < 0:
+        return jsonify({'error': 'cursor must not be negative.'}), 400
+
     try:
-        data = load_admin_opinion_results()
+        filters = annotation_filters(request.args)
+
+        if request.args.get("format") == "ndjson":
+            compress = "gzip" in request.headers.get("Accept-Encoding", "")
+            annotations = (annotation for _, annotation in storage.iter_annotations(filters=filters))
+            response = Response(ndjson_chunks(annotations, compress), mimetype="application/x-ndjson")
+            if compress:
+                response.headers["Content-Encoding"] = "gzip"
+            return response
+
+        if "limit" in request.args or "cursor" in request.args:
+            results, next_cursor = load_admin_opinion_page(storage.iter_annotations(cursor, filters), max(1, limit))
+            return jsonify({"results": results, "next_cursor": next_cursor})
+
+        data = load_admin_opinion_results(storage.iter_annotations(filters=filters))
         return jsonify(data)
     except FileNotFoundError:
         return jsonify({"error": f"All annotations files not found"}), 404
+    except InvalidCursor:
+        return jsonify({"error": "invalid cursor"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/pool-info", methods=["GET"])
+def get_pool_info():
+    token = get_token(request)
+
+    if token is None: 
+        return jsonify({'error': 'No token found.'}), 400
+
+    if not token_is_admin(token):
+        return jsonify({'error': f'Token {token} is not admin.'}), 400
+
+    return jsonify(all_data.lease_counts())
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    "annotations per annotator, model, theme and day, double annotation progress, report reasons and annotation times"
+    token = get_token(request)
+
+    if token is None: 
+        return jsonify({'error': 'No token found.'}), 400
+
+    if not token_is_admin(token):
+        return jsonify({'error': f'Token {token} is not admin.'}), 400
+
+    return jsonify(annotation_stats.stats())
+
+
+@app.route("/model-info", methods=["GET"])
+def get_model_info():
+    "recent error rate, latencies and circuit breaker of every model"
+    token = get_token(request)
+
+    if token is None: 
+        return jsonify({'error': 'No token found.'}), 400
+
+    if not token_is_admin(token):
+        return jsonify({'error': f'Token {token} is not admin.'}), 400
+
+    return jsonify(model_router.stats())
+
+
+@app.route("/profiles", methods=["GET"])
+def get_profiles():
+    "recent request profiles with their top functions, take one by sending X-Profile: 1 or ?profile=1 with an admin token"
+    token = get_token(request)
+
+    if token is None: 
+        return jsonify({'error': 'No token found.'}), 400
+
+    if not token_is_admin(token):
+        return jsonify({'error': f'Token {token} is not admin.'}), 400
+
+    sort = request.args.get("sort", "cumulative")
+    if sort not in SORT_KEYS:
+        return jsonify({'error': f'sort must be one of {", ".join(SORT_KEYS)}.'}), 400
+    try:
+        limit = int(request.args.get("limit", 20))
+        top = int(request.args.get("top", 10))
+    except ValueError:
+        return jsonify({'error': 'limit and top must be integers.'}), 400
+
+    return jsonify(list_profiles(limit, top, sort))
+
+
+@app.route("/log-level", methods=["GET", "POST"])
+def log_level():
+    "current log level, POST {'level': 'DEBUG'} to change it (with --workers, in the process answering only)"
+    token = get_token(request)
+
+    if token is None: 
+        return jsonify({'error': 'No token found.'}), 400
+
+    if not token_is_admin(token):
+        return jsonify({'error': f'Token {token} is not admin.'}), 400
+
+    if request.method == "POST":
+        try:
+            set_log_level(request.json.get("level"))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        app.logger.warning("log level changed", extra={"token": token, "level": get_log_level()})
+
+    return jsonify({"level": get_log_level()})
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def serve_workers(num_workers, port):
+    "forks num_workers server processes accepting connections on the same listening socket"
+    from waitress import serve
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(1024)
+
+    children = []
+    for _ in range(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            registry.start_publishing()
+            if args.async_mode:
+                make_async_server().serve(sock=sock)
+            else:
+                serve(app, sockets=[sock], threads=args.threads)
+            os._exit(0)
+        children.append(pid)
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
 if __name__ == '__main__':
     from waitress import serve
-    serve(app, host='127.0.0.1', port=args.port)
+    # exit through sys.exit so that dirty users are flushed at exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.workers > 1:
+        serve_workers(args.workers, args.port)
+    elif args.async_mode:
+        make_async_server().serve(host='127.0.0.1', port=args.port)
+    else:
+        serve(app, host='127.0.0.1', port=args.port, threads=args.threads)
 
     # app.run(host='127.0.0.1', port=3002, debug=True)
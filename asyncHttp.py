@@ -0,0 +1,122 @@
+import ssl
+import json
+import asyncio
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+
+class Headers(dict) :
+    "header names are case-insensitive"
+    def __setitem__(self, name, value) :
+        super().__setitem__(name.lower(), value)
+
+    def __getitem__(self, name) :
+        return super().__getitem__(name.lower())
+
+    def __contains__(self, name) :
+        return super().__contains__(name.lower())
+
+    def get(self, name, default = None) :
+        return super().get(name.lower(), default)
+
+
+class AsyncHTTPResponse :
+    def __init__(self, status, headers, body) :
+        self.status_code = status
+        self.headers = headers
+        self.content = body
+
+    def json(self) :
+        return json.loads(self.content)
+
+
+class AsyncHTTPClient :
+    """
+    Minimal HTTP/1.1 client on asyncio streams, enough for the JSON POSTs sent to the LLM providers:
+    keep-alive connections, at most connections_per_host open to a host, Content-Length and chunked answers.
+    Connections belong to the event loop that opened them, a new loop starts with new ones.
+    """
+    def __init__(self, connections_per_host) :
+        self.connections_per_host = connections_per_host
+        self.loop = None
+
+    def reset(self) :
+        self.loop = asyncio.get_running_loop()
+        # (scheme, host, port) -> idle (reader, writer) pairs
+        self.idle = defaultdict(list)
+        self.slots = defaultdict(lambda : asyncio.Semaphore(self.connections_per_host))
+        self.ssl_context = ssl.create_default_context()
+
+    async def post_json(self, url, headers, data, connect_timeout, read_timeout) :
+        if self.loop is not asyncio.get_running_loop() :
+            self.reset()
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        body = json.dumps(data).encode("utf-8")
+        head = [f"POST {path or '/'} HTTP/1.1", f"Host: {parts.netloc}", "Content-Type: application/json",
+                f"Content-Length: {len(body)}", "Connection: keep-alive"]
+        head += [f"{name}: {value}" for name, value in headers.items() if name.lower() != "content-type"]
+        request = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+        async with self.slots[key] :
+            while self.idle[key] :
+                reader, writer = self.idle[key].pop()
+                try :
+                    return await asyncio.wait_for(self.exchange(key, reader, writer, request), read_timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) :
+                    # the server closed this idle connection, try another one
+                    writer.close()
+                except BaseException :
+                    writer.close()
+                    raise
+
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, port, ssl=self.ssl_context if parts.scheme == "https" else None),
+                connect_timeout
+            )
+            try :
+                return await asyncio.wait_for(self.exchange(key, reader, writer, request), read_timeout)
+            except BaseException :
+                writer.close()
+                raise
+
+    async def exchange(self, key, reader, writer, request) :
+        writer.write(request)
+        await writer.drain()
+
+        status_line = await reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers = Headers()
+        while True :
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n" :
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip()] = value.strip()
+
+        keep_alive = headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked" :
+            chunks = []
+            while True :
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0 :
+                    # trailers end with an empty line
+                    while await reader.readuntil(b"\r\n") != b"\r\n" :
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif "content-length" in headers :
+            body = await reader.readexactly(int(headers["content-length"]))
+        else :
+            body = await reader.read()
+            keep_alive = False
+
+        if keep_alive :
+            self.idle[key].append((reader, writer))
+        else :
+            writer.close()
+        return AsyncHTTPResponse(status, headers, body)
@@ -0,0 +1,281 @@
+import io
+import sys
+import json
+import asyncio
+import logging
+from http import HTTPStatus
+from urllib.parse import unquote, unquote_to_bytes, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from asyncHttp import Headers
+from const import ASYNC_IDLE_TIMEOUT, ASYNC_READ_TIMEOUT, ASYNC_MAX_BODY_BYTES
+
+logger = logging.getLogger(__name__)
+
+# headers accepted in a request
+MAX_HEADERS = 100
+
+
+class RequestError(Exception) :
+    "a request that cannot be served, answered with status before the connection is closed"
+    def __init__(self, status, message) :
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncRequest :
+    "the parts of a flask request used by the asyncio routes"
+    def __init__(self, method, target, version, headers, body, peer) :
+        self.method = method
+        path, _, self.query_string = target.partition("?")
+        self.raw_path = path
+        self.path = unquote(path)
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.peer = peer
+
+    @property
+    def json(self) :
+        return json.loads(self.body) if self.body else None
+
+    @property
+    def args(self) :
+        "query arguments, the first value of each, like request.args.get in flask"
+        return {name: values[0] for name, values in parse_qs(self.query_string).items()}
+
+    def keep_alive(self) :
+        connection = self.headers.get("Connection", "").lower()
+        if self.version == "HTTP/1.0" :
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+class AsyncResponse :
+    "body is bytes, or an async iterator of bytes sent with chunked encoding"
+    def __init__(self, body, status = 200, content_type = "application/json", headers = None) :
+        self.body = body
+        self.status = status
+        self.headers = {"Content-Type": content_type, **(headers or {})}
+
+    @classmethod
+    def json(cls, data, status = 200) :
+        return cls(json.dumps(data).encode("utf-8"), status)
+
+
+class AsyncServer :
+    """
+    HTTP/1.1 server on an asyncio event loop. Routes added with add_route are coroutines running on the loop,
+    so what they await (LLM calls) does not hold a thread. Every other request is handed to the
+    WSGI app in a pool of threads, so the flask routes keep working unchanged.
+    """
+    def __init__(self, wsgi_app, threads, idle_timeout = ASYNC_IDLE_TIMEOUT, read_timeout = ASYNC_READ_TIMEOUT,
+                 max_body_bytes = ASYNC_MAX_BODY_BYTES) :
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.max_body_bytes = max_body_bytes
+        # (method, path) -> coroutine function(AsyncRequest) -> AsyncResponse
+        self.routes = {}
+
+    def add_route(self, method, path, handler) :
+        self.routes[(method, path)] = handler
+
+    def serve(self, host = "127.0.0.1", port = 3002, sock = None) :
+        "serves forever on host:port, or on an already listening socket"
+        asyncio.run(self.run(host, port, sock))
+
+    async def run(self, host, port, sock) :
+        if sock is not None :
+            server = await asyncio.start_server(self.handle_connection, sock=sock)
+        else :
+            server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        async with server :
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer) :
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try :
+            while True :
+                try :
+                    request = await self.read_request(reader, writer, peer)
+                except RequestError as e :
+                    await self.send_bytes(writer, AsyncResponse.json({"error": str(e)}, e.status), False)
+                    break
+                if request is None :
+                    break
+                keep_alive = request.keep_alive()
+                handler = self.routes.get((request.method, request.path))
+                if handler is not None :
+                    await self.send_async(writer, request, handler, keep_alive)
+                else :
+                    await self.send_wsgi(writer, request, keep_alive)
+                if not keep_alive :
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError) :
+            # client gone
+            pass
+        except asyncio.CancelledError :
+            # the server is shutting down
+            pass
+        finally :
+            writer.close()
+
+    async def read_request(self, reader, writer, peer) :
+        """
+        The next request of the connection, or None when the client closed it or left it idle for idle_timeout seconds.
+        Raises RequestError for a request that is malformed, too large, or not received within read_timeout seconds.
+        """
+        try :
+            async with asyncio.timeout(self.idle_timeout) :
+                line = await reader.readuntil(b"\r\n")
+                if line == b"\r\n" :
+                    line = await reader.readuntil(b"\r\n")
+        except (asyncio.IncompleteReadError, TimeoutError) :
+            return None
+        except asyncio.LimitOverrunError :
+            raise RequestError(414, "request line too long")
+
+        try :
+            async with asyncio.timeout(self.read_timeout) :
+                return await self.read_rest(reader, writer, line, peer)
+        except TimeoutError :
+            raise RequestError(408, "request not received in time")
+        except asyncio.LimitOverrunError :
+            raise RequestError(431, "request header too long")
+
+    async def read_rest(self, reader, writer, line, peer) :
+        "headers and body of the request starting with line"
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3 :
+            raise RequestError(400, "malformed request line")
+        method, target, version = parts
+
+        headers = Headers()
+        while True :
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n" :
+                break
+            if len(headers) >= MAX_HEADERS :
+                raise RequestError(431, "too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip()] = value.strip()
+
+        if headers.get("Transfer-Encoding", "").lower() == "chunked" :
+            raise RequestError(501, "chunked request bodies are not supported")
+        length = headers.get("Content-Length", "0")
+        if not length.isdigit() :
+            raise RequestError(400, "invalid Content-Length")
+        length = int(length)
+        if length > self.max_body_bytes :
+            raise RequestError(413, f"request body larger than {self.max_body_bytes} bytes")
+        if length and headers.get("Expect", "").lower() == "100-continue" :
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        body = await reader.readexactly(length)
+        return AsyncRequest(method, target, version, headers, body, peer)
+
+    def write_head(self, writer, status, headers, keep_alive) :
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+        lines += [f"{name}: {value}" for name, value in headers]
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def send_async(self, writer, request, handler, keep_alive) :
+        try :
+            response = await handler(request)
+        except Exception :
+            logger.exception("unhandled exception", extra={"method": request.method, "path": request.path})
+            response = AsyncResponse.json({"error": "Internal server error"}, 500)
+
+        if isinstance(response.body, bytes) :
+            await self.send_bytes(writer, response, keep_alive)
+            return
+
+        headers = list(response.headers.items())
+        self.write_head(writer, response.status, headers + [("Transfer-Encoding", "chunked")], keep_alive)
+        async for chunk in response.body :
+            if chunk :
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def send_bytes(self, writer, response, keep_alive) :
+        headers = list(response.headers.items()) + [("Content-Length", len(response.body))]
+        self.write_head(writer, response.status, headers, keep_alive)
+        writer.write(response.body)
+        await writer.drain()
+
+    def environ(self, request, writer) :
+        host, port = writer.get_extra_info("sockname")[:2]
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(request.raw_path).decode("latin-1"),
+            "QUERY_STRING": request.query_string,
+            "SERVER_NAME": str(host),
+            "SERVER_PORT": str(port),
+            "SERVER_PROTOCOL": request.version,
+            "REMOTE_ADDR": str(request.peer[0]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(request.body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items() :
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH") :
+                environ[key] = value
+            else :
+                environ[f"HTTP_{key}"] = value
+        return environ
+
+    def call_wsgi(self, environ) :
+        """
+        Runs the WSGI app in a pool thread. A body with a Content-Length is read there too,
+        returns (status, headers, body bytes or the iterable to stream).
+        """
+        started = {}
+        def start_response(status, headers, exc_info = None) :
+            started["status"] = int(status.split()[0])
+            started["headers"] = headers
+            return lambda data : None
+        result = self.wsgi_app(environ, start_response)
+        if any(name.lower() == "content-length" for name, _ in started["headers"]) :
+            try :
+                body = b"".join(result)
+            finally :
+                if hasattr(result, "close") :
+                    result.close()
+            return started["status"], started["headers"], body
+        return started["status"], started["headers"], result
+
+    async def send_wsgi(self, writer, request, keep_alive) :
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(self.executor, self.call_wsgi, self.environ(request, writer))
+        if isinstance(body, bytes) :
+            self.write_head(writer, status, headers, keep_alive)
+            writer.write(body)
+            await writer.drain()
+            return
+
+        # streamed body: every chunk is produced in a pool thread, it may wait for LLM calls
+        self.write_head(writer, status, headers + [("Transfer-Encoding", "chunked")], keep_alive)
+        chunks = iter(body)
+        try :
+            while True :
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                if chunk is None :
+                    break
+                if chunk :
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    await writer.drain()
+        finally :
+            if hasattr(body, "close") :
+                await loop.run_in_executor(self.executor, body.close)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
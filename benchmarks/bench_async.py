@@ -0,0 +1,124 @@
+"""
+Latency of the fast routes (/next-data, /user-info) while more and more /opinion-response
+requests are waiting for a slow LLM, with the default waitress server and with app.py --async.
+With waitress every waiting /opinion-response holds one of the --threads threads,
+with --async they wait on the event loop and the threads stay free for the other routes.
+
+    python benchmarks/bench_async.py --llm-latency 2 --levels 0,4,8,16,32,64 --seconds 6
+"""
+import argparse
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.environ.setdefault("ANNOTATION_DATA_FILE", "unused.jsonl")
+
+import numpy as np
+import requests
+from fake_llm import FakeLLMServer
+from load_test import write_data_file, make_segments, free_port, start_server, WORDS, THEMES
+
+
+def opinion_request(i) :
+    "an example opinion (no lease to renew), with a new text every time so that no answer comes from a cache"
+    text = " ".join(random.choices(WORDS, k=60)) + f" {i}."
+    opinion = {"opinionId": f"Example-bench-{i}", "text": text}
+    return {"opinionId": opinion["opinionId"], "full_text": text, "authorName": random.choice(THEMES),
+            "segments": make_segments(opinion, [["claim", "premise"], ["solution"]])}
+
+
+def keep_busy(base_url, token, stop, counter) :
+    "sends /opinion-response one after the other until stop is set"
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    while not stop.is_set() :
+        try :
+            session.post(f"{base_url}/opinion-response", json=opinion_request(random.random()), timeout=120)
+            counter.append(1)
+        except requests.RequestException :
+            pass
+
+
+def measure(base_url, token, seconds) :
+    "latencies of /next-data and /user-info called in turn for seconds"
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    latencies = {"/next-data": [], "/user-info": []}
+    end = time.monotonic() + seconds
+    while time.monotonic() < end :
+        for route in latencies :
+            started = time.perf_counter()
+            session.get(f"{base_url}{route}", timeout=120)
+            latencies[route].append(time.perf_counter() - started)
+    return latencies
+
+
+def run_mode(name, extra_args, args, llm_url) :
+    workdir = Path(tempfile.mkdtemp(prefix="gdn-async-"))
+    tokens = [f"annotator{i}" for i in range(max(args.levels) + 1)]
+    (workdir / "annotators").mkdir()
+    (workdir / "annotators" / "allowed_tokens.txt").write_text("\n".join(tokens) + "\n")
+    (workdir / "annotators" / "admin_tokens.txt").write_text("admin\n")
+    write_data_file(workdir / "data.jsonl", args.rows)
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = start_server(workdir, port, llm_url, 1, ["--threads", str(args.threads), *extra_args])
+    try :
+        for token in tokens :
+            requests.post(f"{base_url}/check-token", json={"token": token}, timeout=30)
+        measurer = tokens[0]
+
+        for level in args.levels :
+            stop = threading.Event()
+            answered = []
+            busy = [threading.Thread(target=keep_busy, args=(base_url, token, stop, answered), daemon=True)
+                    for token in tokens[1:level + 1]]
+            for thread in busy :
+                thread.start()
+            # let the requests pile up on the server
+            time.sleep(min(args.llm_latency, 1.0) if level else 0)
+            latencies = measure(base_url, measurer, args.seconds)
+            stop.set()
+            for thread in busy :
+                thread.join()
+
+            line = f"{name:<9}{level:>9}"
+            for route, values in latencies.items() :
+                p50, p95 = np.percentile(np.array(values) * 1000, [50, 95])
+                line += f"{p50:>12.1f}{p95:>12.1f}"
+            print(line + f"{len(answered) / args.seconds:>14.1f}", flush=True)
+    finally :
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+        shutil.rmtree(workdir)
+
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--levels", type=lambda s : [int(level) for level in s.split(",")], default=[0, 4, 8, 16, 32, 64],
+                        help="/opinion-response requests kept in flight")
+    parser.add_argument("--seconds", type=float, default=6, help="measuring time per level")
+    parser.add_argument("--threads", type=int, default=4, help="app.py --threads")
+    parser.add_argument("--llm-latency", type=float, default=2.0)
+    parser.add_argument("--rows", type=int, default=2000)
+    args = parser.parse_args()
+
+    # the LLM connection pool is not what is measured here
+    os.environ.setdefault("LLM_CONNECTIONS_PER_HOST", "256")
+    llm = FakeLLMServer(latency=args.llm_latency).start()
+    print(f"{'server':<9}{'in flight':>9}{'next p50 ms':>12}{'next p95 ms':>12}{'info p50 ms':>12}{'info p95 ms':>12}{'opinions/s':>14}")
+    for name, extra_args in [("waitress", []), ("async", ["--async"])] :
+        run_mode(name, extra_args, args, llm.url)
+    llm.shutdown()
+
+
+if __name__ == "__main__" :
+    main()
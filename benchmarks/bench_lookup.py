@@ -0,0 +1,94 @@
+"""
+Per-call latency of GDNData lookups and single-row updates, comparing the
+old boolean-mask implementation with the opinionId -> position index.
+
+    python benchmarks/bench_lookup.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("ANNOTATION_DATA_FILE", "unused.jsonl")
+
+import pandas as pd
+from data import GDNData
+
+
+def make_dataframe(size) :
+    data = pd.DataFrame({
+        "opinionId": range(1, size + 1),
+        "text": ["une opinion"] * size,
+        "authorName": [random.choice(["LA_TRANSITION_ECOLOGIQUE", "DEMOCRATIE_ET_CITOYENNETE"]) for _ in range(size)],
+        "len": [11] * size,
+        "date": ["2019-01-22 10:00:00"] * size,
+    })
+    data["num_finished_annotations"] = 0
+    data["is_being_annotated"] = False
+    data["llm_1"] = ""
+    data["llm_2"] = ""
+    return data
+
+
+# the mask-based implementation GDNData used before the position index
+def legacy_get_data_from_id(data, opinionId) :
+    line = data[data["opinionId"] == opinionId].iloc[0][["opinionId", "text", "authorName", "len"]]
+    line = line.to_dict()
+    data.loc[data["opinionId"] == line["opinionId"], "is_being_annotated"] = True
+    return line
+
+def legacy_add_finished_annotation(data, opinion) :
+    data.loc[data["opinionId"] == opinion["opinion"]["opinionId"], "is_being_annotated"] = False
+    data.loc[data["opinionId"] == opinion["opinion"]["opinionId"], "num_finished_annotations"] += 1
+    if data[data["opinionId"] == opinion["opinion"]["opinionId"]].iloc[0]["llm_1"] == "" :
+        data.loc[data["opinionId"] == opinion["opinion"]["opinionId"], "llm_1"] = opinion["llm"]
+    else :
+        data.loc[data["opinionId"] == opinion["opinion"]["opinionId"], "llm_2"] = opinion["llm"]
+
+def legacy_get_used_llm(data, opinionId) :
+    line = data[data["opinionId"] == opinionId].iloc[0]
+    return [llm for llm in (line["llm_1"], line["llm_2"]) if llm]
+
+
+def time_per_call(function, ids) :
+    start = time.perf_counter()
+    for opinionId in ids :
+        function(opinionId)
+    return (time.perf_counter() - start) / len(ids) * 1e6
+
+
+def run(size, calls) :
+    ids = [random.randint(1, size) for _ in range(calls)]
+    legacy = make_dataframe(size)
+    indexed = GDNData(make_dataframe(size))
+
+    results = {
+        "get_data_from_id": (
+            time_per_call(lambda i: legacy_get_data_from_id(legacy, i), ids),
+            time_per_call(indexed.get_data_from_id, ids),
+        ),
+        "add_finished_annotation": (
+            time_per_call(lambda i: legacy_add_finished_annotation(legacy, {"opinion": {"opinionId": i}, "llm": "gpt-4.1"}), ids),
+            time_per_call(lambda i: indexed.add_finished_annotation({"opinion": {"opinionId": i}, "llm": "gpt-4.1"}), ids),
+        ),
+        "get_used_llm": (
+            time_per_call(lambda i: legacy_get_used_llm(legacy, i), ids),
+            time_per_call(indexed.get_used_llm, ids),
+        ),
+    }
+
+    for name, (before, after) in results.items() :
+        print(f"{size:>9} rows  {name:<25} before {before:>10.1f} us/call  after {after:>8.1f} us/call  x{before / after:.0f}")
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Benchmark GDNData lookups")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    for size in args.sizes :
+        run(size, args.calls)
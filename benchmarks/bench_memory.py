@@ -0,0 +1,68 @@
+"""
+Memory held by the opinions dataframe, loaded with pd.read_json (every text in memory)
+or with read_compact_opinions (texts memory-mapped and decoded on demand),
+for synthetic DATA_FILEs with growing text volume.
+
+    python benchmarks/bench_memory.py --rows 100000 --text-lengths 100 1000 5000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("ANNOTATION_DATA_FILE", "unused.jsonl")
+
+import pandas as pd
+from data import read_compact_opinions
+
+THEMES = ["LA_FISCALITE_ET_LES_DEPENSES_PUBLIQUES", "LA_TRANSITION_ECOLOGIQUE", "DEMOCRATIE_ET_CITOYENNETE", "ORGANISATION_DE_LETAT_ET_DES_SERVICES_PUBLICS"]
+
+
+def write_data_file(path, rows, text_length) :
+    with open(path, "w") as f:
+        for opinionId in range(1, rows + 1) :
+            text = "".join(random.choices("abcdefghijklmnopqrstuvwxyz ", k=text_length))
+            f.write(json.dumps({"opinionId": opinionId, "text": text, "authorName": random.choice(THEMES),
+                                "len": text_length, "date": "2019-01-22 10:00:00"}) + "\n")
+
+
+def mebibytes(data) :
+    return data.memory_usage(deep = True).sum() / 2 ** 20
+
+
+def run(rows, text_length) :
+    with tempfile.TemporaryDirectory() as directory :
+        path = Path(directory) / "data.jsonl"
+        write_data_file(path, rows, text_length)
+        file_size = os.path.getsize(path) / 2 ** 20
+
+        start = time.perf_counter()
+        full = pd.read_json(path, lines = True)
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        compact, texts = read_compact_opinions(path)
+        compact_time = time.perf_counter() - start
+        # the line offsets are the only other per-opinion memory of the lazy mode
+        offsets = (texts.starts.nbytes + texts.ends.nbytes) / 2 ** 20
+
+        print(f"{rows:>8} rows x {text_length:>5} chars ({file_size:>7.1f} MiB file)  "
+              f"read_json {mebibytes(full):>8.1f} MiB in {full_time:>5.1f}s  "
+              f"compact {mebibytes(compact) + offsets:>6.1f} MiB in {compact_time:>5.1f}s")
+        texts.mmap.close()
+        texts.file.close()
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Benchmark the memory of the opinions dataframe")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--text-lengths", type=int, nargs="+", default=[100, 1000, 5000])
+    args = parser.parse_args()
+
+    for text_length in args.text_lengths :
+        run(args.rows, text_length)
@@ -0,0 +1,72 @@
+"""
+Overload test of the GroqLLM rate limiter against fake_llm.py enforcing a rate limit:
+the same burst of concurrent queries is sent without limiter, then with a limiter set
+just under the provider's limit, and the unanswered queries and 429s are compared.
+
+    python benchmarks/bench_rate_limit.py --calls 100 --threads 16 --provider-limit 10 --window 1
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.environ.setdefault("ANNOTATION_DATA_FILE", "unused.jsonl")
+os.environ.setdefault("GROQ_API_KEY", "fake")
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+from fake_llm import FakeLLMServer
+from groqLLM import GroqLLM
+from rateLimiter import RateLimiter, queue_wait_seconds
+
+
+def run(llm, calls, threads) :
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor :
+        answers = list(executor.map(lambda i : llm.query(f"opinion {i}"), range(calls)))
+    return answers, time.perf_counter() - started
+
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--provider-limit", type=int, default=10, help="calls the fake provider accepts per window")
+    parser.add_argument("--window", type=float, default=1.0, help="seconds")
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--queue-timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    # a token bucket lets burst + rate * window calls through in any window, keep that under the provider limit
+    burst = max(1, args.provider_limit // 2)
+    rpm = (args.provider_limit - burst) * 60 / args.window
+    limits = {"groq": {"rpm": rpm, "rpm_burst": burst}}
+
+    for name, limiter in [("no limiter", RateLimiter({}, args.calls, args.queue_timeout)),
+                          (f"limiter {limits}", RateLimiter(limits, args.calls, args.queue_timeout))] :
+        server = FakeLLMServer(latency=args.latency, rate_limit=args.provider_limit, rate_window=args.window).start()
+        llm = GroqLLM("llama-3.1-8b-instant", rate_limiter=limiter)
+        llm.api_url = server.url
+        queue_wait_seconds.values.clear()
+        # silence the per-call prints
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try :
+            answers, elapsed = run(llm, args.calls, args.threads)
+        finally :
+            sys.stdout.close()
+            sys.stdout = stdout
+        server.shutdown()
+
+        unanswered = sum(answer is None for answer in answers)
+        waits = queue_wait_seconds.values.get(("groq",))
+        mean_wait = waits[1] / sum(waits[0]) if waits else 0.0
+        print(f"{name:<60} {elapsed:7.2f}s  unanswered {unanswered:4d}/{args.calls}  "
+              f"429 received {server.num_rate_limited:4d}  mean queue wait {mean_wait:.2f}s  "
+              f"throughput {(args.calls - unanswered) / elapsed:.1f} answers/s")
+
+
+if __name__ == "__main__" :
+    main()
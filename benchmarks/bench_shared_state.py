@@ -0,0 +1,96 @@
+"""
+Multi-process load test of the SQLite shared assignment state: several processes,
+each with several threads, claim opinions through GDNData.next_data until none is left,
+then the claims are checked for duplicate assignments.
+
+    python benchmarks/bench_shared_state.py --rows 5000 --processes 4 --threads 4
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("ANNOTATION_DATA_FILE", "unused.jsonl")
+
+import pandas as pd
+from data import GDNData
+from sharedState import SQLiteAssignmentState
+
+
+class BenchUser :
+    "the part of User that next_data uses, the token is the holder of the leases"
+    def __init__(self, token) :
+        self.token = token
+        self.done_annotations = []
+
+    def can_be_second_annotator(self) :
+        return False
+
+
+def make_dataframe(size) :
+    data = pd.DataFrame({
+        "opinionId": range(1, size + 1),
+        "text": ["une opinion"] * size,
+        "authorName": ["LA_TRANSITION_ECOLOGIQUE"] * size,
+        "len": [11] * size,
+    })
+    data["num_finished_annotations"] = 0
+    data["is_being_annotated"] = False
+    data["llm_1"] = ""
+    data["llm_2"] = ""
+    return data
+
+
+def claim_all(all_data, threads, results) :
+    claimed = []
+    def worker(i) :
+        user = BenchUser(f"bench-{os.getpid()}-{i}")
+        while True :
+            try :
+                line = all_data.next_data(user)
+            except OverflowError :
+                return
+            claimed.append(line["opinionId"])
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers :
+        thread.start()
+    for thread in workers :
+        thread.join()
+    results.put(claimed)
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Load test the shared assignment state")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory :
+        # the data is loaded once and inherited by the forked processes, as with app.py --workers
+        all_data = GDNData(make_dataframe(args.rows))
+        all_data.use_shared_state(SQLiteAssignmentState.create(Path(directory) / "state.sqlite", all_data.data, all_data.lease_ttl))
+
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        start = time.perf_counter()
+        processes = [context.Process(target=claim_all, args=(all_data, args.threads, results)) for _ in range(args.processes)]
+        for process in processes :
+            process.start()
+        claims = [opinionId for _ in processes for opinionId in results.get()]
+        for process in processes :
+            process.join()
+        elapsed = time.perf_counter() - start
+
+    duplicates = {opinionId: count for opinionId, count in Counter(claims).items() if count > 1}
+    print(f"{len(claims)} claims of {args.rows} opinions by {args.processes} processes x {args.threads} threads "
+          f"in {elapsed:.2f}s ({len(claims) / elapsed:.0f} claims/s)")
+    print(f"duplicate assignments: {len(duplicates)}, unclaimed opinions: {args.rows - len(set(claims))}")
+    sys.exit(1 if duplicates or len(set(claims)) != args.rows else 0)
@@ -0,0 +1,99 @@
+"""
+Startup replay time of all_annotations.jsonl / all_reports.jsonl on synthetic
+annotation logs, comparing the old line-by-line replay with replay_logs.
+
+    python benchmarks/bench_startup.py --rows 100000 --annotations 1000 5000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("ANNOTATION_DATA_FILE", "unused.jsonl")
+
+import pandas as pd
+from data import replay_logs
+
+
+def make_dataframe(size) :
+    data = pd.DataFrame({
+        "opinionId": range(1, size + 1),
+        "text": ["une opinion"] * size,
+        "authorName": ["LA_TRANSITION_ECOLOGIQUE"] * size,
+        "len": [11] * size,
+    })
+    data["num_finished_annotations"] = 0
+    data["is_being_annotated"] = False
+    data["llm_1"] = ""
+    data["llm_2"] = ""
+    return data
+
+
+def write_logs(directory, rows, num_annotations, num_reports) :
+    annotations_file = Path(directory) / "all_annotations.jsonl"
+    reports_file = Path(directory) / "all_reports.jsonl"
+    # every opinion is annotated at most twice, as in the real campaign
+    annotated = random.sample(range(1, rows + 1), num_annotations // 2 + 1)
+    ids = (annotated + annotated)[:num_annotations]
+    random.shuffle(ids)
+    with open(annotations_file, "w") as f:
+        for opinionId in ids :
+            f.write(json.dumps({"opinion": {"opinionId": opinionId, "text": "une opinion"}, "results": [], "llm": "gpt-4.1", "annotator": "bench"}) + "\n")
+    with open(reports_file, "w") as f:
+        for opinionId in random.sample(range(1, rows + 1), num_reports) :
+            f.write(json.dumps({"opinion": {"opinionId": opinionId}, "reason": "other", "annotator": "bench"}) + "\n")
+    return annotations_file, reports_file
+
+
+# the line-by-line replay load_data used before replay_logs
+def legacy_replay(data, annotations_file, reports_file) :
+    with open(annotations_file, "r") as f:
+        for line in f:
+            line = json.loads(line)
+            data.loc[data["opinionId"] == line["opinion"]["opinionId"], "num_finished_annotations"] += 1
+            if data[data["opinionId"] == line["opinion"]["opinionId"]].iloc[0]["llm_1"] == "" :
+                data.loc[data["opinionId"] == line["opinion"]["opinionId"], "llm_1"] = "a"
+            else :
+                data.loc[data["opinionId"] == line["opinion"]["opinionId"], "llm_2"] = "a"
+    with open(reports_file, "r") as f:
+        for line in f:
+            line = json.loads(line)
+            data.loc[data["opinionId"] == line["opinion"]["opinionId"], "num_finished_annotations"] = -1
+    return data
+
+
+def run(rows, num_annotations, num_reports) :
+    with tempfile.TemporaryDirectory() as directory :
+        annotations_file, reports_file = write_logs(directory, rows, num_annotations, num_reports)
+
+        legacy = make_dataframe(rows)
+        start = time.perf_counter()
+        legacy_replay(legacy, annotations_file, reports_file)
+        before = time.perf_counter() - start
+
+        vectorized = make_dataframe(rows)
+        start = time.perf_counter()
+        replay_logs(vectorized, annotations_file, reports_file)
+        after = time.perf_counter() - start
+
+    columns = ["num_finished_annotations", "llm_1", "llm_2"]
+    identical = legacy[columns].equals(vectorized[columns])
+    print(f"{rows:>9} rows {num_annotations:>7} annotations {num_reports:>5} reports  "
+          f"before {before:>8.3f}s  after {after:>7.3f}s  identical={identical}")
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Benchmark the startup replay of annotations and reports")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--annotations", type=int, nargs="+", default=[1_000, 5_000])
+    parser.add_argument("--reports", type=int, default=100)
+    args = parser.parse_args()
+
+    for rows in args.rows :
+        for num_annotations in args.annotations :
+            run(rows, num_annotations, args.reports)
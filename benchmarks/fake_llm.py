@@ -0,0 +1,114 @@
+"""
+Local stand-in for the Groq and OpenAI chat completion APIs, used by the load tests.
+Every call waits latency +- jitter seconds, then fails with error_status with probability error_rate,
+or answers with a short sentence. With rate_limit, calls beyond rate_limit per rate_window seconds
+are answered 429 right away, like a provider enforcing its limits.
+
+    python benchmarks/fake_llm.py --port 8900 --latency 0.5 --jitter 0.2 --error-rate 0.05
+
+and start app.py with GROQ_API_URL and OPENAI_API_URL set to http://127.0.0.1:8900/v1/chat/completions.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeLLMServer(ThreadingHTTPServer) :
+    daemon_threads = True
+    # many annotators call the models at once
+    request_queue_size = 1024
+
+    def __init__(self, port = 0, latency = 0.5, jitter = 0.0, error_rate = 0.0, error_status = 503,
+                 rate_limit = None, rate_window = 60.0) :
+        super().__init__(("127.0.0.1", port), FakeLLMHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        # times of the calls accepted in the last rate_window seconds
+        self.accepted = deque()
+        self.lock = threading.Lock()
+        self.num_calls = 0
+        self.num_errors = 0
+        self.num_rate_limited = 0
+
+    def over_rate_limit(self) :
+        if self.rate_limit is None :
+            return False
+        now = time.monotonic()
+        with self.lock :
+            while self.accepted and self.accepted[0] <= now - self.rate_window :
+                self.accepted.popleft()
+            if len(self.accepted) >= self.rate_limit :
+                self.num_rate_limited += 1
+                return True
+            self.accepted.append(now)
+            return False
+
+    @property
+    def url(self) :
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+    def start(self) :
+        "serves from a daemon thread, returns the server"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler) :
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) :
+        pass
+
+    def do_POST(self) :
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        if server.over_rate_limit() :
+            self.answer(429, {"error": {"message": "rate limit reached"}}, {"Retry-After": "1"})
+            return
+        time.sleep(max(0.0, random.uniform(server.latency - server.jitter, server.latency + server.jitter)))
+
+        failed = random.random() < server.error_rate
+        with server.lock :
+            server.num_calls += 1
+            server.num_errors += failed
+        if failed :
+            status, answer = server.error_status, {"error": {"message": "fake error"}}
+        else :
+            status, answer = 200, {"choices": [{"message": {"role": "assistant", "content": f"Argument reformulé par {body['model']}."}}]}
+
+        self.answer(status, answer)
+
+    def answer(self, status, answer, headers = {}) :
+        content = json.dumps(answer).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items() :
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.5, help="mean answer time in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--rate-limit", type=int, default=None, help="calls accepted per rate window, 429 beyond")
+    parser.add_argument("--rate-window", type=float, default=60.0, help="seconds")
+    args = parser.parse_args()
+
+    server = FakeLLMServer(args.port, args.latency, args.jitter, args.error_rate, args.error_status,
+                           args.rate_limit, args.rate_window)
+    print(f"fake LLM listening on {server.url}")
+    server.serve_forever()
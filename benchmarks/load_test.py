@@ -0,0 +1,284 @@
+"""
+End-to-end load test of app.py: N simulated annotators run the real flow
+(/check-token, tutorial examples, /next-data, /opinion-response, /summaries or /report)
+against a server started on a synthetic DATA_FILE, with fake_llm.py standing in for Groq and OpenAI.
+Reports throughput, p50/p95/p99 per route and assignment conflicts.
+
+    python benchmarks/load_test.py --annotators 50 --duration 60 --llm-latency 0.8 --llm-error-rate 0.02
+
+Everything runs in a temporary directory, kept with --keep (the server output is in server.log).
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.environ.setdefault("ANNOTATION_DATA_FILE", "unused.jsonl")
+
+import numpy as np
+import requests
+from const import RESULTS_EXAMPLES, REPORT_FR_TO_EN
+from fake_llm import FakeLLMServer
+
+THEMES = ["LA_TRANSITION_ECOLOGIQUE", "LA_FISCALITE_ET_LES_DEPENSES_PUBLIQUES",
+          "DEMOCRATIE_ET_CITOYENNETE", "ORGANISATION_DE_LETAT_ET_DES_SERVICES_PUBLICS"]
+WORDS = ["il", "faut", "réduire", "les", "impôts", "pour", "aider", "services", "publics", "transition",
+         "écologique", "citoyens", "démocratie", "taxe", "carbone", "retraite", "santé", "école", "transport", "local"]
+
+
+def write_data_file(path, rows) :
+    "synthetic opinions with the columns of the real DATA_FILE"
+    with open(path, "w") as f :
+        for i in range(rows) :
+            text = " ".join(random.choices(WORDS, k=random.randint(20, 200))) + "."
+            f.write(json.dumps({
+                "opinionId": 100000 + i,
+                "text": text,
+                "authorName": random.choice(THEMES),
+                "len": len(text),
+                "date": f"2019-0{1 + i % 3}-{10 + i % 18}",
+            }) + "\n")
+
+
+def make_segments(opinion, kinds_per_unit) :
+    "one color per argument unit, one segment per kind"
+    text = opinion["text"]
+    segments = {}
+    for unit, kinds in enumerate(kinds_per_unit) :
+        for kind in kinds :
+            segment_id = f"{opinion['opinionId']}-c{unit}-{len(segments)}"
+            start = random.randint(0, max(0, len(text) - 20))
+            segments[segment_id] = {"segmentId": segment_id, "color": f"c{unit}", "hex": "#1976D2", "type": kind,
+                                    "start": start, "end": start + 20, "text": text[start:start + 20]}
+    return segments
+
+
+def example_segments(opinion) :
+    "a segmentation passing is_valid_example: the expected kinds spread round-robin over the expected units"
+    expected = RESULTS_EXAMPLES[opinion["opinionId"]]
+    kinds = (["claim"] * expected["num_claims"] + ["premise"] * expected["num_premises"]
+             + ["solution"] * expected["num_solutions"])
+    units = [[] for _ in range(expected["num_argumentative_units"])]
+    for i, kind in enumerate(kinds) :
+        units[i % len(units)].append(kind)
+    return make_segments(opinion, units)
+
+
+def random_segments(opinion, max_units) :
+    units = [random.sample(["claim", "premise", "solution"], random.randint(1, 3)) for _ in range(random.randint(1, max_units))]
+    return make_segments(opinion, units)
+
+
+class LoadStats :
+    "latencies per route and assignment checks, shared by the annotator threads"
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # opinionId -> annotator holding it, between /next-data and /summaries or /report
+        self.holders = {}
+        self.annotated_by = defaultdict(list)
+        self.reported = set()
+        self.conflicts = {"held_by_another_annotator": 0, "already_annotated_by_annotator": 0, "reported_opinion": 0}
+
+    def record(self, route, seconds, ok) :
+        with self.lock :
+            self.latencies[route].append(seconds)
+            if not ok :
+                self.errors[route] += 1
+
+    def assigned(self, opinion_id, annotator) :
+        with self.lock :
+            holder = self.holders.get(opinion_id)
+            if holder is not None and holder != annotator :
+                self.conflicts["held_by_another_annotator"] += 1
+            if annotator in self.annotated_by[opinion_id] :
+                self.conflicts["already_annotated_by_annotator"] += 1
+            if opinion_id in self.reported :
+                self.conflicts["reported_opinion"] += 1
+            self.holders[opinion_id] = annotator
+
+    def releasing(self, opinion_id, annotator) :
+        "called before /summaries or /report: the server may hand the opinion out again before their answer arrives"
+        with self.lock :
+            if self.holders.get(opinion_id) == annotator :
+                del self.holders[opinion_id]
+
+    def finished(self, opinion_id, annotator, reported = False) :
+        with self.lock :
+            if reported :
+                self.reported.add(opinion_id)
+            else :
+                self.annotated_by[opinion_id].append(annotator)
+
+    def over_annotated(self) :
+        return sum(1 for annotators in self.annotated_by.values() if len(annotators) > 2)
+
+
+class Annotator :
+    def __init__(self, base_url, token, stats, args) :
+        self.base_url = base_url
+        self.token = token
+        self.stats = stats
+        self.args = args
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        self.num_annotations = 0
+
+    def call(self, method, route, **kwargs) :
+        started = time.perf_counter()
+        try :
+            response = self.session.request(method, self.base_url + route, timeout=self.args.timeout, **kwargs)
+        except requests.RequestException :
+            self.stats.record(route, time.perf_counter() - started, False)
+            return None
+        self.stats.record(route, time.perf_counter() - started, response.ok)
+        return response
+
+    def annotate(self, opinion, segments) :
+        response = self.call("POST", "/opinion-response", json={
+            "opinionId": opinion["opinionId"], "full_text": opinion["text"],
+            "authorName": opinion["authorName"], "segments": segments,
+        })
+        if response is None or not response.ok :
+            return False
+        time.sleep(self.args.think)
+        if "Example" not in str(opinion["opinionId"]) :
+            self.stats.releasing(opinion["opinionId"], self.token)
+        response = self.call("POST", "/summaries", json={"opinion": opinion, "results": response.json()["results"]})
+        return response is not None and response.ok
+
+    def run(self, deadline) :
+        self.call("POST", "/check-token", json={"token": self.token})
+        while time.monotonic() < deadline :
+            response = self.call("GET", "/next-data")
+            if response is None :
+                continue
+            if not response.ok :
+                # no more opinions to annotate
+                return
+            opinion = response.json()
+            opinion_id = opinion["opinionId"]
+            time.sleep(self.args.think)
+
+            if "Example" in str(opinion_id) :
+                self.annotate(opinion, example_segments(opinion))
+            elif random.random() < self.args.report_rate :
+                self.stats.assigned(opinion_id, self.token)
+                self.stats.releasing(opinion_id, self.token)
+                response = self.call("POST", "/report", json={"opinion": opinion, "reason": random.choice(list(REPORT_FR_TO_EN))})
+                if response is not None and response.ok :
+                    self.stats.finished(opinion_id, self.token, reported=True)
+            else :
+                self.stats.assigned(opinion_id, self.token)
+                if self.annotate(opinion, random_segments(opinion, self.args.max_units)) :
+                    self.stats.finished(opinion_id, self.token)
+                    self.num_annotations += 1
+
+
+def free_port() :
+    with socket.socket() as sock :
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir, port, llm_url, workers, extra_args = ()) :
+    env = dict(os.environ,
+               ANNOTATION_DATA_FILE=str(workdir / "data.jsonl"),
+               GROQ_API_KEY="fake", OPENAI_API_KEY="fake",
+               GROQ_API_URL=llm_url, OPENAI_API_URL=llm_url)
+    log = open(workdir / "server.log", "w")
+    server = subprocess.Popen([sys.executable, str(ROOT / "app.py"), "--port", str(port), "--workers", str(workers), *extra_args],
+                              cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 300
+    while time.monotonic() < deadline :
+        if server.poll() is not None :
+            raise RuntimeError(f"app.py exited with {server.returncode}, see {workdir / 'server.log'}")
+        try :
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError :
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("app.py did not start listening")
+
+
+def print_report(stats, elapsed, annotators, llm) :
+    print(f"\n{'route':<22}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    total = 0
+    for route, latencies in sorted(stats.latencies.items()) :
+        p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+        total += len(latencies)
+        print(f"{route:<22}{len(latencies):>8}{stats.errors[route]:>8}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+
+    num_annotations = sum(annotator.num_annotations for annotator in annotators)
+    print(f"\n{elapsed:.1f}s: {total / elapsed:.1f} requests/s, {num_annotations / elapsed:.2f} annotations/s "
+          f"({num_annotations} annotations, {len(stats.reported)} reports)")
+    print(f"LLM calls: {llm.num_calls}, failed on purpose: {llm.num_errors}")
+    conflicts = dict(stats.conflicts, annotated_more_than_twice=stats.over_annotated())
+    print("assignment conflicts: " + ", ".join(f"{name}={count}" for name, count in conflicts.items()))
+
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annotators", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--rows", type=int, default=5000, help="opinions in the synthetic DATA_FILE")
+    parser.add_argument("--workers", type=int, default=1, help="app.py --workers")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="app.py --async")
+    parser.add_argument("--think", type=float, default=0.0, help="seconds an annotator waits between two calls")
+    parser.add_argument("--report-rate", type=float, default=0.05)
+    parser.add_argument("--max-units", type=int, default=3, help="argument units (LLM calls) per opinion")
+    parser.add_argument("--timeout", type=float, default=120, help="client timeout in seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-jitter", type=float, default=0.2)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="gdn-load-"))
+    tokens = [f"annotator{i}" for i in range(args.annotators)]
+    (workdir / "annotators").mkdir()
+    (workdir / "annotators" / "allowed_tokens.txt").write_text("\n".join(tokens) + "\n")
+    (workdir / "annotators" / "admin_tokens.txt").write_text("admin\n")
+    write_data_file(workdir / "data.jsonl", args.rows)
+
+    llm = FakeLLMServer(latency=args.llm_latency, jitter=args.llm_jitter, error_rate=args.llm_error_rate).start()
+    port = free_port()
+    server = start_server(workdir, port, llm.url, args.workers, ["--async"] if args.async_mode else [])
+    print(f"app.py on port {port}, {args.annotators} annotators for {args.duration}s, files in {workdir}")
+
+    stats = LoadStats()
+    annotators = [Annotator(f"http://127.0.0.1:{port}", token, stats, args) for token in tokens]
+    started = time.monotonic()
+    threads = [threading.Thread(target=annotator.run, args=(started + args.duration,)) for annotator in annotators]
+    try :
+        for thread in threads :
+            thread.start()
+        for thread in threads :
+            thread.join()
+    finally :
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+        llm.shutdown()
+    print_report(stats, time.monotonic() - started, annotators, llm)
+
+    if not args.keep :
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__" :
+    main()
@@ -2,14 +2,61 @@ from pathlib import Path
 import os
 
 DATA_FILE = Path(os.environ["ANNOTATION_DATA_FILE"])
+# "1": keep only ids, counters and flags in memory and read texts from the memory-mapped DATA_FILE
+LAZY_TEXTS = os.environ.get("ANNOTATION_LAZY_TEXTS", "0") == "1"
 
 
 ANNOTATORS_DIR = Path("./annotators/")
 ALL_ANNOTATIONS_OUTPUT_FILE = Path("./annotators/all_annotations.jsonl")
 ALL_REPORTS_OUTPUT_FILE = Path("./annotators/all_reports.jsonl")
+ALLOWED_TOKENS_FILE = Path("./annotators/allowed_tokens.txt")
+ADMIN_TOKENS_FILE = Path("./annotators/admin_tokens.txt")
+# seconds between two checks of the token files for changes
+TOKEN_RECHECK_INTERVAL = float(os.environ.get("ANNOTATION_TOKEN_RECHECK_INTERVAL", 1))
+# assignment state shared by the server processes when app.py runs with --workers
+SHARED_STATE_FILE = Path("./annotators/assignment_state.sqlite")
+# where users, annotations and reports are kept: "jsonl" (one directory per annotator) or "sqlite"
+STORAGE_BACKEND = os.environ.get("ANNOTATION_STORAGE", "jsonl")
+STORAGE_DB_FILE = Path("./annotators/storage.sqlite")
+# per-annotator offsets of the last collect_all_annotations run
+COLLECT_MANIFEST_FILE = Path("./annotators/collect_manifest.json")
+# GDNData state saved for fast restarts, rewritten every SNAPSHOT_INTERVAL seconds (0 disables snapshots)
+SNAPSHOT_FILE = Path("./annotators/gdn_snapshot.pkl")
+SNAPSHOT_INTERVAL = float(os.environ.get("ANNOTATION_SNAPSHOT_INTERVAL", 10 * 60))
+# request profiles taken for admins, only the PROFILES_KEPT most recent ones are kept
+PROFILES_DIR = Path("./logs/profiles/")
+PROFILES_KEPT = int(os.environ.get("ANNOTATION_PROFILES_KEPT", 200))
+# seconds between two publications of the metrics of a server process when app.py runs with --workers
+METRICS_PUBLISH_INTERVAL = float(os.environ.get("ANNOTATION_METRICS_PUBLISH_INTERVAL", 1))
+# JSON lines logs, written by a background thread: records waiting beyond LOG_QUEUE_SIZE are dropped,
+# files are rotated past LOG_MAX_BYTES keeping LOG_BACKUPS old ones. LOG_LEVEL can be changed at runtime through /log-level.
+LOG_DIR = Path("./logs/")
+LOG_LEVEL = os.environ.get("ANNOTATION_LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.environ.get("ANNOTATION_LOG_QUEUE_SIZE", 10000))
+LOG_MAX_BYTES = int(os.environ.get("ANNOTATION_LOG_MAX_BYTES", 50 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get("ANNOTATION_LOG_BACKUPS", 5))
+
+# app.py --async: seconds an idle keep-alive connection stays open, seconds to receive the rest of
+# a request once its first line arrived, and largest request body accepted (bytes)
+ASYNC_IDLE_TIMEOUT = float(os.environ.get("ANNOTATION_ASYNC_IDLE_TIMEOUT", 75))
+ASYNC_READ_TIMEOUT = float(os.environ.get("ANNOTATION_ASYNC_READ_TIMEOUT", 30))
+ASYNC_MAX_BODY_BYTES = int(os.environ.get("ANNOTATION_ASYNC_MAX_BODY_BYTES", 10 * 1024 * 1024))
 
 NUM_ANNOTATIONS_BEFORE_SHARED = 5
 
+# seconds an opinion stays reserved for an annotator without activity,
+# and seconds between two returns of expired reservations to the pools
+LEASE_TTL = float(os.environ.get("ANNOTATION_LEASE_TTL", 30 * 60))
+LEASE_REAP_INTERVAL = float(os.environ.get("ANNOTATION_LEASE_REAP_INTERVAL", 60))
+
+# "always": fsync every line appended to an annotator's jsonl files, "never": leave it to the OS
+JSONL_FSYNC = os.environ.get("ANNOTATION_JSONL_FSYNC", "always")
+
+# number of users kept in memory, and seconds a user change may stay in memory before
+# being written to user.pkl (0 writes on every save)
+USER_CACHE_SIZE = int(os.environ.get("ANNOTATION_USER_CACHE_SIZE", 1000))
+USER_FLUSH_INTERVAL = float(os.environ.get("ANNOTATION_USER_FLUSH_INTERVAL", 2))
+
 REPORT_FR_TO_EN = {
     "discours de haine": "hate speech",
     "incomprehensible": "incomprehensible",
@@ -18,6 +65,31 @@ REPORT_FR_TO_EN = {
     "autre": "other"
 }
 
+# LLM calls running at the same time, and seconds /opinion-response waits for all its arguments
+LLM_MAX_WORKERS = int(os.environ.get("ANNOTATION_LLM_MAX_WORKERS", 16))
+LLM_REQUEST_DEADLINE = float(os.environ.get("ANNOTATION_LLM_REQUEST_DEADLINE", 60))
+
+# models whose answers are cached (comma separated), so that identical prompts are not sent twice.
+# Leave a model out to keep sampling a new answer every time.
+CACHED_MODELS = [model for model in os.environ.get("ANNOTATION_CACHED_MODELS", "").split(",") if model]
+LLM_CACHE_FILE = Path("./cache/llm_cache.sqlite")
+LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get("ANNOTATION_LLM_CACHE_MEMORY_ENTRIES", 2048))
+LLM_CACHE_MAX_DISK_BYTES = int(os.environ.get("ANNOTATION_LLM_CACHE_MAX_DISK_BYTES", 64 * 1024 * 1024))
+
+# model selection: rolling window of calls kept per model, circuit breaker opened after
+# LLM_BREAKER_FAILURES failures in a row or an error rate above LLM_BREAKER_ERROR_RATE, for LLM_BREAKER_COOLDOWN seconds.
+# With LLM_LATENCY_BIAS above 0, faster models are picked more often (0 keeps the choice uniform).
+LLM_ROUTER_WINDOW = int(os.environ.get("ANNOTATION_LLM_ROUTER_WINDOW", 100))
+LLM_BREAKER_FAILURES = int(os.environ.get("ANNOTATION_LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_ERROR_RATE = float(os.environ.get("ANNOTATION_LLM_BREAKER_ERROR_RATE", 0.5))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("ANNOTATION_LLM_BREAKER_COOLDOWN", 30))
+LLM_LATENCY_BIAS = float(os.environ.get("ANNOTATION_LLM_LATENCY_BIAS", 0))
+# send a second identical request to the same model when the first one is slower than
+# the LLM_HEDGE_QUANTILE of its recent latencies (needs LLM_HEDGE_MIN_SAMPLES calls)
+LLM_HEDGE = os.environ.get("ANNOTATION_LLM_HEDGE", "0") == "1"
+LLM_HEDGE_QUANTILE = float(os.environ.get("ANNOTATION_LLM_HEDGE_QUANTILE", 0.95))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("ANNOTATION_LLM_HEDGE_MIN_SAMPLES", 20))
+
 ALL_MODELS = [
     "llama-3.3-70b-versatile",
     "llama-3.1-8b-instant",
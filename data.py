@@ -1,145 +1,450 @@
-from const import DATA_FILE, ANNOTATORS_DIR, ALL_ANNOTATIONS_OUTPUT_FILE, ALL_REPORTS_OUTPUT_FILE
+from const import DATA_FILE, ALL_ANNOTATIONS_OUTPUT_FILE, ALL_REPORTS_OUTPUT_FILE, LEASE_TTL, LEASE_REAP_INTERVAL, LAZY_TEXTS, SNAPSHOT_FILE, SNAPSHOT_INTERVAL
 import pandas as pd
+import numpy as np
 import os
-from filelock import FileLock
 import json
+import mmap
+import heapq
+import threading
+import atexit
+import time
+import logging
 from user import User
+from storage import storage
+from snapshot import bytes_digest, data_file_key, load_snapshot, save_snapshot
+from stats import annotation_stats, add_items, logged_items
+
+logger = logging.getLogger(__name__)
+
+
+class OpinionPools :
+    """
+    Opinions that can be handed out, split by their number of finished annotations
+    (0: never annotated, 1: waiting for a second annotator).
+    Each pool is a heap of row positions, so opinions keep being handed out in file order,
+    and a set used for membership tests. Removed positions are left in the heap and skipped
+    when popped.
+    """
+    POOLS = (0, 1)
+
+    def __init__(self, num_finished_annotations, is_being_annotated) :
+        self.members = {count: set() for count in self.POOLS}
+        for pos, (count, taken) in enumerate(zip(num_finished_annotations, is_being_annotated)) :
+            if (not taken) and count in self.members :
+                self.members[count].add(pos)
+        # a sorted list is a valid heap
+        self.heaps = {count: sorted(self.members[count]) for count in self.POOLS}
+
+    def size(self, count) :
+        return len(self.members[count])
+
+    def add(self, pos, count) :
+        if count not in self.members or pos in self.members[count] :
+            return
+        self.members[count].add(pos)
+        heapq.heappush(self.heaps[count], pos)
+
+    def discard(self, pos) :
+        for count in self.POOLS :
+            self.members[count].discard(pos)
+
+    def pop(self, count, excluded = frozenset()) :
+        "removes and returns the first available position that is not in excluded, or None"
+        heap = self.heaps[count]
+        members = self.members[count]
+        skipped = []
+        found = None
+        while heap :
+            pos = heapq.heappop(heap)
+            if pos not in members :
+                continue # stale entry
+            if pos in excluded :
+                skipped.append(pos)
+                continue
+            members.discard(pos)
+            found = pos
+            break
+
+        for pos in skipped :
+            heapq.heappush(heap, pos)
+
+        if len(heap) > 2 * len(members) + 64 :
+            self.heaps[count] = sorted(members)
+        return found
+
 
 class GDNData :
-    def __init__(self):
-        self.data = self.load_data()
+    def __init__(self, data = None, lease_ttl = LEASE_TTL, texts = None):
+        # LazyOpinionTexts holding the columns that are not in data (text, date), if any
+        self.texts = texts
+        # DATA_FILE key of the snapshots, columns read from DATA_FILE
+        # and result of count_logged_annotations, set when loading DATA_FILE
+        self.snapshot_key = None
+        self.base_columns = None
+        self.replayed = None
+        self.startup_times = {}
+        if data is None :
+            data = self.load_data()
+        self.data = data
+        self.lock = threading.RLock()
+        # reserved opinion position -> (time.monotonic() at which the reservation expires, token of its annotator)
+        self.leases = {}
+        self.lease_ttl = lease_ttl
+        self.num_expired_leases = 0
+        # SQLiteAssignmentState shared with other server processes, see use_shared_state
+        self.shared_state = None
+        started = time.perf_counter()
+        self.build_index()
+        self.build_pools()
+        self.startup_times["index"] = time.perf_counter() - started
+        if self.base_columns is not None :
+            logger.info("startup times", extra={f"{step}_seconds": round(seconds, 2) for step, seconds in self.startup_times.items()})
+
+    def build_index(self) :
+        # opinionId -> row position, so that lookups and single-row updates
+        # do not need a boolean mask over the whole dataframe
+        self.data.reset_index(drop = True, inplace = True)
+        self.positions = {opinionId: pos for pos, opinionId in enumerate(self.data["opinionId"].tolist())}
+
+    def build_pools(self) :
+        self.pools = OpinionPools(self.data["num_finished_annotations"].tolist(), self.data["is_being_annotated"].tolist())
+
+    def get_value(self, pos, column) :
+        # the index is a RangeIndex, so row labels are row positions
+        value = self.data.at[pos, column]
+        if isinstance(value, np.generic) :
+            value = value.item()
+        return value
+
+    def set_value(self, pos, column, value) :
+        self.data.at[pos, column] = value
+
+    def get_line(self, pos, columns) :
+        if self.texts is None :
+            return {column: self.get_value(pos, column) for column in columns}
+
+        line = {}
+        record = None
+        for column in columns :
+            if column in self.data.columns :
+                line[column] = self.get_value(pos, column)
+            else :
+                if record is None :
+                    record = self.texts.record(pos)
+                line[column] = record[column]
+        if "date" in line :
+            # same type as read_json's date column
+            line["date"] = pd.Timestamp(line["date"])
+        return line
+
+    def use_shared_state(self, shared_state) :
+        """
+        From now on, claims, releases, finished and reported annotations and used models
+        go through shared_state instead of this process' pools and columns.
+        """
+        self.shared_state = shared_state
+
+    def claim(self, pos, holder = None) :
+        "reserves an opinion for holder (a token) for lease_ttl seconds, must be called with the lock"
+        self.set_value(pos, "is_being_annotated", True)
+        self.pools.discard(pos)
+        self.leases[pos] = (time.monotonic() + self.lease_ttl, holder)
+
+    def held_by_another(self, pos, holder) :
+        "the opinion has an unexpired lease of another annotator, must be called with the lock"
+        lease = self.leases.get(pos)
+        return lease is not None and lease[0] > time.monotonic() and lease[1] != holder
+
+    def release(self, pos) :
+        "must be called with the lock"
+        self.set_value(pos, "is_being_annotated", False)
+        self.leases.pop(pos, None)
+
+    def renew_lease(self, opinionId, holder) :
+        """
+        Extends the reservation of an opinion that holder is working on.
+        If it already expired and nobody took the opinion since, it is reserved again.
+        Returns False when another annotator holds the opinion or it can no longer be annotated.
+        """
+        pos = self.positions.get(opinionId)
+        if pos is None :
+            return False
+        if self.shared_state is not None :
+            return self.shared_state.renew(opinionId, holder)
+        with self.lock :
+            if not self.can_be_finished_by(pos, holder) :
+                return False
+            self.claim(pos, holder)
+            return True
+
+    def can_be_finished_by(self, pos, holder) :
+        """
+        holder has the lease of the opinion, or the lease expired and nobody took the opinion since.
+        Must be called with the lock.
+        """
+        if self.held_by_another(pos, holder) :
+            return False
+        return pos in self.leases or self.get_value(pos, "num_finished_annotations") in OpinionPools.POOLS
+
+    def reap_expired_leases(self) :
+        "returns every opinion whose reservation expired to its pool, returns how many were"
+        if self.shared_state is not None :
+            return self.shared_state.reap_expired()
+        now = time.monotonic()
+        with self.lock :
+            expired = [pos for pos, (expiry, _) in self.leases.items() if expiry <= now]
+            for pos in expired :
+                self.release(pos)
+                self.pools.add(pos, self.get_value(pos, "num_finished_annotations"))
+            self.num_expired_leases += len(expired)
+        if expired :
+            logger.info("expired reservations returned to the pools", extra={"expired": len(expired)})
+        return len(expired)
+
+    def start_lease_reaper(self, interval = LEASE_REAP_INTERVAL) :
+        def reap_forever() :
+            while True :
+                time.sleep(interval)
+                self.reap_expired_leases()
+        threading.Thread(target=reap_forever, daemon=True).start()
+
+    def save_snapshot(self) :
+        """
+        Saves the columns read from DATA_FILE and the aggregated logs replayed so far, after
+        collecting the annotators' files, so that the next start only replays newer lines.
+        The in-memory counts are not saved: they also hold annotations that are not collected yet.
+        """
+        if self.snapshot_key is None :
+            return
+        started = time.perf_counter()
+        collect_all_annotations()
+        self.replayed = count_logged_annotations(self.data["opinionId"], replayed = self.replayed)
+        offsets = None if self.texts is None else (self.texts.starts, self.texts.ends)
+        save_snapshot(SNAPSHOT_FILE, self.snapshot_key, self.data[self.base_columns], offsets, self.replayed)
+        logger.info("snapshot saved", extra={"path": str(SNAPSHOT_FILE), "seconds": round(time.perf_counter() - started, 2)})
+
+    def start_snapshots(self, interval = SNAPSHOT_INTERVAL) :
+        "saves a snapshot now, then every interval seconds and at exit"
+        if self.snapshot_key is None or interval <= 0 :
+            return
+        pid = os.getpid()
+        def save_at_exit() :
+            # forked server processes inherit the handler
+            if os.getpid() == pid :
+                self.save_snapshot()
+        def save_forever() :
+            while True :
+                try :
+                    self.save_snapshot()
+                except Exception as e :
+                    logger.exception("could not save snapshot", extra={"path": str(SNAPSHOT_FILE)})
+                time.sleep(interval)
+        atexit.register(save_at_exit)
+        threading.Thread(target=save_forever, daemon=True).start()
+
+    def lease_counts(self) :
+        if self.shared_state is not None :
+            counts = self.shared_state.counts()
+            return {
+                "active": counts["active"],
+                "expired": self.shared_state.num_expired_leases,
+                "ttl": self.lease_ttl,
+                "unannotated_available": counts["unannotated_available"],
+                "once_annotated_available": counts["once_annotated_available"],
+                "reported": counts["reported"],
+            }
+        with self.lock :
+            return {
+                "active": len(self.leases),
+                "expired": self.num_expired_leases,
+                "ttl": self.lease_ttl,
+                "unannotated_available": self.pools.size(0),
+                "once_annotated_available": self.pools.size(1),
+                "reported": int((self.data["num_finished_annotations"] == -1).sum()),
+            }
 
     def load_data(self) :
-        print("setting up dataframe...")
-        data = pd.read_json(DATA_FILE, lines = True)
+        times = self.startup_times
+        started = time.perf_counter()
+        if SNAPSHOT_INTERVAL > 0 :
+            self.snapshot_key = data_file_key(DATA_FILE, LAZY_TEXTS)
+            snapshot = load_snapshot(SNAPSHOT_FILE, self.snapshot_key)
+        else :
+            snapshot = None
+        times["snapshot"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        if snapshot is not None :
+            logger.info("setting up dataframe from the snapshot", extra={"path": str(SNAPSHOT_FILE)})
+            data = snapshot["data"]
+            if snapshot["offsets"] is not None :
+                self.texts = LazyOpinionTexts(DATA_FILE, *snapshot["offsets"])
+            self.replayed = snapshot["replayed"]
+        else :
+            logger.info("setting up dataframe", extra={"path": str(DATA_FILE)})
+            if LAZY_TEXTS :
+                data, self.texts = read_compact_opinions(DATA_FILE)
+            else :
+                data = pd.read_json(DATA_FILE, lines = True)
+        self.base_columns = list(data.columns)
         data["num_finished_annotations"] = 0
         data["is_being_annotated"] = False
         data["llm_1"] = ""
         data["llm_2"] = ""
+        times["read"] = time.perf_counter() - started
 
-        print("collection already existing annotations...")
+        started = time.perf_counter()
+        logger.info("collecting already existing annotations")
         collect_all_annotations()
+        times["collect"] = time.perf_counter() - started
 
-        # get all already-done annotations
-        print("reading existing annotations...")
-        try :
-            with open(ALL_ANNOTATIONS_OUTPUT_FILE, "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        line = json.loads(line)
-                    except json.JSONDecodeError:
-                        print(f"Skipping invalid JSON in output file")
-                        continue
-                    data.loc[data["opinionId"] == line["opinion"]["opinionId"], "num_finished_annotations"] += 1
-                    if data[data["opinionId"] == line["opinion"]["opinionId"]].iloc[0]["llm_1"] == "" :
-                        data.loc[data["opinionId"] == line["opinion"]["opinionId"], "llm_1"] = "a"
-                    else : 
-                        data.loc[data["opinionId"] == line["opinion"]["opinionId"], "llm_2"]  = "a"
-    
-        except FileNotFoundError :
-            print(f"no {ALL_ANNOTATIONS_OUTPUT_FILE} file found")
-            pass
-        
-        # get all reported opinions
-        print("reading existing reports...")
-        try :
-            with open(ALL_REPORTS_OUTPUT_FILE, "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        line = json.loads(line)
-                    except json.JSONDecodeError:
-                        print(f"Skipping invalid JSON in output file")
-                        continue
-                    
-                    data.loc[data["opinionId"] == line["opinion"]["opinionId"], "num_finished_annotations"] = -1
-    
-        except FileNotFoundError :
-            print(f"no {ALL_REPORTS_OUTPUT_FILE} file found")
-            pass
+        # get all already-done annotations and reported opinions,
+        # only those logged after the snapshot when there is one
+        started = time.perf_counter()
+        self.replayed = replay_logs(data, replayed = self.replayed)
+        if LAZY_TEXTS :
+            data["num_finished_annotations"] = data["num_finished_annotations"].astype("int16")
+        times["replay"] = time.perf_counter() - started
 
         return data
 
     def next_data(self, user: User) :
-        print("CALING NEXT DATA")
-        
+        if self.shared_state is not None :
+            return self.next_shared_data(user)
 
-        if user.can_be_second_annotator() :
-            data = self.data[self.data["num_finished_annotations"] == 1]
-            if not data.empty :
-                i = 0
-                while i < len(data) :
-                    if (not data.iloc[i]["is_being_annotated"]) and (not (data.iloc[i]["opinionId"] in user.done_annotations)): 
-                        line = data.iloc[i][["opinionId", "text", "authorName", "len"]]
-                        line = line.to_dict()
-                        self.data.loc[self.data["opinionId"] == line["opinionId"], "is_being_annotated"] = True
-
-                        return line
-                    i += 1
-            
-        # either the user cant be second annotator or there is not opinion to be annotated a second time
-        i = 0
-        data = self.data[self.data["num_finished_annotations"] == 0]
-        while i < len(data) :
-            if (not data.iloc[i]["is_being_annotated"]) and (not (data.iloc[i]["opinionId"] in user.done_annotations)):  
-                line = data.iloc[i][["opinionId", "text", "authorName", "len"]]
-                line = line.to_dict()
-                self.data.loc[self.data["opinionId"] == line["opinionId"], "is_being_annotated"] = True
-                return line 
-            i += 1
-            
-        
-        raise OverflowError("No more opinions to annotate")
+        # positions of the opinions this user already annotated
+        done = {self.positions[opinionId] for opinionId in user.done_annotations if opinionId in self.positions}
+
+        with self.lock :
+            pos = None
+            if user.can_be_second_annotator() :
+                pos = self.pools.pop(1, done)
+
+            # either the user cant be second annotator or there is not opinion to be annotated a second time
+            if pos is None :
+                pos = self.pools.pop(0, done)
+
+            if pos is None :
+                raise OverflowError("No more opinions to annotate")
+
+            self.claim(pos, user.token)
+            return self.get_line(pos, ["opinionId", "text", "authorName", "len"])
     
 
-    def cancel_opinion_annotation(self, opinionId) :
-        self.data.loc[self.data["opinionId"] == opinionId, "is_being_annotated"] = False
+    def next_shared_data(self, user: User) :
+        done = set(user.done_annotations)
+        opinionId = None
+        if user.can_be_second_annotator() :
+            opinionId = self.shared_state.claim_next(1, done, user.token)
+        if opinionId is None :
+            opinionId = self.shared_state.claim_next(0, done, user.token)
+        if opinionId is None :
+            raise OverflowError("No more opinions to annotate")
+        return self.get_line(self.positions[opinionId], ["opinionId", "text", "authorName", "len"])
+
+    def cancel_opinion_annotation(self, opinionId, holder = None) :
+        "returns the opinion to its pool, unless holder is given and another annotator holds it"
+        pos = self.positions.get(opinionId)
+        if pos is None :
+            return
+        if self.shared_state is not None :
+            return self.shared_state.release(opinionId, holder)
+        with self.lock :
+            if holder is not None and self.held_by_another(pos, holder) :
+                return
+            self.release(pos)
+            self.pools.add(pos, self.get_value(pos, "num_finished_annotations"))
+
+    def set_opinion_annotation(self, opinionId, holder = None) :
+        pos = self.positions.get(opinionId)
+        if pos is None :
+            return
+        if self.shared_state is not None :
+            return self.shared_state.claim(opinionId, holder)
+        with self.lock :
+            self.claim(pos, holder)
 
-    def set_opinion_annotation(self, opinionId) :
-        self.data.loc[self.data["opinionId"] == opinionId, "is_being_annotated"] = True
+    def add_finished_annotation(self, opinion, holder = None) :
+        """
+        Records the annotation of an opinion. When holder is given, returns False without recording anything
+        if the opinion went to another annotator or can no longer be annotated (see renew_lease).
+        """
+        pos = self.positions.get(opinion["opinion"]["opinionId"])
+        if pos is None :
+            return True
+        if self.shared_state is not None :
+            num_finished_annotations = self.shared_state.finish(opinion["opinion"]["opinionId"], opinion["llm"], holder)
+            if num_finished_annotations is None :
+                return False
+            annotation_stats.opinion_changed(num_finished_annotations - 1, num_finished_annotations)
+            return True
+        with self.lock :
+            if holder is not None and not self.can_be_finished_by(pos, holder) :
+                return False
+            num_finished_annotations = self.get_value(pos, "num_finished_annotations") + 1
+            self.release(pos)
+            self.set_value(pos, "num_finished_annotations", num_finished_annotations)
 
-    def add_finished_annotation(self, opinion) :
-        self.data.loc[self.data["opinionId"] == opinion["opinion"]["opinionId"], "is_being_annotated"] = False
-        self.data.loc[self.data["opinionId"] == opinion["opinion"]["opinionId"], "num_finished_annotations"] += 1
+            if self.get_value(pos, "llm_1") == "" :
+                self.set_value(pos, "llm_1", opinion["llm"])
+            else : 
+                self.set_value(pos, "llm_2", opinion["llm"])
 
-        if self.data[self.data["opinionId"] == opinion["opinion"]["opinionId"]].iloc[0]["llm_1"] == "" :
-            self.data.loc[self.data["opinionId"] == opinion["opinion"]["opinionId"], "llm_1"] = opinion["llm"]
-        else : 
-            self.data.loc[self.data["opinionId"] == opinion["opinion"]["opinionId"], "llm_2"] = opinion["llm"]
+            self.pools.discard(pos)
+            self.pools.add(pos, num_finished_annotations)
+        annotation_stats.opinion_changed(num_finished_annotations - 1, num_finished_annotations)
+        return True
 
     def add_reported_annotation(self, opinion) :
-        self.data.loc[self.data["opinionId"] == opinion["opinion"]["opinionId"], "is_being_annotated"] = False
-        self.data.loc[self.data["opinionId"] == opinion["opinion"]["opinionId"], "num_finished_annotations"] = -1
+        pos = self.positions.get(opinion["opinion"]["opinionId"])
+        if pos is None :
+            return
+        if self.shared_state is not None :
+            previous = self.shared_state.report(opinion["opinion"]["opinionId"])
+            annotation_stats.opinion_changed(previous, -1)
+            return
+        with self.lock :
+            previous = self.get_value(pos, "num_finished_annotations")
+            self.release(pos)
+            self.set_value(pos, "num_finished_annotations", -1)
+            self.pools.discard(pos)
+        annotation_stats.opinion_changed(previous, -1)
 
 
-    def get_data_from_id(self, opinionId) :
-        print("problem opinion:", opinionId)
-        print(self.data[self.data["opinionId"] == opinionId])
-        line = self.data[self.data["opinionId"] == opinionId].iloc[0][["opinionId", "text", "authorName", "len"]]
-        line = line.to_dict()
-        self.data.loc[self.data["opinionId"] == line["opinionId"], "is_being_annotated"] = True
+    def get_data_from_id(self, opinionId, holder = None) :
+        "the opinion, reserved for holder whoever held it before"
+        logger.debug("opinion requested", extra={"opinionId": opinionId, "token": holder})
+        pos = self.positions[opinionId]
+        line = self.get_line(pos, ["opinionId", "text", "authorName", "len"])
+        if self.shared_state is not None :
+            self.shared_state.claim(opinionId, holder)
+            return line
+        with self.lock :
+            self.claim(pos, holder)
         return line
+
+    def resume_data(self, opinionId, holder) :
+        "the opinion holder was working on with its lease renewed, or None when it went to another annotator meanwhile"
+        if not self.renew_lease(opinionId, holder) :
+            return None
+        return self.get_line(self.positions[opinionId], ["opinionId", "text", "authorName", "len"])
     
     def get_data_info_from_id(self, opinionId) :
         # does not set is being annotated to true anymore
-        print("problem opinion:", opinionId)
-        print(self.data[self.data["opinionId"] == opinionId])
-        line = self.data[self.data["opinionId"] == opinionId].iloc[0][["opinionId", "text", "authorName", "len", "date"]]
-        line = line.to_dict()
+        logger.debug("opinion info requested", extra={"opinionId": opinionId})
+        pos = self.positions[opinionId]
+        line = self.get_line(pos, ["opinionId", "text", "authorName", "len", "date"])
         return line
     
     def get_used_llm(self, opinionId) :
-        line = self.data[self.data["opinionId"] == opinionId].iloc[0]
+        pos = self.positions[opinionId]
+        if self.shared_state is not None :
+            return self.shared_state.used_llms(opinionId)
         used_llms = []
-        if line["llm_1"] :
-            used_llms.append(line["llm_1"])
-        if line["llm_2"] :
-            used_llms.append(line["llm_2"])
+        if self.get_value(pos, "llm_1") :
+            used_llms.append(self.get_value(pos, "llm_1"))
+        if self.get_value(pos, "llm_2") :
+            used_llms.append(self.get_value(pos, "llm_2"))
         return used_llms
 
 
@@ -148,55 +453,164 @@ class GDNData :
 
 
 
-def collect_all_annotations():
-    with open(ALL_ANNOTATIONS_OUTPUT_FILE, "w") as out_f:
-        # iterate through each annotator directory
-        for annotator in os.listdir(ANNOTATORS_DIR):
-            if os.path.isdir(ANNOTATORS_DIR / annotator) :
-                annotator_dir = os.path.join(ANNOTATORS_DIR, annotator)
-                annotations_file = os.path.join(annotator_dir, "annotations.jsonl")
-
-                if not os.path.isfile(annotations_file):
-                    continue  # skip if the file doesn’t exist
-
-                lock = FileLock(annotations_file + ".lock")
-                with lock:
-                    with open(annotations_file, "r") as f:
-                        for line in f:
-                            line = line.strip()
-                            if not line:
-                                continue
-                            try:
-                                data = json.loads(line)
-                                data["annotator"] = annotator  # add annotator ID
-                                out_f.write(json.dumps(data) + "\n")
-                            except json.JSONDecodeError:
-                                print(f"Skipping invalid JSON in {annotations_file}")
-
-
-    with open(ALL_REPORTS_OUTPUT_FILE, "w") as out_f:
-        # iterate through each annotator directory
-        for annotator in os.listdir(ANNOTATORS_DIR):
-            if os.path.isdir(ANNOTATORS_DIR / annotator) :
-                annotator_dir = os.path.join(ANNOTATORS_DIR, annotator)
-                reports_file = os.path.join(annotator_dir, "reports.jsonl")
-
-                if not os.path.isfile(reports_file):
-                    continue  # skip if the file doesn’t exist
-
-                lock = FileLock(reports_file + ".lock")
-                with lock:
-                    with open(reports_file, "r") as f:
-                        for line in f:
-                            line = line.strip()
-                            if not line:
-                                continue
-                            try:
-                                data = json.loads(line)
-                                data["annotator"] = annotator  # add annotator ID
-                                out_f.write(json.dumps(data) + "\n")
-                            except json.JSONDecodeError:
-                                print(f"Skipping invalid JSON in {reports_file}")
+class LazyOpinionTexts :
+    """
+    Memory-mapped DATA_FILE with the byte offset of every line,
+    so that the full record of an opinion (text, date...) is only decoded when needed.
+    """
+    def __init__(self, path, starts = None, ends = None) :
+        self.file = open(path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if starts is not None :
+            # line offsets kept in a snapshot
+            self.starts = starts
+            self.ends = ends
+            return
+        starts = []
+        ends = []
+        start = 0
+        size = len(self.mmap)
+        while start < size :
+            end = self.mmap.find(b"\n", start)
+            if end == -1 :
+                end = size
+            if self.mmap[start:end].strip() :
+                starts.append(start)
+                ends.append(end)
+            start = end + 1
+        self.starts = np.array(starts, dtype = np.int64)
+        self.ends = np.array(ends, dtype = np.int64)
+
+    def __len__(self) :
+        return len(self.starts)
+
+    def record(self, pos) :
+        return json.loads(self.mmap[self.starts[pos]:self.ends[pos]])
+
+
+def read_compact_opinions(path) :
+    """
+    Dataframe of the columns needed for assignment only, with compact types
+    (int32 ids and lengths, categorical authorName), and the LazyOpinionTexts of path.
+    """
+    texts = LazyOpinionTexts(path)
+    opinion_ids = np.empty(len(texts), dtype = np.int32)
+    lengths = np.empty(len(texts), dtype = np.int32)
+    author_names = []
+    for pos in range(len(texts)) :
+        record = texts.record(pos)
+        opinion_ids[pos] = record["opinionId"]
+        lengths[pos] = record["len"]
+        author_names.append(record["authorName"])
+
+    data = pd.DataFrame({
+        "opinionId": opinion_ids,
+        "authorName": pd.Categorical(author_names),
+        "len": lengths,
+    })
+    return data, texts
+
+
+def read_logged_ids(path, offset = 0, digest = None, on_record = None) :
+    """
+    opinionIds of the complete lines of an aggregated annotations or reports file after byte offset,
+    with the offset after the last complete line and the digest of the file up to it.
+    Every parsed line is also passed to on_record, if given.
+    Returns None if the first offset bytes of the file do not have the given digest.
+    """
+    try :
+        with open(path, "rb") as f:
+            content = f.read()
+    except FileNotFoundError :
+        logger.warning("file not found", extra={"path": str(path)})
+        content = b""
+
+    if len(content) < offset or (offset and bytes_digest(content[:offset]) != digest) :
+        return None
+    end = max(offset, content.rfind(b"\n") + 1)
+
+    opinion_ids = []
+    for line in content[offset:end].splitlines() :
+        if not line.strip() :
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            logger.warning("skipping invalid JSON line", extra={"path": str(path)})
+            continue
+        opinion_ids.append(record["opinion"]["opinionId"])
+        if on_record is not None :
+            on_record(record)
+    return opinion_ids, end, bytes_digest(content[:end])
+
+
+def counter(stats, kind) :
+    "adds the /stats counters of a logged line of this kind to stats"
+    return lambda record : add_items(stats, logged_items(kind, record))
+
+
+def count_logged_annotations(opinion_ids, annotations_file = ALL_ANNOTATIONS_OUTPUT_FILE, reports_file = ALL_REPORTS_OUTPUT_FILE, replayed = None) :
+    """
+    Number of aggregated annotations and reported flag of every opinion of opinion_ids,
+    and the /stats counters of the logged annotations and reports (see stats.logged_items).
+    replayed is a previous result for the same opinions: only the lines added to the logs
+    since then are read, unless the logs were rewritten in the meantime.
+    Returns {"counts", "reported", "stats", "logs": {kind: (offset, digest)}}.
+    """
+    files = {"annotations": annotations_file, "reports": reports_file}
+    tails = None
+    if replayed is not None :
+        stats = dict(replayed["stats"])
+        tails = {kind: read_logged_ids(path, *replayed["logs"][kind], on_record = counter(stats, kind)) for kind, path in files.items()}
+        if any(tail is None for tail in tails.values()) :
+            logger.info("aggregated logs were rewritten, replaying them from the start")
+            tails = None
+
+    if tails is None :
+        stats = {}
+        tails = {kind: read_logged_ids(path, on_record = counter(stats, kind)) for kind, path in files.items()}
+        counts = np.zeros(len(opinion_ids), dtype = np.int64)
+        reported = np.zeros(len(opinion_ids), dtype = bool)
+    else :
+        counts = replayed["counts"].copy()
+        reported = replayed["reported"].copy()
+
+    annotated_ids = tails["annotations"][0]
+    reported_ids = tails["reports"][0]
+    if annotated_ids :
+        new_counts = pd.Series(annotated_ids, dtype = "int64").value_counts()
+        counts += opinion_ids.map(new_counts).fillna(0).to_numpy(dtype = np.int64)
+    if reported_ids :
+        reported |= opinion_ids.isin(reported_ids).to_numpy()
+
+    return {
+        "counts": counts,
+        "reported": reported,
+        "stats": stats,
+        "logs": {kind: tail[1:] for kind, tail in tails.items()},
+    }
+
+
+def replay_logs(data, annotations_file = ALL_ANNOTATIONS_OUTPUT_FILE, reports_file = ALL_REPORTS_OUTPUT_FILE, replayed = None) :
+    """
+    Sets num_finished_annotations, llm_1 and llm_2 from the aggregated annotations
+    and marks reported opinions with num_finished_annotations = -1, in one vectorized pass.
+    The model used by past annotations is not known here, so llm_1/llm_2 are only set to "a".
+    Returns the result of count_logged_annotations, to replay only new lines next time.
+    """
+    logger.info("reading existing annotations and reports")
+    replayed = count_logged_annotations(data["opinionId"], annotations_file, reports_file, replayed)
+    counts = replayed["counts"]
+
+    data["num_finished_annotations"] = np.where(replayed["reported"], -1, counts)
+    data.loc[counts >= 1, "llm_1"] = "a"
+    data.loc[counts >= 2, "llm_2"] = "a"
+    return replayed
+
+
+def collect_all_annotations(incremental = True):
+    "updates ALL_ANNOTATIONS_OUTPUT_FILE and ALL_REPORTS_OUTPUT_FILE from the storage backend"
+    storage.collect(incremental)
 
 
 
@@ -1,9 +1,42 @@
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Optional
 import os
+import json
+import time
+import random
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from llmCache import LLMCache
+from rateLimiter import RateLimiter
+from asyncHttp import AsyncHTTPClient, AsyncHTTPResponse
+from metrics import registry
+
+logger = logging.getLogger(__name__)
 
 GROQ_API_KEY = os.environ["GROQ_API_KEY"]
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+GROQ_API_URL = os.environ.get("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+OPENAI_API_URL = os.environ.get("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
+
+# HTTP client settings, timeouts and backoff are in seconds
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 5))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", 30))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 2))
+LLM_BACKOFF = float(os.environ.get("LLM_BACKOFF", 0.5))
+LLM_MAX_BACKOFF = float(os.environ.get("LLM_MAX_BACKOFF", 8))
+LLM_CONNECTIONS_PER_HOST = int(os.environ.get("LLM_CONNECTIONS_PER_HOST", 16))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# threads running the calls of hedged queries, two per query at most
+LLM_HEDGE_WORKERS = int(os.environ.get("LLM_HEDGE_WORKERS", 32))
+# requests and tokens per minute allowed per provider ("groq", "openai") and per model, as JSON:
+# {"groq": {"rpm": 30, "tpm": 6000}, "llama-3.1-8b-instant": {"rpm": 30}}. Calls over the limits
+# wait, at most LLM_QUEUE_SIZE of them and each for at most LLM_QUEUE_TIMEOUT seconds.
+# The limits are for the whole server: with app.py --workers the processes share the buckets.
+LLM_RATE_LIMITS = json.loads(os.environ.get("LLM_RATE_LIMITS", "{}"))
+LLM_QUEUE_SIZE = int(os.environ.get("LLM_QUEUE_SIZE", 256))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 60))
 INSTRUCTION = "Tu es un portail de clarification d'argument. L'utilisateur va te donner une opinion écrite sur un thème donné, \
 ainsi que la segmentation d'un des arguments de cette opinion en trois types de segments: affirmation(s), argument(s) et solution(s).\n \
 Extrait, en une phrase, l'argument clair et auto-suffisant sous-jacent à cette segmentation. priorise la solution, et inclus les arguments \
@@ -11,22 +44,136 @@ et affirmations seulement si ils te semblent pertinents. Tu peux utiliser le con
 aucune information qui n'est pas présente dans les segments. Ne répond qu'avec l'argument clair et auto-suffisant, et rien d'autre. \
 Si l'argument est déjà clair et bien écrit, tu peux renvoyer directement cet argument."
 
+llm_request_seconds = registry.histogram("llm_request_seconds", "Duration of the provider calls of GroqLLM.query, retries included.", ["model"])
+hedged_requests_total = registry.counter("llm_hedged_requests_total", "Duplicate requests sent because the first one was slower than the hedge deadline.", ["model"])
+llm_requests_total = registry.counter("llm_requests_total", "Provider calls of GroqLLM.query by outcome (ok, http_error, timeout, rate_limited, cancelled, error).", ["model", "outcome"])
+
+
+hedge_executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_WORKERS)
+
+
+def make_session(connections_per_host: int = LLM_CONNECTIONS_PER_HOST) -> requests.Session:
+    """Keep-alive session; blocks instead of opening more than connections_per_host connections to a host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=connections_per_host, pool_block=True, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# shared by every GroqLLM, so that models served by the same provider reuse connections
+default_session = make_session()
+# same for the asyncio calls of the --async server
+default_async_client = AsyncHTTPClient(LLM_CONNECTIONS_PER_HOST)
+# shared by every GroqLLM, so that provider limits count the calls of all its models
+default_rate_limiter = RateLimiter(LLM_RATE_LIMITS, LLM_QUEUE_SIZE, LLM_QUEUE_TIMEOUT).register_metrics()
+
+
+class RateLimitedError(Exception):
+    "the rate limiter gave up on a call, because its queue was full or the call waited too long"
+
+
+def estimate_tokens(data: dict) -> int:
+    "rough count of the tokens of a chat completion: about 4 characters per prompt token, plus the answer"
+    characters = sum(len(message["content"]) for message in data["messages"])
+    return characters // 4 + data.get("max_tokens", 0)
+
+
+def backoff_delay(attempt: int, response: Optional[requests.Response] = None) -> float:
+    "full-jitter exponential backoff, honoring a Retry-After header in seconds"
+    delay = random.uniform(0, min(LLM_MAX_BACKOFF, LLM_BACKOFF * 2 ** attempt))
+    if response is not None:
+        try:
+            delay = max(delay, min(LLM_MAX_BACKOFF, float(response.headers.get("Retry-After", 0))))
+        except ValueError:
+            pass
+    return delay
+
+
 class GroqLLM:
-    def __init__(self, model: str = "mixtral-8x7b-32768"):
+    def __init__(self, model: str = "mixtral-8x7b-32768", session: Optional[requests.Session] = None,
+                 cache: Optional[LLMCache] = None, router=None, rate_limiter: Optional[RateLimiter] = None):
         self.model = model
 
         if "gpt" in model:
+            self.provider = "openai"
             self.api_key = OPENAI_API_KEY
-            self.api_url = "https://api.openai.com/v1/chat/completions"
+            self.api_url = OPENAI_API_URL
         else:
+            self.provider = "groq"
             self.api_key = GROQ_API_KEY
-            self.api_url = "https://api.groq.com/openai/v1/chat/completions"
+            self.api_url = GROQ_API_URL
 
         self.instruction = INSTRUCTION
+        self.session = session if session is not None else default_session
+        self.timeout = (LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT)
+        self.max_retries = LLM_MAX_RETRIES
+        # only set for models whose answers may be reused
+        self.cache = cache
+        # ModelRouter told about every call, and deciding when to hedge
+        self.router = router
+        self.rate_limiter = rate_limiter if rate_limiter is not None else default_rate_limiter
+
+    def post(self, headers: dict, data: dict, priority: int = 0) -> requests.Response:
+        "POST with bounded retries on connection errors, 429 and 5xx, every attempt waiting for the rate limiter"
+        attempt = 0
+        tokens = estimate_tokens(data)
+        while True:
+            if not self.rate_limiter.acquire(self.provider, self.model, tokens, priority):
+                raise RateLimitedError(f"{self.model} call given up by the rate limiter")
+            try:
+                response = self.session.post(self.api_url, headers=headers, json=data, timeout=self.timeout)
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(backoff_delay(attempt))
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                logger.info("llm call retried", extra={"model": self.model, "status": response.status_code, "attempt": attempt})
+                time.sleep(backoff_delay(attempt, response))
+            attempt += 1
         
 
     
     def query(self, prompt: str, temperature: float = 0.3, max_tokens: int = 150) -> Optional[str]:
+        if self.cache is None:
+            return self.query_provider(prompt, temperature, max_tokens)
+
+        key = self.cache.key(self.model, self.instruction, prompt, temperature, max_tokens)
+        answer = self.cache.get(key)
+        if answer is None:
+            answer = self.query_provider(prompt, temperature, max_tokens)
+            if answer is not None:
+                self.cache.put(key, answer)
+        return answer
+
+    def query_provider(self, prompt: str, temperature: float, max_tokens: int) -> Optional[str]:
+        deadline = self.router.hedge_deadline(self.model) if self.router is not None else None
+        if deadline is None:
+            return self.query_once(prompt, temperature, max_tokens)
+        return self.query_hedged(prompt, temperature, max_tokens, deadline)
+
+    def query_hedged(self, prompt: str, temperature: float, max_tokens: int, deadline: float) -> Optional[str]:
+        "sends the same request again if the first one is not answered after deadline seconds, returns the first answer"
+        first = hedge_executor.submit(self.query_once, prompt, temperature, max_tokens)
+        try:
+            return first.result(timeout=deadline)
+        except FuturesTimeoutError:
+            pass
+
+        hedged_requests_total.inc(model=self.model)
+        # behind first requests when calls are rate limited
+        second = hedge_executor.submit(self.query_once, prompt, temperature, max_tokens, 1)
+        answer = None
+        for future in as_completed([first, second]):
+            answer = future.result()
+            if answer is not None:
+                # the other request is left to finish in the background
+                break
+        return answer
+
+    def request_payload(self, prompt: str, temperature: float, max_tokens: int) -> tuple[dict, dict]:
+        "headers and JSON body of a chat completion request"
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -43,22 +190,148 @@ class GroqLLM:
         if (("qwen" in self.model)) :
             data["reasoning_format"] = "hidden"
             data["reasoning_effort"] = "none"
+        return headers, data
+
+    def record_call(self, seconds: float, outcome: str):
+        llm_request_seconds.observe(seconds, model=self.model)
+        # calls given up by our own rate limiter or cancelled by the caller say nothing about the model
+        if self.router is not None and outcome not in ("rate_limited", "cancelled"):
+            self.router.record(self.model, seconds, outcome == "ok")
+        llm_requests_total.inc(model=self.model, outcome=outcome)
+
+    def query_once(self, prompt: str, temperature: float, max_tokens: int, priority: int = 0) -> Optional[str]:
+        headers, data = self.request_payload(prompt, temperature, max_tokens)
 
+        started = time.perf_counter()
+        outcome = "ok"
         try:
-            response = requests.post(self.api_url, headers=headers, json=data)
+            response = self.post(headers, data, priority)
             response.raise_for_status()
             result = response.json()
-            print("got results by", self.model)
-            print(result["choices"][0]["message"])
-            return result["choices"][0]["message"]["content"]
+            answer = result["choices"][0]["message"]["content"]
+            logger.debug("llm answer", extra={"model": self.model, "answer": answer})
+            return answer
         except requests.exceptions.HTTPError as http_err:
+            outcome = "http_error"
             try:
                 error_detail = response.json()
-                print(f"Groq API error: {error_detail}")
             except Exception:
-                print(f"HTTP error: {http_err}")
+                error_detail = str(http_err)
+            logger.warning("llm http error", extra={"model": self.model, "status": response.status_code, "error": error_detail})
+            return None
+        except RateLimitedError as e:
+            outcome = "rate_limited"
+            logger.warning(str(e), extra={"model": self.model})
+            return None
+        except requests.exceptions.Timeout:
+            outcome = "timeout"
+            logger.warning("llm timeout", extra={"model": self.model, "timeout": self.timeout})
             return None
         except Exception as e:
-            print(f"Error querying Groq LLM: {e}")
-            return None 
-    
+            outcome = "error"
+            logger.warning("llm call failed", extra={"model": self.model, "error": str(e)})
+            return None
+        finally:
+            self.record_call(time.perf_counter() - started, outcome)
+
+    # asyncio counterparts of query, used by the --async server: they await the provider
+    # on the event loop instead of holding a thread, with the same cache, retries, hedging and metrics
+
+    async def aquery(self, prompt: str, temperature: float = 0.3, max_tokens: int = 150) -> Optional[str]:
+        if self.cache is None:
+            return await self.aquery_provider(prompt, temperature, max_tokens)
+
+        key = self.cache.key(self.model, self.instruction, prompt, temperature, max_tokens)
+        # the cache may wait for its SQLite file, which must not stall the event loop
+        answer = await asyncio.to_thread(self.cache.get, key)
+        if answer is None:
+            answer = await self.aquery_provider(prompt, temperature, max_tokens)
+            if answer is not None:
+                await asyncio.to_thread(self.cache.put, key, answer)
+        return answer
+
+    async def aquery_provider(self, prompt: str, temperature: float, max_tokens: int) -> Optional[str]:
+        deadline = self.router.hedge_deadline(self.model) if self.router is not None else None
+        first = asyncio.ensure_future(self.aquery_once(prompt, temperature, max_tokens))
+        second = None
+        try:
+            if deadline is None:
+                return await first
+            done, _ = await asyncio.wait({first}, timeout=deadline)
+            if done:
+                return first.result()
+
+            hedged_requests_total.inc(model=self.model)
+            second = asyncio.ensure_future(self.aquery_once(prompt, temperature, max_tokens, 1))
+            answer = None
+            for future in asyncio.as_completed([first, second]):
+                answer = await future
+                if answer is not None:
+                    break
+            return answer
+        finally:
+            # the slower request, or both when the caller gave up at its deadline
+            for future in (first, second):
+                if future is not None and not future.done():
+                    future.cancel()
+
+    async def apost(self, headers: dict, data: dict, priority: int = 0) -> AsyncHTTPResponse:
+        "same as post"
+        attempt = 0
+        tokens = estimate_tokens(data)
+        while True:
+            if not await self.rate_limiter.aacquire(self.provider, self.model, tokens, priority):
+                raise RateLimitedError(f"{self.model} call given up by the rate limiter")
+            try:
+                response = await default_async_client.post_json(self.api_url, headers, data, LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT)
+            except TimeoutError:
+                # like a requests timeout, not retried
+                raise
+            except (OSError, asyncio.IncompleteReadError):
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                logger.info("llm call retried", extra={"model": self.model, "status": response.status_code, "attempt": attempt})
+                await asyncio.sleep(backoff_delay(attempt, response))
+            attempt += 1
+
+    async def aquery_once(self, prompt: str, temperature: float, max_tokens: int, priority: int = 0) -> Optional[str]:
+        headers, data = self.request_payload(prompt, temperature, max_tokens)
+
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            response = await self.apost(headers, data, priority)
+            if response.status_code >= 400:
+                outcome = "http_error"
+                try:
+                    error_detail = response.json()
+                except Exception:
+                    error_detail = None
+                logger.warning("llm http error", extra={"model": self.model, "status": response.status_code, "error": error_detail})
+                return None
+            result = response.json()
+            answer = result["choices"][0]["message"]["content"]
+            logger.debug("llm answer", extra={"model": self.model, "answer": answer})
+            return answer
+        except RateLimitedError as e:
+            outcome = "rate_limited"
+            logger.warning(str(e), extra={"model": self.model})
+            return None
+        except asyncio.CancelledError:
+            # deadline of the request reached, or the other request of a hedged query answered first
+            outcome = "cancelled"
+            raise
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.warning("llm timeout", extra={"model": self.model, "timeout": self.timeout})
+            return None
+        except Exception as e:
+            outcome = "error"
+            logger.warning("llm call failed", extra={"model": self.model, "error": str(e)})
+            return None
+        finally:
+            self.record_call(time.perf_counter() - started, outcome)
@@ -0,0 +1,194 @@
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import threading
+import traceback
+from logging.handlers import QueueHandler, RotatingFileHandler
+from datetime import datetime, timezone
+from metrics import registry
+from const import LOG_DIR, LOG_LEVEL, LOG_QUEUE_SIZE, LOG_MAX_BYTES, LOG_BACKUPS
+
+# records handed to the handlers at once, they are flushed once per batch
+LOG_BATCH_SIZE = 512
+# attributes of every LogRecord, the other ones come from extra={...} and are logged as fields
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+dropped_records_total = registry.counter("log_records_dropped_total", "Log records dropped because the log queue was full.")
+
+
+def record_fields(record) :
+    return {key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES}
+
+
+class JsonFormatter(logging.Formatter) :
+    "one JSON object per line: time, level, logger, message, the extra fields and the traceback if any"
+    def format(self, record) :
+        line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **record_fields(record),
+        }
+        if record.exc_text :
+            line["exception"] = record.exc_text
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter) :
+    "readable line with the fields as key=value"
+    def format(self, record) :
+        line = super().format(record)
+        fields = " ".join(f"{key}={value}" for key, value in record_fields(record).items())
+        return f"{line} {fields}" if fields else line
+
+
+class BatchFlush :
+    "handler mixin: emit only writes, the writer thread calls flush_batch once per batch"
+    def flush(self) :
+        pass
+
+    def flush_batch(self) :
+        super().flush()
+
+
+class BatchStreamHandler(BatchFlush, logging.StreamHandler) :
+    pass
+
+
+class BatchRotatingFileHandler(BatchFlush, RotatingFileHandler) :
+    "with app.py --workers, every process writes to the same file, the first one past max_bytes rotates it"
+    def shouldRollover(self, record) :
+        if self.stream is not None :
+            try :
+                moved = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+            except FileNotFoundError :
+                moved = True
+            if moved :
+                # another server process rotated the file
+                self.stream.close()
+                self.stream = self._open()
+        return super().shouldRollover(record)
+
+
+class DroppingQueueHandler(QueueHandler) :
+    "a record is dropped when the queue is full, errors wait up to a second for room"
+    def enqueue(self, record) :
+        try :
+            if record.levelno >= logging.ERROR :
+                self.queue.put(record, timeout=1)
+            else :
+                self.queue.put_nowait(record)
+        except queue.Full :
+            dropped_records_total.inc()
+
+    def prepare(self, record) :
+        # only the message and the traceback are rendered here, the JSON is written by the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info :
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+
+class LogPipeline :
+    """
+    Logging off the request path: loggers only put records in a bounded queue,
+    a background thread writes them to the handlers in batches.
+    """
+    STOP = object()
+
+    def __init__(self, handlers, queue_size) :
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+        # held while a batch is written, so that a fork never copies half written buffers
+        self.writing = threading.Lock()
+        self.start()
+        # the writer thread does not survive a fork (app.py --workers)
+        os.register_at_fork(before=self.writing.acquire, after_in_parent=self.writing.release, after_in_child=self.restart)
+        atexit.register(self.stop)
+
+    def start(self) :
+        self.thread = threading.Thread(target=self.run, args=(self.queue_handler.queue,), daemon=True, name="log-writer")
+        self.thread.start()
+
+    def restart(self) :
+        self.writing = threading.Lock()
+        self.queue_handler.queue = queue.Queue(self.queue_size)
+        self.start()
+
+    def stop(self) :
+        "writes the queued records, called at exit"
+        try :
+            self.queue_handler.queue.put(self.STOP, timeout=5)
+        except queue.Full :
+            return
+        self.thread.join(timeout=5)
+
+    def run(self, records) :
+        while True :
+            batch = [records.get()]
+            while len(batch) < LOG_BATCH_SIZE :
+                try :
+                    batch.append(records.get_nowait())
+                except queue.Empty :
+                    break
+            with self.writing :
+                for record in batch :
+                    if record is self.STOP :
+                        continue
+                    for handler in self.handlers :
+                        if record.levelno >= handler.level :
+                            handler.handle(record)
+                for handler in self.handlers :
+                    handler.flush_batch()
+            if any(record is self.STOP for record in batch) :
+                return
+
+    def depth(self) :
+        return {(): self.queue_handler.queue.qsize()}
+
+
+def setup_logging(log_dir = LOG_DIR, level = LOG_LEVEL) :
+    """
+    Sends every log record to a LogPipeline writing to the console (INFO and above),
+    log_dir/info.jsonl (every record passing the level) and log_dir/error.jsonl (ERROR and above).
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    console = BatchStreamHandler(sys.stderr)
+    console.setLevel(logging.INFO)
+    console.setFormatter(ConsoleFormatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s"))
+    handlers = [console]
+    for name, handler_level in [("info.jsonl", logging.NOTSET), ("error.jsonl", logging.ERROR)] :
+        handler = BatchRotatingFileHandler(os.path.join(log_dir, name), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+        handler.setLevel(handler_level)
+        handler.setFormatter(JsonFormatter())
+        handlers.append(handler)
+
+    pipeline = LogPipeline(handlers, LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    for handler in list(root.handlers) :
+        root.removeHandler(handler)
+    root.addHandler(pipeline.queue_handler)
+    set_log_level(level)
+    registry.gauge("log_queue_depth", "Log records waiting for the writer thread.", pipeline.depth)
+    return pipeline
+
+
+def set_log_level(level) :
+    "level name (DEBUG, INFO, ...) of every logger, raises ValueError for an unknown one"
+    level = str(level).upper()
+    if not isinstance(logging.getLevelName(level), int) :
+        raise ValueError(f"unknown log level {level}")
+    logging.getLogger().setLevel(level)
+
+
+def get_log_level() :
+    return logging.getLevelName(logging.getLogger().getEffectiveLevel())
@@ -0,0 +1,140 @@
+import sqlite3
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from metrics import registry
+from sqliteDb import SQLiteDatabase
+from const import LLM_CACHE_FILE, LLM_CACHE_MEMORY_ENTRIES, LLM_CACHE_MAX_DISK_BYTES
+
+logger = logging.getLogger(__name__)
+
+# seconds a lookup or a write waits for the cache file locked by another process,
+# it is then a miss or skipped rather than a slower annotation request
+LLM_CACHE_BUSY_TIMEOUT = 1
+
+cache_lookups_total = registry.counter("llm_cache_lookups_total", "Lookups of the LLM answer cache by result (memory_hit, disk_hit, miss).", ["result"])
+
+
+class LLMCache(SQLiteDatabase):
+    """
+    Cache of LLM answers: an in-memory LRU tier in front of a SQLite file that survives restarts.
+    The disk tier is kept under max_disk_bytes by dropping the least recently used answers,
+    the file being shared by the server processes of app.py --workers.
+    """
+    def __init__(self, path=LLM_CACHE_FILE, max_memory_entries: int = LLM_CACHE_MEMORY_ENTRIES,
+                 max_disk_bytes: int = LLM_CACHE_MAX_DISK_BYTES):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        super().__init__(path, timeout=LLM_CACHE_BUSY_TIMEOUT)
+        with self.transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+            # size of the answers in the file when last written by this process, for the stats
+            self.disk_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+
+    @staticmethod
+    def key(model: str, instruction: str, prompt: str, temperature: float, max_tokens: int) -> str:
+        content = json.dumps([model, instruction, prompt, temperature, max_tokens], ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.hits_memory += 1
+                cache_lookups_total.inc(result="memory_hit")
+                return value
+
+        # the file is read without the lock, each thread has its own connection
+        try:
+            row = self.connection().execute("SELECT value FROM answers WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError as e:
+            logger.warning("llm cache lookup failed, counted as a miss", extra={"error": str(e)})
+            row = None
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            cache_lookups_total.inc(result="miss")
+            return None
+
+        try:
+            with self.transaction() as db:
+                db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.OperationalError as e:
+            logger.warning("llm cache last use not updated", extra={"error": str(e)})
+        with self.lock:
+            self.hits_disk += 1
+            self.remember(key, row[0])
+        cache_lookups_total.inc(result="disk_hit")
+        return row[0]
+
+    def put(self, key: str, value: str):
+        size = len(key) + len(value.encode("utf-8"))
+        with self.lock:
+            self.remember(key, value)
+        try:
+            with self.transaction() as db:
+                db.execute("INSERT OR REPLACE INTO answers (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                           (key, value, size, time.time()))
+                evicted = self.evict_disk(db)
+        except sqlite3.OperationalError as e:
+            logger.warning("llm cache write skipped", extra={"error": str(e)})
+            return
+        with self.lock:
+            for evicted_key in evicted:
+                self.memory.pop(evicted_key, None)
+
+    def remember(self, key: str, value: str):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict_disk(self, db) -> list:
+        """
+        Deletes the least recently used answers until the file is under max_disk_bytes, returns their keys.
+        Must be called in a transaction: the size is summed there, as other processes write to the file too.
+        """
+        disk_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+        evicted = []
+        while disk_bytes > self.max_disk_bytes:
+            rows = db.execute("SELECT key, size FROM answers ORDER BY last_used LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if disk_bytes <= self.max_disk_bytes:
+                    break
+                db.execute("DELETE FROM answers WHERE key = ?", (key,))
+                evicted.append(key)
+                disk_bytes -= size
+        self.disk_bytes = disk_bytes
+        return evicted
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_bytes": self.disk_bytes,
+            }
+
+    def register_metrics(self):
+        registry.gauge("llm_cache_memory_entries", "Answers held in the in-memory tier of the LLM cache.", lambda: len(self.memory))
+        # the SQLite file is shared by the server processes
+        registry.gauge("llm_cache_disk_bytes", "Size of the answers kept in the LLM cache file.", lambda: self.disk_bytes, aggregate="max")
+        return self
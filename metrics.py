@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import bisect
+import logging
+import resource
+import threading
+from sqliteDb import SQLiteDatabase
+from const import METRICS_PUBLISH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values, extra = "") :
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra :
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value) :
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value) :
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter :
+    def __init__(self, name, help, labelnames = ()) :
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount = 1, **labels) :
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock :
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) :
+        with self.lock :
+            return dict(self.values)
+
+    def merge(self, snapshots) :
+        "sum of the values of several processes"
+        merged = {}
+        for values in snapshots :
+            for key, value in values.items() :
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self, values = None) :
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        if values is None :
+            values = self.snapshot()
+        for key, value in values.items() :
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram :
+    def __init__(self, name, help, labelnames = (), buckets = LATENCY_BUCKETS) :
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels) :
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock :
+            counts = self.values.get(key)
+            if counts is None :
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def snapshot(self) :
+        with self.lock :
+            return {key: [list(counts[0]), counts[1]] for key, counts in self.values.items()}
+
+    def merge(self, snapshots) :
+        "bucket counts and sums added up over several processes"
+        merged = {}
+        for values in snapshots :
+            for key, (counts, total) in values.items() :
+                if key not in merged :
+                    merged[key] = [[0] * len(counts), 0.0]
+                merged[key][0] = [a + b for a, b in zip(merged[key][0], counts)]
+                merged[key][1] += total
+        return merged
+
+    def render(self, values = None) :
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        if values is None :
+            values = self.snapshot()
+        for key, (counts, total) in values.items() :
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts) :
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Gauge :
+    """
+    value read when the metrics are rendered: collect returns a number, or {label values: number}.
+    aggregate tells how the values of several server processes are combined: "sum", "max",
+    or "local" for a value that is the same in every process (read from the shared state).
+    """
+    def __init__(self, name, help, collect, labelnames = (), aggregate = "sum") :
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labelnames = tuple(labelnames)
+        self.aggregate = aggregate
+
+    def snapshot(self) :
+        values = self.collect()
+        if not isinstance(values, dict) :
+            values = {(): values}
+        return values
+
+    def merge(self, snapshots) :
+        merged = {}
+        for values in snapshots :
+            for key, value in values.items() :
+                if key not in merged :
+                    merged[key] = value
+                elif self.aggregate == "max" :
+                    merged[key] = max(merged[key], value)
+                else :
+                    merged[key] += value
+        return merged
+
+    def render(self, values = None) :
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if values is None :
+            values = self.snapshot()
+        for key, value in values.items() :
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}")
+        return lines
+
+
+class SQLiteMetricsStore(SQLiteDatabase) :
+    "latest metric values of every server process of app.py --workers, one JSON row per process"
+    @classmethod
+    def create(cls, path) :
+        store = cls(path)
+        with store.transaction() as db :
+            db.execute("DROP TABLE IF EXISTS metrics")
+            db.execute("CREATE TABLE metrics (pid INTEGER PRIMARY KEY, updated REAL NOT NULL, data TEXT NOT NULL)")
+        store.close()
+        return store
+
+    def publish(self, pid, snapshot) :
+        data = json.dumps({name: [[list(key), value] for key, value in values.items()] for name, values in snapshot.items()})
+        with self.transaction() as db :
+            db.execute("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?)", (pid, time.time(), data))
+
+    def read(self) :
+        "[(pid, seconds since the last publish, {metric name: {label values: value}})]"
+        now = time.time()
+        rows = []
+        for pid, updated, data in self.connection().execute("SELECT pid, updated, data FROM metrics") :
+            snapshot = {name: {tuple(key): value for key, value in values} for name, values in json.loads(data).items()}
+            rows.append((pid, now - updated, snapshot))
+        return rows
+
+
+class MetricsRegistry :
+    """
+    Metrics of this process in the Prometheus text format.
+    Updates only take a lock and increment a counter, so they can stay on in production.
+    With app.py --workers, every server process publishes its values to a shared store every
+    METRICS_PUBLISH_INTERVAL seconds, and /metrics adds up the values of all the processes,
+    so that a scrape gives the same counters whatever process answers it.
+    """
+    def __init__(self) :
+        self.metrics = {}
+        # SQLiteMetricsStore shared by the server processes, see use_shared_store
+        self.store = None
+
+    def register(self, metric) :
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames = ()) :
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames = (), buckets = LATENCY_BUCKETS) :
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, collect, labelnames = (), aggregate = "sum") :
+        return self.register(Gauge(name, help, collect, labelnames, aggregate))
+
+    def use_shared_store(self, store) :
+        "to be called before forking the server processes, which then call start_publishing"
+        self.store = store
+
+    def snapshot(self) :
+        "values of the metrics of this process that are added up with the other processes'"
+        snapshot = {}
+        for metric in list(self.metrics.values()) :
+            if getattr(metric, "aggregate", None) == "local" :
+                continue
+            try :
+                snapshot[metric.name] = metric.snapshot()
+            except Exception :
+                logger.exception("could not collect metric", extra={"metric": metric.name})
+        return snapshot
+
+    def publish(self) :
+        self.store.publish(os.getpid(), self.snapshot())
+
+    def start_publishing(self, interval = METRICS_PUBLISH_INTERVAL) :
+        def publish_forever() :
+            while True :
+                try :
+                    self.publish()
+                except Exception :
+                    logger.exception("could not publish metrics")
+                time.sleep(interval)
+        threading.Thread(target=publish_forever, daemon=True, name="metrics-publisher").start()
+
+    def merged_values(self) :
+        "metric name -> values added up over the processes, the gauges of processes gone silent are left out"
+        self.publish()
+        snapshots = {}
+        for pid, age, snapshot in self.store.read() :
+            for name, values in snapshot.items() :
+                metric = self.metrics.get(name)
+                if isinstance(metric, Gauge) and age > 5 * METRICS_PUBLISH_INTERVAL :
+                    continue
+                snapshots.setdefault(name, []).append(values)
+        return {name: self.metrics[name].merge(values) for name, values in snapshots.items() if name in self.metrics}
+
+    def render(self) :
+        merged = self.merged_values() if self.store is not None else {}
+        lines = []
+        for metric in list(self.metrics.values()) :
+            try :
+                lines.extend(metric.render(merged.get(metric.name)))
+            except Exception :
+                logger.exception("could not collect metric", extra={"metric": metric.name})
+        return "\n".join(lines) + "\n"
+
+
+def resident_memory_bytes() :
+    try :
+        with open("/proc/self/statm") as f :
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError) :
+        # no /proc: peak instead of current memory, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+registry = MetricsRegistry()
+registry.gauge("process_resident_memory_bytes", "Resident memory of the server processes.", resident_memory_bytes)
+registry.gauge("process_max_resident_memory_bytes", "Peak resident memory of the largest server process.",
+               lambda : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, aggregate="max")
@@ -0,0 +1,148 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+import numpy as np
+from metrics import registry
+from const import (LLM_ROUTER_WINDOW, LLM_BREAKER_FAILURES, LLM_BREAKER_ERROR_RATE, LLM_BREAKER_COOLDOWN,
+                   LLM_LATENCY_BIAS, LLM_HEDGE, LLM_HEDGE_QUANTILE, LLM_HEDGE_MIN_SAMPLES)
+
+logger = logging.getLogger(__name__)
+
+
+class ModelHealth :
+    """
+    Last calls of one model (duration, success) and its circuit breaker.
+    An open breaker keeps the model out of the choice for cooldown seconds,
+    then lets a single call through: its success closes the breaker, its failure opens it again.
+    """
+    def __init__(self, window, failures, error_rate, cooldown) :
+        self.calls = deque(maxlen=window)
+        self.failures = failures
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        # time.monotonic() at which the breaker opened, None when closed
+        self.opened_at = None
+        # time.monotonic() at which the single call of an open breaker was let through
+        self.probe_started = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds, ok) :
+        with self.lock :
+            self.calls.append((seconds, ok))
+            if ok :
+                self.consecutive_failures = 0
+                if self.opened_at is not None :
+                    # failures from before the breaker opened do not count anymore
+                    self.opened_at = None
+                    self.probe_started = None
+                    self.calls.clear()
+                    self.calls.append((seconds, ok))
+                    return "closed"
+                return None
+
+            self.consecutive_failures += 1
+            if self.opened_at is not None :
+                self.opened_at = time.monotonic()
+                self.probe_started = None
+                return None
+            num_errors = sum(1 for _, call_ok in self.calls if not call_ok)
+            if (self.consecutive_failures >= self.failures
+                    or (len(self.calls) >= self.failures and num_errors / len(self.calls) >= self.error_rate)) :
+                self.opened_at = time.monotonic()
+                return "opened"
+            return None
+
+    def available(self) :
+        with self.lock :
+            if self.opened_at is None :
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.cooldown :
+                return False
+            # a call let through but never made must not keep the model out forever
+            return self.probe_started is None or now - self.probe_started >= self.cooldown
+
+    def chosen(self) :
+        with self.lock :
+            if self.opened_at is not None :
+                self.probe_started = time.monotonic()
+
+    def is_open(self) :
+        return self.opened_at is not None
+
+    def latency(self, quantile, min_samples = 1) :
+        "quantile of the durations of the recent successful calls, None without enough of them"
+        with self.lock :
+            durations = [seconds for seconds, ok in self.calls if ok]
+        if len(durations) < max(1, min_samples) :
+            return None
+        return float(np.quantile(durations, quantile))
+
+    def stats(self) :
+        with self.lock :
+            calls = list(self.calls)
+        return {
+            "calls": len(calls),
+            "error_rate": sum(1 for _, ok in calls if not ok) / len(calls) if calls else 0.0,
+            "p50": self.latency(0.5),
+            "p95": self.latency(0.95),
+            "breaker_open": self.is_open(),
+        }
+
+
+class ModelRouter :
+    """
+    Picks the model of an annotation among the ones allowed for the opinion
+    (pick_llm still excludes the models already used), leaving out the models whose breaker is open.
+    The choice stays uniform unless latency_bias > 0, which weights every model by 1 / p50 ** latency_bias.
+    GroqLLM reports the outcome of every call with record, and asks hedge_deadline
+    when to send a duplicate request to the same model.
+    """
+    def __init__(self, models, window = LLM_ROUTER_WINDOW, failures = LLM_BREAKER_FAILURES,
+                 error_rate = LLM_BREAKER_ERROR_RATE, cooldown = LLM_BREAKER_COOLDOWN,
+                 latency_bias = LLM_LATENCY_BIAS, hedge = LLM_HEDGE) :
+        self.health = {model: ModelHealth(window, failures, error_rate, cooldown) for model in models}
+        self.latency_bias = latency_bias
+        self.hedge = hedge
+
+    def record(self, model, seconds, ok) :
+        change = self.health[model].record(seconds, ok)
+        if change is not None :
+            logger.warning("circuit breaker changed", extra={"model": model, "breaker": change})
+
+    def pick(self, candidates) :
+        available = [model for model in candidates if self.health[model].available()]
+        if not available :
+            # every allowed model is failing, the opinion still needs one
+            logger.warning("no healthy model, picking one anyway", extra={"models": list(candidates)})
+            available = list(candidates)
+
+        weights = None
+        if self.latency_bias > 0 :
+            latencies = [self.health[model].latency(0.5) for model in available]
+            known = [latency for latency in latencies if latency is not None]
+            # models without successful calls yet count as the median known one
+            default = float(np.median(known)) if known else 1.0
+            weights = [max(latency if latency is not None else default, 0.001) ** -self.latency_bias for latency in latencies]
+
+        model = random.choices(available, weights=weights)[0]
+        self.health[model].chosen()
+        return model
+
+    def hedge_deadline(self, model) :
+        "seconds after which a duplicate request is sent, None when hedging is off or latencies are unknown"
+        if not self.hedge :
+            return None
+        return self.health[model].latency(LLM_HEDGE_QUANTILE, LLM_HEDGE_MIN_SAMPLES)
+
+    def stats(self) :
+        return {model: health.stats() for model, health in self.health.items()}
+
+    def register_metrics(self) :
+        registry.gauge("llm_breaker_open", "1 when the circuit breaker of a model is open.",
+                       lambda : {(model,): int(health.is_open()) for model, health in self.health.items()}, ["model"],
+                       aggregate="max")
+        return self
@@ -0,0 +1,112 @@
+import os
+import json
+import logging
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+from datetime import datetime
+from const import PROFILES_DIR, PROFILES_KEPT
+
+logger = logging.getLogger(__name__)
+
+# orders accepted by top_functions, as pstats sort keys
+SORT_KEYS = {"cumulative": "cumulative", "tottime": "tottime", "ncalls": "ncalls"}
+# since python 3.12 cProfile goes through sys.monitoring, only one profiler can be enabled in the process
+profiler_lock = threading.Lock()
+
+
+def profile_requested(request) :
+    "an X-Profile header or a profile query parameter set to anything but 0"
+    flag = request.headers.get("X-Profile", request.args.get("profile"))
+    return flag is not None and flag not in ("", "0", "false")
+
+
+def start_profile() :
+    """
+    cProfile of the whole process while the request is served, so the work of the other threads is recorded too.
+    Returns None when another request is being profiled.
+    """
+    if not profiler_lock.acquire(blocking=False) :
+        return None
+    profiler = cProfile.Profile()
+    try :
+        profiler.enable()
+    except ValueError :
+        # another profiling tool is active (debugger, coverage...)
+        profiler_lock.release()
+        return None
+    return profiler
+
+
+def stop_profile(profiler) :
+    "disables profiler and lets another request be profiled"
+    profiler.disable()
+    profiler_lock.release()
+
+
+def save_profile(profiler, metadata) :
+    """
+    Stops profiler (see stop_profile) and writes its stats to PROFILES_DIR with a JSON file of metadata
+    (route, token, status...), returns the id of the profile.
+    """
+    stop_profile(profiler)
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    profile_id = f"{datetime.today().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    profiler.dump_stats(PROFILES_DIR / f"{profile_id}.prof")
+    with open(PROFILES_DIR / f"{profile_id}.json", "w") as f :
+        json.dump({"id": profile_id, "time": time.time(), **metadata}, f)
+    remove_old_profiles()
+    return profile_id
+
+
+def profile_ids() :
+    "ids of the saved profiles, most recent first"
+    try :
+        names = os.listdir(PROFILES_DIR)
+    except FileNotFoundError :
+        return []
+    return sorted((name[:-len(".json")] for name in names if name.endswith(".json")), reverse=True)
+
+
+def remove_old_profiles() :
+    for profile_id in profile_ids()[PROFILES_KEPT:] :
+        for extension in (".json", ".prof") :
+            try :
+                os.remove(PROFILES_DIR / f"{profile_id}{extension}")
+            except FileNotFoundError :
+                pass
+
+
+def top_functions(profile_id, top = 20, sort = "cumulative") :
+    "the top functions of a saved profile, ordered by sort"
+    stats = pstats.Stats(str(PROFILES_DIR / f"{profile_id}.prof"))
+    stats.sort_stats(SORT_KEYS[sort])
+    functions = []
+    for filename, line, name in stats.fcn_list[:top] :
+        primitive_calls, calls, own_time, cumulative_time, _ = stats.stats[(filename, line, name)]
+        functions.append({
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "tottime": own_time,
+            "cumtime": cumulative_time,
+        })
+    return functions
+
+
+def list_profiles(limit = 20, top = 10, sort = "cumulative") :
+    "metadata and top functions of the most recent profiles"
+    profiles = []
+    for profile_id in profile_ids()[:limit] :
+        try :
+            with open(PROFILES_DIR / f"{profile_id}.json", "r") as f :
+                profile = json.load(f)
+            profile["top_functions"] = top_functions(profile_id, top, sort)
+        except (OSError, ValueError) as e :
+            # removed meanwhile, or still being written
+            logger.warning("could not read profile", extra={"profile_id": profile_id, "error": str(e)})
+            continue
+        profiles.append(profile)
+    return profiles
@@ -0,0 +1,267 @@
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from metrics import registry
+from sqliteDb import SQLiteDatabase
+
+queue_wait_seconds = registry.histogram("llm_queue_wait_seconds", "Time LLM calls waited for the rate limiter.", ["provider"])
+queue_rejected_total = registry.counter("llm_queue_rejected_total", "LLM calls given up by the rate limiter (full queue or timeout).", ["provider", "reason"])
+
+
+class TokenBucket :
+    "refills continuously at per_minute units per minute, holding at most burst units (per_minute by default)"
+    def __init__(self, per_minute, burst = None) :
+        self.capacity = float(burst if burst else per_minute)
+        self.rate = per_minute / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now) :
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now) :
+        "seconds before amount can be taken, a call larger than the bucket only waits for a full bucket"
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount :
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount) :
+        self.tokens -= min(amount, self.capacity)
+
+
+def make_buckets(limits) :
+    "(scope, kind) -> TokenBucket of the limits given to RateLimiter, kind is rpm or tpm"
+    buckets = {}
+    for scope, limit in limits.items() :
+        for kind in ("rpm", "tpm") :
+            if limit.get(kind) :
+                buckets[(scope, kind)] = TokenBucket(limit[kind], limit.get(f"{kind}_burst"))
+    return buckets
+
+
+def take_all(buckets, needs, now) :
+    "takes every (key, amount) of needs if all the buckets can pay for it, else returns the seconds to wait"
+    delay = max(buckets[key].wait_time(amount, now) for key, amount in needs)
+    if delay <= 0 :
+        for key, amount in needs :
+            buckets[key].take(amount)
+    return delay
+
+
+class MemoryBuckets :
+    "token buckets of this process"
+    def __init__(self, limits) :
+        self.buckets = make_buckets(limits)
+
+    def take(self, needs) :
+        return take_all(self.buckets, needs, time.monotonic())
+
+
+class SQLiteBuckets(SQLiteDatabase) :
+    """
+    Same buckets kept in a table of a SQLite database, so that the server processes of app.py --workers
+    share the limits instead of each one sending the full rpm and tpm. Every take is one IMMEDIATE transaction.
+    """
+    def __init__(self, path, limits) :
+        super().__init__(path)
+        # only hold the state read from the table during a take, RateLimiter calls take with its condition held
+        self.buckets = make_buckets(limits)
+
+    @classmethod
+    def create(cls, path, limits) :
+        "(re)creates the table with full buckets"
+        store = cls(path, limits)
+        now = time.time()
+        with store.transaction() as db :
+            db.execute("DROP TABLE IF EXISTS rate_buckets")
+            db.execute("""CREATE TABLE rate_buckets (
+                scope TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (scope, kind)
+            )""")
+            db.executemany("INSERT INTO rate_buckets VALUES (?, ?, ?, ?)",
+                           [(scope, kind, bucket.capacity, now) for (scope, kind), bucket in store.buckets.items()])
+        store.close()
+        return store
+
+    def take(self, needs) :
+        # wall clock times, monotonic ones are not comparable between processes everywhere
+        now = time.time()
+        with self.transaction() as db :
+            for scope, kind, tokens, updated in db.execute("SELECT scope, kind, tokens, updated FROM rate_buckets") :
+                if (scope, kind) in self.buckets :
+                    bucket = self.buckets[(scope, kind)]
+                    bucket.tokens, bucket.updated = tokens, updated
+            delay = take_all(self.buckets, needs, now)
+            if delay <= 0 :
+                db.executemany("UPDATE rate_buckets SET tokens = ?, updated = ? WHERE scope = ? AND kind = ?",
+                               [(self.buckets[key].tokens, self.buckets[key].updated, *key) for key, _ in needs])
+        return delay
+
+
+class Waiter :
+    def __init__(self, priority, seq, needs, provider) :
+        self.priority = priority
+        self.seq = seq
+        # [((scope, kind), amount)]
+        self.needs = needs
+        self.provider = provider
+        self.granted = False
+        self.started = time.monotonic()
+        self.deadline = None
+
+    def __lt__(self, other) :
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class RateLimiter :
+    """
+    Token buckets in requests per minute ("rpm") and tokens per minute ("tpm"),
+    per provider ("groq", "openai") and per model: limits = {"groq": {"rpm": 30, "tpm": 6000}, "gpt-4.1": {"rpm": 500}}.
+    "rpm_burst" and "tpm_burst" bound how much of a minute's budget can be spent at once.
+    A call waits until every bucket it uses can pay for it. Waiting calls are served by priority
+    (lower first, then in arrival order), a call never overtakes a waiting call of higher priority
+    sharing one of its buckets. At most max_queue calls wait, each for at most timeout seconds.
+    The buckets are the process' own, or shared by several processes after use_shared_buckets:
+    the priorities then only order the calls waiting in the same process.
+    """
+    def __init__(self, limits, max_queue, timeout) :
+        self.buckets = MemoryBuckets(limits)
+        self.keys = set(self.buckets.buckets)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.waiters = []
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+
+    def use_shared_buckets(self, buckets) :
+        "takes from buckets from now on, e.g. SQLiteBuckets created with the same limits"
+        with self.condition :
+            self.buckets = buckets
+
+    def needs(self, provider, model, tokens) :
+        needs = []
+        for scope in (provider, model) :
+            if (scope, "rpm") in self.keys :
+                needs.append(((scope, "rpm"), 1))
+            if (scope, "tpm") in self.keys :
+                needs.append(((scope, "tpm"), tokens))
+        return needs
+
+    def acquire(self, provider, model, tokens, priority = 0) :
+        "waits for the buckets of provider and model, returns False if the call has to be given up"
+        needs = self.needs(provider, model, tokens)
+        if not needs :
+            return True
+
+        waiter = self.enqueue(needs, provider, priority)
+        if waiter is None :
+            return False
+        with self.condition :
+            while True :
+                delay = self.try_grant(waiter)
+                if delay is None :
+                    return waiter.granted
+                self.condition.wait(delay)
+
+    async def aacquire(self, provider, model, tokens, priority = 0) :
+        """
+        Same as acquire for the asyncio server: the call waits in the same queue, but with asyncio.sleep
+        instead of a blocked thread. Only taking from the buckets, a SQLite transaction when they are shared, runs in a thread.
+        """
+        needs = self.needs(provider, model, tokens)
+        if not needs :
+            return True
+
+        waiter = self.enqueue(needs, provider, priority)
+        if waiter is None :
+            return False
+        try :
+            while True :
+                delay = await asyncio.to_thread(self.try_grant, waiter)
+                if delay is None :
+                    return waiter.granted
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError :
+            with self.condition :
+                if not waiter.granted :
+                    self.withdraw(waiter)
+            raise
+
+    def enqueue(self, needs, provider, priority) :
+        "the waiter of a call, or None when the queue is full"
+        with self.condition :
+            if len(self.waiters) >= self.max_queue :
+                queue_rejected_total.inc(provider=provider, reason="full")
+                return None
+            waiter = Waiter(priority, next(self.seq), needs, provider)
+            waiter.deadline = waiter.started + self.timeout
+            heapq.heappush(self.waiters, waiter)
+            return waiter
+
+    def try_grant(self, waiter) :
+        """
+        Lets through the waiters that can go. Returns None once waiter was granted (waiter.granted)
+        or given up at its deadline, otherwise the seconds to wait before trying again.
+        """
+        with self.condition :
+            delay = self.grant()
+            if waiter.granted :
+                queue_wait_seconds.observe(time.monotonic() - waiter.started, provider=waiter.provider)
+                return None
+            remaining = waiter.deadline - time.monotonic()
+            if remaining <= 0 :
+                self.withdraw(waiter)
+                queue_rejected_total.inc(provider=waiter.provider, reason="timeout")
+                return None
+            return min(delay, remaining)
+
+    def withdraw(self, waiter) :
+        "to be called with the condition held"
+        self.waiters.remove(waiter)
+        heapq.heapify(self.waiters)
+        # the calls behind this one may go now
+        self.condition.notify_all()
+
+    def grant(self) :
+        "to be called with the condition held: lets through every waiter that can go, returns seconds until the next one can"
+        blocked = set()
+        next_delay = self.timeout
+        granted = []
+        for waiter in sorted(self.waiters) :
+            keys = {key for key, _ in waiter.needs}
+            if keys & blocked :
+                blocked |= keys
+                continue
+            delay = self.buckets.take(waiter.needs)
+            if delay > 0 :
+                blocked |= keys
+                next_delay = min(next_delay, delay)
+                continue
+            waiter.granted = True
+            granted.append(waiter)
+
+        if granted :
+            self.waiters = [waiter for waiter in self.waiters if not waiter.granted]
+            heapq.heapify(self.waiters)
+            self.condition.notify_all()
+        return next_delay
+
+    def depth(self) :
+        "waiting calls per provider"
+        with self.condition :
+            depth = {}
+            for waiter in self.waiters :
+                depth[(waiter.provider,)] = depth.get((waiter.provider,), 0) + 1
+        return depth
+
+    def register_metrics(self) :
+        registry.gauge("llm_queue_depth", "LLM calls waiting for the rate limiter.", self.depth, ["provider"])
+        return self
@@ -0,0 +1,149 @@
+import time
+from sqliteDb import SQLiteDatabase
+
+
+class SQLiteAssignmentState(SQLiteDatabase) :
+    """
+    Assignment state of the opinions (annotation counts, reservations, used models) kept in
+    a SQLite database in WAL mode, so that several server processes can share it.
+    Every claim is a conditional update inside an IMMEDIATE transaction, so an opinion
+    is never handed out twice. Reservations are leases stored as wall-clock expiry times
+    with the token of the annotator holding them.
+    """
+    def __init__(self, path, lease_ttl) :
+        super().__init__(path)
+        self.lease_ttl = lease_ttl
+        self.num_expired_leases = 0
+
+    @classmethod
+    def create(cls, path, data, lease_ttl) :
+        "(re)creates the database from the columns of a GDNData dataframe"
+        state = cls(path, lease_ttl)
+        with state.transaction() as db :
+            db.execute("DROP TABLE IF EXISTS opinions")
+            db.execute("""CREATE TABLE opinions (
+                pos INTEGER PRIMARY KEY,
+                opinionId INTEGER NOT NULL UNIQUE,
+                num_finished_annotations INTEGER NOT NULL,
+                reserved_until REAL,
+                holder TEXT,
+                llm_1 TEXT NOT NULL,
+                llm_2 TEXT NOT NULL
+            )""")
+            db.execute("CREATE INDEX opinions_available ON opinions (num_finished_annotations, pos)")
+            db.executemany(
+                "INSERT INTO opinions VALUES (?, ?, ?, NULL, NULL, ?, ?)",
+                zip(range(len(data)), data["opinionId"].tolist(), data["num_finished_annotations"].tolist(),
+                    data["llm_1"].tolist(), data["llm_2"].tolist())
+            )
+        state.close()
+        return state
+
+    def claim_next(self, num_finished_annotations, excluded, holder) :
+        "reserves for holder the first available opinion with this count whose id is not in excluded, returns its id or None"
+        now = time.time()
+        with self.transaction() as db :
+            rows = db.execute(
+                """SELECT opinionId FROM opinions
+                WHERE num_finished_annotations = ? AND (reserved_until IS NULL OR reserved_until <= ?)
+                ORDER BY pos LIMIT ?""",
+                (num_finished_annotations, now, len(excluded) + 1)
+            ).fetchall()
+            for (opinionId,) in rows :
+                if opinionId not in excluded :
+                    db.execute("UPDATE opinions SET reserved_until = ?, holder = ? WHERE opinionId = ?", (now + self.lease_ttl, holder, opinionId))
+                    return opinionId
+        return None
+
+    def claim(self, opinionId, holder) :
+        with self.transaction() as db :
+            db.execute("UPDATE opinions SET reserved_until = ?, holder = ? WHERE opinionId = ?", (time.time() + self.lease_ttl, holder, opinionId))
+
+    # same as GDNData.can_be_finished_by: holder has the lease, or the opinion is still available
+    FINISHABLE_BY = """(
+        (reserved_until > :now AND holder IS :holder)
+        OR ((reserved_until IS NULL OR reserved_until <= :now) AND num_finished_annotations IN (0, 1))
+    )"""
+
+    def renew(self, opinionId, holder) :
+        """
+        same as GDNData.renew_lease: extend the lease of holder, or take back an opinion that is still available,
+        returns False when another annotator holds it
+        """
+        now = time.time()
+        with self.transaction() as db :
+            renewed = db.execute(
+                f"UPDATE opinions SET reserved_until = :until, holder = :holder WHERE opinionId = :opinionId AND {self.FINISHABLE_BY}",
+                {"until": now + self.lease_ttl, "holder": holder, "opinionId": opinionId, "now": now}
+            ).rowcount
+        return renewed == 1
+
+    def release(self, opinionId, holder = None) :
+        "when holder is given, only a lease of holder (or an expired one) is released"
+        with self.transaction() as db :
+            if holder is None :
+                db.execute("UPDATE opinions SET reserved_until = NULL, holder = NULL WHERE opinionId = ?", (opinionId,))
+            else :
+                db.execute(
+                    """UPDATE opinions SET reserved_until = NULL, holder = NULL
+                    WHERE opinionId = ? AND (holder IS ? OR reserved_until IS NULL OR reserved_until <= ?)""",
+                    (opinionId, holder, time.time())
+                )
+
+    def finish(self, opinionId, llm, holder = None) :
+        """
+        returns the new number of finished annotations, or None when holder is given
+        and the opinion cannot be finished by holder (see GDNData.add_finished_annotation)
+        """
+        condition = "" if holder is None else f"AND {self.FINISHABLE_BY}"
+        with self.transaction() as db :
+            rows = db.execute(
+                f"""UPDATE opinions SET
+                    reserved_until = NULL,
+                    holder = NULL,
+                    num_finished_annotations = num_finished_annotations + 1,
+                    llm_2 = CASE WHEN llm_1 = '' THEN llm_2 ELSE :llm END,
+                    llm_1 = CASE WHEN llm_1 = '' THEN :llm ELSE llm_1 END
+                WHERE opinionId = :opinionId {condition}
+                RETURNING num_finished_annotations""",
+                {"llm": llm, "opinionId": opinionId, "holder": holder, "now": time.time()}
+            ).fetchall()
+        return rows[0][0] if rows else None
+
+    def report(self, opinionId) :
+        "returns the number of finished annotations before the report"
+        with self.transaction() as db :
+            [(previous,)] = db.execute("SELECT num_finished_annotations FROM opinions WHERE opinionId = ?", (opinionId,)).fetchall()
+            db.execute("UPDATE opinions SET reserved_until = NULL, holder = NULL, num_finished_annotations = -1 WHERE opinionId = ?", (opinionId,))
+        return previous
+
+    def used_llms(self, opinionId) :
+        row = self.connection().execute("SELECT llm_1, llm_2 FROM opinions WHERE opinionId = ?", (opinionId,)).fetchone()
+        if row is None :
+            raise KeyError(opinionId)
+        return [llm for llm in row if llm]
+
+    def reap_expired(self) :
+        with self.transaction() as db :
+            expired = db.execute("UPDATE opinions SET reserved_until = NULL, holder = NULL WHERE reserved_until <= ?", (time.time(),)).rowcount
+        self.num_expired_leases += expired
+        return expired
+
+    def counts(self) :
+        now = time.time()
+        available = "(reserved_until IS NULL OR reserved_until <= ?)"
+        row = self.connection().execute(
+            f"""SELECT
+                SUM(num_finished_annotations = 0 AND {available}),
+                SUM(num_finished_annotations = 1 AND {available}),
+                SUM(reserved_until > ?),
+                SUM(num_finished_annotations = -1)
+            FROM opinions""",
+            (now, now, now)
+        ).fetchone()
+        return {
+            "unannotated_available": row[0] or 0,
+            "once_annotated_available": row[1] or 0,
+            "active": row[2] or 0,
+            "reported": row[3] or 0,
+        }
@@ -0,0 +1,68 @@
+import os
+import pickle
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# bumped whenever the content of the snapshot changes
+SNAPSHOT_VERSION = 3
+
+
+def bytes_digest(content) :
+    return hashlib.blake2b(content, digest_size = 16).hexdigest()
+
+
+def file_digest(path, size = None, chunk_size = 1 << 20) :
+    "blake2b hex digest of the first size bytes of path (all of it by default)"
+    digest = hashlib.blake2b(digest_size = 16)
+    with open(path, "rb") as f :
+        remaining = size
+        while remaining is None or remaining > 0 :
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk :
+                break
+            digest.update(chunk)
+            if remaining is not None :
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def data_file_key(path, lazy_texts) :
+    "identifies a DATA_FILE and the way it was loaded, a snapshot is only used for the same key"
+    stat = os.stat(path)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "size": stat.st_size,
+        "digest": file_digest(path),
+        "lazy_texts": lazy_texts,
+    }
+
+
+def save_snapshot(path, key, data, offsets, replayed) :
+    """
+    Writes the columns read from DATA_FILE, the line offsets of the lazy texts (or None)
+    and the replayed aggregated logs (see count_logged_annotations) to path.
+    The header goes first, so that a stale snapshot is rejected without unpickling the rest.
+    """
+    with tempfile.NamedTemporaryFile('wb', delete=False, dir=os.path.dirname(path)) as tmp:
+        pickle.dump(key, tmp, protocol = pickle.HIGHEST_PROTOCOL)
+        pickle.dump({"data": data, "offsets": offsets, "replayed": replayed}, tmp, protocol = pickle.HIGHEST_PROTOCOL)
+        temp_name = tmp.name
+    os.replace(temp_name, path)  # atomic replace
+
+
+def load_snapshot(path, key) :
+    "content saved by save_snapshot, or None if there is no snapshot for this key"
+    try :
+        with open(path, "rb") as f :
+            if pickle.load(f) != key :
+                logger.info("snapshot saved for another DATA_FILE, ignoring it", extra={"path": str(path)})
+                return None
+            return pickle.load(f)
+    except FileNotFoundError :
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e :
+        logger.warning("could not read snapshot", extra={"path": str(path), "error": str(e)})
+        return None
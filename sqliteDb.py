@@ -0,0 +1,44 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SQLiteDatabase :
+    """
+    SQLite database in WAL mode used from several threads and processes:
+    each thread of each process gets its own connection.
+    """
+    def __init__(self, path, timeout = 30) :
+        self.path = str(path)
+        # seconds a statement waits for a lock held by another connection
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self) :
+        # connections must not cross a fork
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid() :
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def close(self) :
+        db = getattr(self.local, "db", None)
+        if db is not None :
+            db.close()
+            self.local.db = None
+
+    @contextmanager
+    def transaction(self) :
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try :
+            yield db
+            db.execute("COMMIT")
+        except BaseException :
+            db.execute("ROLLBACK")
+            raise
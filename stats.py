@@ -0,0 +1,224 @@
+import bisect
+import threading
+from sqliteDb import SQLiteDatabase
+
+# upper bounds in seconds of the annotation time histogram
+ANNOTATION_TIME_BUCKETS = (15, 30, 60, 90, 120, 180, 240, 300, 420, 600, 900, 1200, 1800, 2700, 3600, float("inf"))
+PERCENTILES = (50, 75, 90, 95, 99)
+
+# (kind, key) counters updated by an annotation or a report, for the /stats lists
+PER_KINDS = {
+    "per_annotator": "annotator",
+    "per_llm": "llm",
+    "per_theme": "theme",
+    "per_day": "day",
+    "reports_per_annotator": "reporter",
+    "report_reasons": "report_reason",
+}
+# counters keeping the smallest or largest amount added instead of their sum
+EXTREMA = {("time", "min"): min, ("time", "max"): max}
+
+
+def annotation_items(annotator, annotation) :
+    "counter increments of one saved annotation, the same for a live one and one read back from the logs"
+    opinion = annotation.get("opinion", {})
+    items = [
+        ("total", "annotations", 1),
+        ("annotator", annotator, 1),
+        ("llm", annotation.get("llm"), 1),
+        ("theme", opinion.get("authorName"), 1),
+        ("day", str(annotation.get("date", ""))[:10] or None, 1),
+    ]
+    seconds = annotation.get("time")
+    if isinstance(seconds, (int, float)) and seconds >= 0 :
+        bucket = ANNOTATION_TIME_BUCKETS[bisect.bisect_left(ANNOTATION_TIME_BUCKETS, seconds)]
+        items += [("time_bucket", str(bucket), 1), ("time", "count", 1), ("time", "sum", seconds),
+                  ("time", "min", seconds), ("time", "max", seconds)]
+    return items
+
+
+def report_items(annotator, report) :
+    return [
+        ("total", "reports", 1),
+        ("reporter", annotator, 1),
+        ("report_reason", report.get("reason"), 1),
+    ]
+
+
+def logged_items(kind, record) :
+    "counter increments of a line of the aggregated annotations or reports file"
+    if kind == "annotations" :
+        return annotation_items(record.get("annotator"), record)
+    return report_items(record.get("annotator"), record)
+
+
+def add_items(counters, items) :
+    for kind, key, amount in items :
+        name = (kind, str(key))
+        if name in EXTREMA :
+            counters[name] = EXTREMA[name](counters[name], amount) if name in counters else amount
+        else :
+            counters[name] = counters.get(name, 0) + amount
+
+
+def progress_items(previous, count) :
+    """
+    Increments of the opinions per number of finished annotations ("1", "2", ...) and of the reported ones,
+    when an opinion goes from previous to count (-1: reported).
+    """
+    if previous == count :
+        return []
+    items = []
+    for value, amount in [(previous, -1), (count, 1)] :
+        if value == -1 :
+            items.append(("opinions", "reported", amount))
+        elif value >= 1 :
+            items.append(("opinions", str(value), amount))
+    return items
+
+
+def histogram_percentile(buckets, total, percentile, smallest = 0, largest = float("inf")) :
+    """
+    Estimated from the histogram, interpolating linearly inside the bucket.
+    The first and last non-empty buckets are narrowed to the smallest and largest observed values,
+    so that one annotation of 0.2s gives 0.2s rather than the middle of the first bucket.
+    """
+    rank = total * percentile / 100
+    seen = 0
+    lower = 0
+    for upper in ANNOTATION_TIME_BUCKETS :
+        count = buckets.get(str(upper), 0)
+        if count and seen + count >= rank :
+            low, high = max(lower, smallest), min(upper, largest)
+            if high == float("inf") :
+                return low
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+        lower = upper
+    return min(lower, largest)
+
+
+class MemoryStatsStore :
+    def __init__(self) :
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, items) :
+        with self.lock :
+            add_items(self.counters, items)
+
+    def reset(self, counters) :
+        with self.lock :
+            self.counters = dict(counters)
+
+    def read(self) :
+        with self.lock :
+            return dict(self.counters)
+
+
+class SQLiteStatsStore(SQLiteDatabase) :
+    "same counters in a table of a SQLite database, shared by the server processes of app.py --workers"
+    def add(self, items) :
+        with self.transaction() as db :
+            # same sums and EXTREMA as add_items
+            db.executemany(
+                """INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT (kind, key) DO UPDATE SET value = CASE
+                    WHEN kind = 'time' AND key = 'min' THEN min(value, excluded.value)
+                    WHEN kind = 'time' AND key = 'max' THEN max(value, excluded.value)
+                    ELSE value + excluded.value END""",
+                [(kind, str(key), amount) for kind, key, amount in items]
+            )
+
+    def reset(self, counters) :
+        with self.transaction() as db :
+            db.execute("DROP TABLE IF EXISTS stats")
+            db.execute("CREATE TABLE stats (kind TEXT NOT NULL, key TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (kind, key))")
+            db.executemany("INSERT INTO stats VALUES (?, ?, ?)", [(kind, key, value) for (kind, key), value in counters.items()])
+
+    def read(self) :
+        return {(kind, key): value for kind, key, value in self.connection().execute("SELECT kind, key, value FROM stats")}
+
+
+class AnnotationStats :
+    """
+    Admin statistics kept up to date on every saved annotation and report, so that /stats
+    answers from a few hundred counters whatever the size of the logs.
+    Counters are rebuilt at startup from the aggregated logs (see data.count_logged_annotations)
+    and the annotation counts of the opinions.
+    """
+    def __init__(self) :
+        self.store = MemoryStatsStore()
+
+    def use_shared_store(self, store) :
+        "moves the counters to store, e.g. a SQLiteStatsStore shared by several processes"
+        store.reset(self.store.read())
+        self.store = store
+
+    def rebuild(self, logged, num_finished_annotations) :
+        """
+        logged: counters accumulated from the aggregated logs (or None),
+        num_finished_annotations: the column of GDNData, -1 for reported opinions.
+        """
+        counters = dict(logged or {})
+        for count, opinions in num_finished_annotations.value_counts().items() :
+            add_items(counters, [(kind, key, int(opinions)) for kind, key, _ in progress_items(0, int(count))])
+        counters[("opinions", "total")] = len(num_finished_annotations)
+        self.store.reset(counters)
+
+    def add_annotation(self, annotator, annotation) :
+        self.store.add(annotation_items(annotator, annotation))
+
+    def add_report(self, annotator, report) :
+        self.store.add(report_items(annotator, report))
+
+    def opinion_changed(self, previous, count) :
+        "an opinion of DATA_FILE went from previous to count finished annotations (-1: reported)"
+        items = progress_items(previous, count)
+        if items :
+            self.store.add(items)
+
+    def stats(self) :
+        counters = self.store.read()
+        grouped = {}
+        for (kind, key), value in counters.items() :
+            grouped.setdefault(kind, {})[key] = value
+
+        def counts(kind) :
+            return {key: int(value) for key, value in sorted(grouped.get(kind, {}).items())}
+
+        opinions = counts("opinions")
+        total = opinions.pop("total", 0)
+        reported = opinions.pop("reported", 0)
+        twice = sum(value for count, value in opinions.items() if int(count) >= 2)
+        progress = {
+            "opinions": total,
+            "annotated_once": opinions.get("1", 0),
+            "annotated_twice": twice,
+            "reported": reported,
+            "double_annotated_ratio": twice / total if total else 0.0,
+        }
+
+        time_counters = grouped.get("time", {})
+        num_times = int(time_counters.get("count", 0))
+        buckets = grouped.get("time_bucket", {})
+        annotation_time = {
+            "count": num_times,
+            "mean": round(time_counters.get("sum", 0) / num_times, 1) if num_times else None,
+            **{f"p{percentile}": round(histogram_percentile(buckets, num_times, percentile, time_counters.get("min", 0),
+                                                            time_counters.get("max", float("inf"))), 1) if num_times else None
+               for percentile in PERCENTILES},
+            "min": round(float(time_counters["min"]), 1) if num_times else None,
+            "max": round(float(time_counters["max"]), 1) if num_times else None,
+        }
+
+        totals = counts("total")
+        return {
+            "annotations": totals.get("annotations", 0),
+            "reports": totals.get("reports", 0),
+            **{name: counts(kind) for name, kind in PER_KINDS.items()},
+            "progress": progress,
+            "annotation_time": annotation_time,
+        }
+
+
+annotation_stats = AnnotationStats()
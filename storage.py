@@ -0,0 +1,475 @@
+import os
+import json
+import logging
+import pickle
+import time
+import tempfile
+from contextlib import contextmanager
+from filelock import FileLock
+from sqliteDb import SQLiteDatabase
+from metrics import registry
+from utils import iter_admin_opinion_results
+from const import (ANNOTATORS_DIR, ALL_ANNOTATIONS_OUTPUT_FILE, ALL_REPORTS_OUTPUT_FILE, COLLECT_MANIFEST_FILE,
+                   JSONL_FSYNC, STORAGE_BACKEND, STORAGE_DB_FILE)
+
+logger = logging.getLogger(__name__)
+
+# kinds of records kept for every annotator
+RECORD_KINDS = ["annotations", "examples_annotations", "reports"]
+# kinds aggregated over all annotators by collect, and their output file
+AGGREGATED_KINDS = {"annotations": ALL_ANNOTATIONS_OUTPUT_FILE, "reports": ALL_REPORTS_OUTPUT_FILE}
+
+lock_wait_seconds = registry.histogram("filelock_wait_seconds", "Time spent waiting for the FileLock of an annotator file.", ["operation"])
+
+
+@contextmanager
+def file_lock(file_path, operation) :
+    "holds the FileLock of file_path, recording how long it took to get it"
+    lock = FileLock(file_path + ".lock")
+    started = time.perf_counter()
+    with lock:
+        lock_wait_seconds.observe(time.perf_counter() - started, operation=operation)
+        yield
+
+
+def read_new_lines(file_path, annotator, offset, out_f) :
+    """
+    Copies the complete lines written to an annotator file after offset to out_f,
+    tagged with the annotator ID. Returns the offset right after the last complete line,
+    so a line that is still being written is picked up by the next run.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        content = f.read()
+
+    end = content.rfind(b"\n") + 1
+    for line in content[:end].decode("utf-8").splitlines() :
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+            data["annotator"] = annotator  # add annotator ID
+            out_f.write(json.dumps(data) + "\n")
+        except json.JSONDecodeError:
+            logger.warning("skipping invalid JSON line", extra={"path": str(file_path), "token": annotator})
+    return offset + end
+
+
+def annotator_files(file_name) :
+    "(annotator, path) of every annotator having file_name"
+    for annotator in os.listdir(ANNOTATORS_DIR):
+        if os.path.isdir(ANNOTATORS_DIR / annotator) :
+            file_path = os.path.join(ANNOTATORS_DIR, annotator, file_name)
+            if os.path.isfile(file_path):
+                yield annotator, file_path
+
+
+def rebuild_collected_file(file_name, output_file) :
+    "rewrites output_file from scratch, returns its manifest entry"
+    files = {}
+    with open(output_file, "w") as out_f:
+        for annotator, file_path in annotator_files(file_name) :
+            with file_lock(file_path, "collect"):
+                offset = read_new_lines(file_path, annotator, 0, out_f)
+            files[annotator] = {"inode": os.stat(file_path).st_ino, "offset": offset}
+        out_f.flush()
+        os.fsync(out_f.fileno())
+    return {"output_size": os.path.getsize(output_file), "files": files}
+
+
+def append_collected_file(file_name, output_file, entry) :
+    """
+    Appends to output_file only the lines written since the run that produced entry.
+    Returns the new manifest entry, or None when a full rebuild is needed
+    because an annotator file shrank, was rewritten or disappeared.
+    Annotator files are append-only and only complete lines are read,
+    so this does not take the annotators' locks.
+    """
+    if (not os.path.isfile(output_file)) or os.path.getsize(output_file) < entry["output_size"] :
+        return None
+
+    current = dict(annotator_files(file_name))
+    if any(annotator not in current for annotator in entry["files"]) :
+        return None
+
+    files = {}
+    for annotator, file_path in current.items() :
+        stat = os.stat(file_path)
+        previous = entry["files"].get(annotator, {"inode": stat.st_ino, "offset": 0})
+        if stat.st_ino != previous["inode"] or stat.st_size < previous["offset"] :
+            return None
+        files[annotator] = previous
+
+    with open(output_file, "r+") as out_f:
+        # drop whatever a previous interrupted run appended after the manifest was written
+        out_f.truncate(entry["output_size"])
+        out_f.seek(entry["output_size"])
+        for annotator, file_path in current.items() :
+            if os.path.getsize(file_path) > files[annotator]["offset"] :
+                offset = read_new_lines(file_path, annotator, files[annotator]["offset"], out_f)
+                files[annotator] = {"inode": files[annotator]["inode"], "offset": offset}
+        out_f.flush()
+        os.fsync(out_f.fileno())
+    return {"output_size": os.path.getsize(output_file), "files": files}
+
+
+def load_collect_manifest() :
+    try :
+        with open(COLLECT_MANIFEST_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError) :
+        return {}
+
+
+def save_collect_manifest(manifest) :
+    with tempfile.NamedTemporaryFile('w', delete=False, dir=os.path.dirname(COLLECT_MANIFEST_FILE)) as tmp:
+        json.dump(manifest, tmp)
+        temp_name = tmp.name
+    os.replace(temp_name, COLLECT_MANIFEST_FILE)  # atomic replace
+
+
+# files already checked for a torn last line by this process
+recovered_files = set()
+
+def recover_jsonl(file_path, chunk_size = 65536) :
+    """
+    Truncates a last line left without its newline by a write interrupted by a crash.
+    Every line is written with its newline in one append, so such a line is incomplete.
+    """
+    if not os.path.isfile(file_path) :
+        return
+    with file_lock(file_path, "recover"):
+        with open(file_path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0 :
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n" :
+                return
+
+            # look backwards for the end of the last complete line
+            end = size
+            keep = 0
+            while end > 0 :
+                start = max(0, end - chunk_size)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline != -1 :
+                    keep = start + newline + 1
+                    break
+                end = start
+
+            logger.warning("truncating torn last line", extra={"path": str(file_path), "bytes": size - keep})
+            f.truncate(keep)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class JsonlStorage :
+    """
+    One directory per annotator in ANNOTATORS_DIR, holding user.pkl and one append-only
+    jsonl file per record kind, each protected by its own .lock file.
+    """
+    def annotator_dir(self, token) :
+        return ANNOTATORS_DIR / token
+
+    def record_file(self, token, kind) :
+        return str(self.annotator_dir(token) / f"{kind}.jsonl")
+
+    def annotator_exists(self, token) :
+        return self.annotator_dir(token).is_dir()
+
+    def list_annotators(self) :
+        return [annotator for annotator in os.listdir(ANNOTATORS_DIR) if os.path.isdir(ANNOTATORS_DIR / annotator)]
+
+    def create_annotator(self, token) :
+        os.makedirs(self.annotator_dir(token), exist_ok=True)
+        for kind in RECORD_KINDS :
+            open(self.record_file(token, kind), 'a').close()
+
+    @staticmethod
+    def file_version(user_file) :
+        # every save replaces the file, so the inode changes even within one mtime tick
+        try :
+            stat = os.stat(user_file)
+        except FileNotFoundError :
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def user_version(self, token) :
+        "changes whenever user.pkl is written, by this process or any other"
+        return self.file_version(self.annotator_dir(token) / "user.pkl")
+
+    def save_user(self, user, expected_version = None) :
+        """
+        Returns the version of the written user. When expected_version is given and user.pkl
+        was changed since, nothing is written and None is returned.
+        """
+        user_file = str(self.annotator_dir(user.token) / "user.pkl")
+        with file_lock(user_file, "save_user"):
+            if expected_version is not None and self.file_version(user_file) != expected_version :
+                return None
+            # write to temp file first
+            with tempfile.NamedTemporaryFile('wb', delete=False, dir=os.path.dirname(user_file)) as tmp:
+                pickle.dump(user, tmp)
+                temp_name = tmp.name
+            os.replace(temp_name, user_file)  # atomic replace
+            return self.file_version(user_file)
+
+    def load_user(self, token) :
+        return self.load_versioned_user(token)[0]
+
+    def load_versioned_user(self, token) :
+        "the user and its version (see user_version)"
+        user_file = str(self.annotator_dir(token) / "user.pkl")
+        with file_lock(user_file, "load_user"):
+            try:
+                with open(user_file, "rb") as f:
+                    user = pickle.load(f)
+            except Exception:
+                raise ValueError
+            version = self.file_version(user_file)
+        self.recover_files(token)
+        return user, version
+
+    def recover_files(self, token) :
+        for kind in RECORD_KINDS :
+            file_path = self.record_file(token, kind)
+            if file_path not in recovered_files :
+                recover_jsonl(file_path)
+                recovered_files.add(file_path)
+
+    def append_record(self, token, kind, data) :
+        "appends one line; O_APPEND writes never touch what was already written"
+        file_path = self.record_file(token, kind)
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        with file_lock(file_path, "append_record"):
+            fd = os.open(file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                written = 0
+                while written < len(line) :
+                    written += os.write(fd, line[written:])
+                if JSONL_FSYNC == "always" :
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def read_records(self, token, kind) :
+        file_path = self.record_file(token, kind)
+        records = []
+        with file_lock(file_path, "read_records"):
+            with open(file_path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning("skipping invalid JSON line", extra={"path": str(file_path), "token": token})
+        return records
+
+    def iter_annotations(self, cursor = 0, filters = {}) :
+        "(cursor of the next annotation, annotation) of the aggregated annotations, cursors are byte offsets"
+        if not os.path.isfile(ALL_ANNOTATIONS_OUTPUT_FILE) :
+            raise FileNotFoundError(ALL_ANNOTATIONS_OUTPUT_FILE)
+        return iter_admin_opinion_results(ALL_ANNOTATIONS_OUTPUT_FILE, cursor, filters)
+
+    def collect(self, incremental = True) :
+        """
+        Aggregates every annotator's annotations.jsonl and reports.jsonl into
+        ALL_ANNOTATIONS_OUTPUT_FILE and ALL_REPORTS_OUTPUT_FILE.
+        In incremental mode only the lines added since the last run are appended,
+        using the per-annotator offsets stored in COLLECT_MANIFEST_FILE.
+        """
+        # two overlapping runs would both append the same lines, and one would save a stale manifest
+        with file_lock(str(COLLECT_MANIFEST_FILE), "collect"):
+            manifest = load_collect_manifest() if incremental else {}
+
+            for kind, output_file in AGGREGATED_KINDS.items() :
+                file_name = f"{kind}.jsonl"
+                entry = None
+                if file_name in manifest :
+                    entry = append_collected_file(file_name, output_file, manifest[file_name])
+                if entry is None :
+                    logger.info("rebuilding aggregated file", extra={"path": str(output_file)})
+                    entry = rebuild_collected_file(file_name, output_file)
+                manifest[file_name] = entry
+
+            save_collect_manifest(manifest)
+
+
+class SQLiteStorage(SQLiteDatabase) :
+    """
+    Users, annotations, example annotations and reports of every annotator in one SQLite database.
+    Each write is a transaction, and annotations are indexed by annotator, opinion, model and date
+    for admin queries. The aggregated jsonl files are exported from it by collect.
+    """
+    def __init__(self, path = STORAGE_DB_FILE) :
+        super().__init__(path)
+        with self.transaction() as db :
+            # version: incremented by every save_user, see JsonlStorage.user_version
+            db.execute("CREATE TABLE IF NOT EXISTS users (token TEXT PRIMARY KEY, state BLOB, version INTEGER NOT NULL DEFAULT 0)")
+            if "version" not in [column for _, column, *_ in db.execute("PRAGMA table_info(users)")] :
+                db.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            db.execute("""CREATE TABLE IF NOT EXISTS records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                token TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                opinionId TEXT,
+                llm TEXT,
+                date TEXT,
+                data TEXT NOT NULL
+            )""")
+            db.execute("CREATE INDEX IF NOT EXISTS records_token ON records (token, kind, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS records_opinion ON records (kind, opinionId, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS records_llm ON records (kind, llm, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS records_date ON records (kind, date, id)")
+            # last record and size of each exported aggregated file
+            db.execute("CREATE TABLE IF NOT EXISTS exports (kind TEXT PRIMARY KEY, last_id INTEGER NOT NULL, output_size INTEGER NOT NULL)")
+
+    def annotator_exists(self, token) :
+        return self.connection().execute("SELECT 1 FROM users WHERE token = ?", (token,)).fetchone() is not None
+
+    def list_annotators(self) :
+        return [token for (token,) in self.connection().execute("SELECT token FROM users ORDER BY token")]
+
+    def create_annotator(self, token) :
+        # the state is written by the first save_user, the row already marks the token as used
+        with self.transaction() as db :
+            db.execute("INSERT OR IGNORE INTO users (token, state) VALUES (?, NULL)", (token,))
+
+    def user_version(self, token) :
+        row = self.connection().execute("SELECT version FROM users WHERE token = ?", (token,)).fetchone()
+        return None if row is None else row[0]
+
+    def save_user(self, user, expected_version = None) :
+        "same as JsonlStorage.save_user"
+        condition = "" if expected_version is None else "WHERE users.version = :expected"
+        with self.transaction() as db :
+            row = db.execute(
+                f"""INSERT INTO users (token, state, version) VALUES (:token, :state, 1)
+                ON CONFLICT (token) DO UPDATE SET state = excluded.state, version = users.version + 1 {condition}
+                RETURNING version""",
+                {"token": user.token, "state": pickle.dumps(user), "expected": expected_version}
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def load_user(self, token) :
+        return self.load_versioned_user(token)[0]
+
+    def load_versioned_user(self, token) :
+        row = self.connection().execute("SELECT state, version FROM users WHERE token = ?", (token,)).fetchone()
+        if row is None or row[0] is None :
+            raise ValueError
+        return pickle.loads(row[0]), row[1]
+
+    INSERT_RECORD = "INSERT INTO records (token, kind, opinionId, llm, date, data) VALUES (?, ?, ?, ?, ?, ?)"
+
+    @staticmethod
+    def record_row(token, kind, data) :
+        "the values of INSERT_RECORD for one record"
+        opinion = data.get("opinion") or {}
+        opinionId = opinion.get("opinionId")
+        return (token, kind, None if opinionId is None else str(opinionId), data.get("llm"), data.get("date"), json.dumps(data))
+
+    def append_record(self, token, kind, data) :
+        with self.transaction() as db :
+            db.execute(self.INSERT_RECORD, self.record_row(token, kind, data))
+
+    def read_records(self, token, kind) :
+        rows = self.connection().execute("SELECT data FROM records WHERE token = ? AND kind = ? ORDER BY id", (token, kind))
+        return [json.loads(data) for (data,) in rows]
+
+    def iter_annotations(self, cursor = 0, filters = {}) :
+        "(cursor of the next annotation, annotation) of all annotations, cursors are record ids"
+        query = "SELECT id, token, data FROM records WHERE kind = 'annotations' AND id > ?"
+        parameters = [cursor]
+        for key, condition in [("annotator", "token = ?"), ("llm", "llm = ?"), ("opinionId", "opinionId = ?"),
+                               ("date_from", "date >= ?"), ("date_to", "date <= ?")] :
+            if key in filters :
+                query += f" AND {condition}"
+                parameters.append(filters[key])
+        rows = self.connection().execute(query + " ORDER BY id", parameters)
+        return (self.with_annotator(id, token, data) for id, token, data in rows)
+
+    @staticmethod
+    def with_annotator(id, token, data) :
+        data = json.loads(data)
+        data["annotator"] = token  # add annotator ID
+        return id, data
+
+    def collect(self, incremental = True) :
+        """
+        Exports the annotations and reports of all annotators to ALL_ANNOTATIONS_OUTPUT_FILE and
+        ALL_REPORTS_OUTPUT_FILE, in the same format as JsonlStorage.collect.
+        In incremental mode only the records added since the last export are appended.
+        """
+        # an overlapping run would append the same records again, the lock is the one of JsonlStorage.collect
+        with file_lock(str(COLLECT_MANIFEST_FILE), "collect"):
+            db = self.connection()
+            for kind, output_file in AGGREGATED_KINDS.items() :
+                export = db.execute("SELECT last_id, output_size FROM exports WHERE kind = ?", (kind,)).fetchone()
+                if incremental and export is not None and os.path.isfile(output_file) and os.path.getsize(output_file) == export[1] :
+                    last_id, mode = export[0], "a"
+                else :
+                    logger.info("rebuilding aggregated file", extra={"path": str(output_file)})
+                    last_id, mode = 0, "w"
+
+                rows = db.execute("SELECT id, token, data FROM records WHERE kind = ? AND id > ? ORDER BY id", (kind, last_id))
+                with open(output_file, mode) as out_f:
+                    for id, token, data in rows :
+                        _, data = self.with_annotator(id, token, data)
+                        out_f.write(json.dumps(data) + "\n")
+                        last_id = id
+                    out_f.flush()
+                    os.fsync(out_f.fileno())
+
+                with self.transaction() as db :
+                    db.execute("INSERT OR REPLACE INTO exports (kind, last_id, output_size) VALUES (?, ?, ?)",
+                               (kind, last_id, os.path.getsize(output_file)))
+
+    def import_jsonl(self, jsonl_storage) :
+        "one-shot migration: replaces the content of the database by the annotators of jsonl_storage"
+        with self.transaction() as db :
+            db.execute("DELETE FROM users")
+            db.execute("DELETE FROM records")
+            db.execute("DELETE FROM exports")
+        for token in jsonl_storage.list_annotators() :
+            user_file = jsonl_storage.annotator_dir(token) / "user.pkl"
+            state = user_file.read_bytes() if user_file.is_file() else None
+            records = {kind: jsonl_storage.read_records(token, kind) for kind in RECORD_KINDS
+                       if os.path.isfile(jsonl_storage.record_file(token, kind))}
+            # one transaction per annotator, a commit per record made large imports take hours
+            with self.transaction() as db :
+                db.execute("INSERT INTO users (token, state) VALUES (?, ?)", (token, state))
+                for kind, kind_records in records.items() :
+                    db.executemany(self.INSERT_RECORD, (self.record_row(token, kind, data) for data in kind_records))
+            logger.info("imported annotator", extra={"token": token, "records": sum(map(len, records.values()))})
+
+    def export_jsonl(self, directory) :
+        "writes every annotator in the JsonlStorage layout: directory/<token>/user.pkl and directory/<token>/<kind>.jsonl"
+        db = self.connection()
+        for token in self.list_annotators() :
+            os.makedirs(os.path.join(directory, token), exist_ok=True)
+            (state,) = db.execute("SELECT state FROM users WHERE token = ?", (token,)).fetchone()
+            # NULL until the first save_user, like an annotator directory without user.pkl
+            if state is not None :
+                with open(os.path.join(directory, token, "user.pkl"), "wb") as f:
+                    f.write(state)
+            for kind in RECORD_KINDS :
+                with open(os.path.join(directory, token, f"{kind}.jsonl"), "w") as f:
+                    for data in self.read_records(token, kind) :
+                        f.write(json.dumps(data) + "\n")
+
+
+def make_storage(backend = STORAGE_BACKEND) :
+    if backend == "sqlite" :
+        return SQLiteStorage()
+    if backend == "jsonl" :
+        return JsonlStorage()
+    raise ValueError(f"unknown storage backend {backend}")
+
+
+storage = make_storage()
@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+# the modules live at the root of the repository and read their settings at import
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("ANNOTATION_DATA_FILE", "unused.jsonl")
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,43 @@
+"""
+Pages of the aggregated annotations read by /get-all-annotations, whose cursors are byte offsets.
+"""
+import json
+
+import pytest
+
+from utils import iter_admin_opinion_results, load_admin_opinion_page, InvalidCursor
+
+
+@pytest.fixture
+def annotations_file(tmp_path) :
+    path = tmp_path / "all_annotations.jsonl"
+    with open(path, "w") as f :
+        for i in range(5) :
+            f.write(json.dumps({"opinion": {"opinionId": i}, "annotator": f"a{i % 2}", "llm": "m"}) + "\n")
+    return path
+
+
+def test_pages(annotations_file) :
+    seen = []
+    cursor = 0
+    while cursor is not None :
+        results, cursor = load_admin_opinion_page(iter_admin_opinion_results(annotations_file, cursor), 2)
+        seen += [annotation["opinion"]["opinionId"] for annotation in results]
+    assert seen == [0, 1, 2, 3, 4]
+
+
+def test_cursor_at_end(annotations_file) :
+    size = annotations_file.stat().st_size
+    assert list(iter_admin_opinion_results(annotations_file, size)) == []
+
+
+@pytest.mark.parametrize("offset", [1, 10, -1])
+def test_cursor_inside_a_line(annotations_file, offset) :
+    first_line = len(annotations_file.read_bytes().split(b"\n")[0]) + 1
+    with pytest.raises(InvalidCursor) :
+        iter_admin_opinion_results(annotations_file, first_line + offset)
+
+
+def test_cursor_past_the_end(annotations_file) :
+    with pytest.raises(InvalidCursor) :
+        iter_admin_opinion_results(annotations_file, annotations_file.stat().st_size + 1)
@@ -0,0 +1,214 @@
+"""
+GroqLLM.post against a local stub of the chat completion API: retries of 429 and 5xx
+with jittered backoff, connect and read timeouts, and reuse of the pooled Session connections.
+"""
+import json
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+import groqLLM
+from groqLLM import GroqLLM, make_session, backoff_delay, llm_requests_total
+from rateLimiter import RateLimiter
+
+
+class StubServer(ThreadingHTTPServer) :
+    "answers with the (status, delay seconds) of script in turn, then 200 right away"
+    daemon_threads = True
+
+    def __init__(self, script = ()) :
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.script = list(script)
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        # client (host, port) of every request, one per connection used
+        self.clients = set()
+
+    @property
+    def url(self) :
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+    def next_answer(self, client) :
+        with self.lock :
+            self.num_requests += 1
+            self.clients.add(client)
+            return self.script.pop(0) if self.script else (200, 0)
+
+
+class StubHandler(BaseHTTPRequestHandler) :
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) :
+        pass
+
+    def do_POST(self) :
+        self.rfile.read(int(self.headers["Content-Length"]))
+        status, delay = self.server.next_answer(self.client_address)
+        time.sleep(delay)
+        if status == 200 :
+            body = {"choices": [{"message": {"content": "an argument"}}]}
+        else :
+            body = {"error": {"message": f"status {status}"}}
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if status == 429 :
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def stub() :
+    servers = []
+    def start(script = ()) :
+        server = StubServer(script)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers :
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch) :
+    monkeypatch.setattr(groqLLM, "LLM_BACKOFF", 0.01)
+    monkeypatch.setattr(groqLLM, "LLM_MAX_BACKOFF", 0.05)
+
+
+def make_llm(url, session = None, timeout = (1, 2), max_retries = 2) :
+    llm = GroqLLM("llama-3.1-8b-instant", session=session if session is not None else make_session(),
+                  rate_limiter=RateLimiter({}, 16, 1))
+    llm.api_url = url
+    llm.timeout = timeout
+    llm.max_retries = max_retries
+    return llm
+
+
+def outcomes(model) :
+    return {key[1]: value for key, value in llm_requests_total.snapshot().items() if key[0] == model}
+
+
+def test_answer(stub) :
+    server = stub()
+    assert make_llm(server.url).query("opinion") == "an argument"
+    assert server.num_requests == 1
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_retries_then_answers(stub, status) :
+    server = stub([(status, 0), (status, 0)])
+    assert make_llm(server.url).query("opinion") == "an argument"
+    assert server.num_requests == 3
+
+
+def test_gives_up_after_max_retries(stub) :
+    server = stub([(503, 0)] * 10)
+    before = outcomes("llama-3.1-8b-instant").get("http_error", 0)
+    assert make_llm(server.url, max_retries=2).query("opinion") is None
+    assert server.num_requests == 3
+    assert outcomes("llama-3.1-8b-instant")["http_error"] == before + 1
+
+
+def test_client_errors_are_not_retried(stub) :
+    server = stub([(400, 0)])
+    assert make_llm(server.url).query("opinion") is None
+    assert server.num_requests == 1
+
+
+def test_backoff_is_jittered_and_bounded(monkeypatch) :
+    delays = {backoff_delay(2) for _ in range(200)}
+    # full jitter: uniform between 0 and min(max backoff, base * 2 ** attempt)
+    assert all(0 <= delay <= min(groqLLM.LLM_MAX_BACKOFF, groqLLM.LLM_BACKOFF * 4) for delay in delays)
+    assert len(delays) > 100
+    assert all(backoff_delay(30) <= groqLLM.LLM_MAX_BACKOFF for _ in range(100))
+
+
+def test_backoff_honors_retry_after() :
+    response = requests.Response()
+    response.headers["Retry-After"] = "0.04"
+    assert all(0.04 <= backoff_delay(0, response) <= groqLLM.LLM_MAX_BACKOFF for _ in range(50))
+    response.headers["Retry-After"] = "3600"
+    assert backoff_delay(0, response) == groqLLM.LLM_MAX_BACKOFF
+
+
+def test_read_timeout(stub) :
+    server = stub([(200, 1.0)])
+    before = outcomes("llama-3.1-8b-instant").get("timeout", 0)
+    started = time.monotonic()
+    assert make_llm(server.url, timeout=(1, 0.2)).query("opinion") is None
+    assert time.monotonic() - started < 0.9
+    # a request that may have reached the model is not sent again
+    assert server.num_requests == 1
+    assert outcomes("llama-3.1-8b-instant")["timeout"] == before + 1
+
+
+def test_connect_timeout_is_retried() :
+    # a listening socket whose accept queue is full drops the SYNs of new connections
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    fillers = []
+    for _ in range(4) :
+        filler = socket.socket()
+        filler.setblocking(False)
+        try :
+            filler.connect(("127.0.0.1", port))
+        except BlockingIOError :
+            pass
+        fillers.append(filler)
+    time.sleep(0.1)
+    try :
+        llm = make_llm(f"http://127.0.0.1:{port}/v1/chat/completions", timeout=(0.2, 1), max_retries=1)
+        started = time.monotonic()
+        with pytest.raises(requests.exceptions.ConnectTimeout) :
+            llm.post(*llm.request_payload("opinion", 0.3, 150))
+        # two attempts of 0.2s, and a short backoff between them
+        assert 0.4 <= time.monotonic() - started < 1.5
+    finally :
+        for sock in fillers + [listener] :
+            sock.close()
+
+
+def test_connection_errors_are_retried(stub, monkeypatch) :
+    attempts = []
+    monkeypatch.setattr(groqLLM, "backoff_delay", lambda attempt, response = None : attempts.append(attempt) or 0)
+    server = stub()
+    url = server.url
+    server.shutdown()
+    server.server_close()
+    llm = make_llm(url, max_retries=2)
+    with pytest.raises(requests.exceptions.ConnectionError) :
+        llm.post(*llm.request_payload("opinion", 0.3, 150))
+    assert attempts == [0, 1]
+
+
+def test_session_reuses_connections(stub) :
+    server = stub()
+    session = make_session()
+    llms = [make_llm(server.url, session=session), make_llm(server.url, session=session)]
+    for i in range(10) :
+        assert llms[i % 2].query(f"opinion {i}") == "an argument"
+    assert server.num_requests == 10
+    assert len(server.clients) == 1
+
+
+def test_pool_bounds_connections_per_host(stub) :
+    server = stub([(200, 0.1)] * 16)
+    llm = make_llm(server.url, session=make_session(connections_per_host=2))
+    threads = [threading.Thread(target=llm.query, args=(f"opinion {i}",)) for i in range(8)]
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+    assert server.num_requests == 8
+    # callers wait for a free connection instead of opening more
+    assert len(server.clients) <= 2
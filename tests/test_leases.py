@@ -0,0 +1,91 @@
+"""
+Leases of GDNData, in memory and in the SQLite state shared by app.py --workers:
+an annotation is only recorded for the annotator holding the opinion.
+"""
+import time
+
+import pandas as pd
+import pytest
+
+from data import GDNData
+from sharedState import SQLiteAssignmentState
+
+
+class LeaseUser :
+    "the part of User that next_data uses"
+    def __init__(self, token, second = False) :
+        self.token = token
+        self.second = second
+        self.done_annotations = []
+
+    def can_be_second_annotator(self) :
+        return self.second
+
+
+def make_dataframe(size) :
+    data = pd.DataFrame({
+        "opinionId": range(1, size + 1),
+        "text": ["une opinion"] * size,
+        "authorName": ["LA_TRANSITION_ECOLOGIQUE"] * size,
+        "len": [11] * size,
+    })
+    data["num_finished_annotations"] = 0
+    data["is_being_annotated"] = False
+    data["llm_1"] = ""
+    data["llm_2"] = ""
+    return data
+
+
+@pytest.fixture(params=["memory", "shared"])
+def all_data(request, tmp_path) :
+    all_data = GDNData(make_dataframe(3), lease_ttl=0.05)
+    if request.param == "shared" :
+        all_data.use_shared_state(SQLiteAssignmentState.create(tmp_path / "state.sqlite", all_data.data, all_data.lease_ttl))
+    return all_data
+
+
+def annotation(opinionId, llm) :
+    return {"opinion": {"opinionId": opinionId}, "llm": llm}
+
+
+def test_holder_finishes(all_data) :
+    line = all_data.next_data(LeaseUser("first"))
+    assert all_data.add_finished_annotation(annotation(line["opinionId"], "model-a"), "first")
+    assert all_data.get_used_llm(line["opinionId"]) == ["model-a"]
+
+
+def reassign_after_ttl(all_data, second = False) :
+    first = all_data.next_data(LeaseUser("first", second))
+    time.sleep(0.1)
+    all_data.reap_expired_leases()
+    reassigned = all_data.next_data(LeaseUser("second", second))
+    assert reassigned["opinionId"] == first["opinionId"]
+    return first["opinionId"]
+
+
+def test_reassigned_after_ttl(all_data) :
+    opinionId = reassign_after_ttl(all_data)
+    assert not all_data.add_finished_annotation(annotation(opinionId, "model-a"), "first")
+    assert all_data.add_finished_annotation(annotation(opinionId, "model-b"), "second")
+    assert all_data.get_used_llm(opinionId) == ["model-b"]
+
+
+def test_no_third_annotation(all_data) :
+    line = all_data.next_data(LeaseUser("annotator"))
+    assert all_data.add_finished_annotation(annotation(line["opinionId"], "model-a"), "annotator")
+
+    # both second annotators submit, the one whose lease expired last
+    opinionId = reassign_after_ttl(all_data, second=True)
+    assert opinionId == line["opinionId"]
+    assert all_data.add_finished_annotation(annotation(opinionId, "model-b"), "second")
+    assert not all_data.add_finished_annotation(annotation(opinionId, "model-c"), "first")
+    assert all_data.get_used_llm(opinionId) == ["model-a", "model-b"]
+
+
+def test_expired_lease_not_taken_again(all_data) :
+    line = all_data.next_data(LeaseUser("first"))
+    time.sleep(0.1)
+    all_data.reap_expired_leases()
+    # nobody took the opinion since, the late annotation is still welcome
+    assert all_data.add_finished_annotation(annotation(line["opinionId"], "model-a"), "first")
+    assert all_data.get_used_llm(line["opinionId"]) == ["model-a"]
@@ -0,0 +1,49 @@
+"""
+LLMCache file shared by several processes: the size limit holds for the whole file,
+and a cache file locked by another process does not fail the LLM call.
+"""
+import sqlite3
+
+import pytest
+
+import llmCache
+from llmCache import LLMCache
+
+
+def answer(i) :
+    return f"answer {i} " + "x" * 100
+
+
+def test_limit_holds_for_all_processes(tmp_path) :
+    # one LLMCache per server process of app.py --workers
+    caches = [LLMCache(tmp_path / "cache.sqlite", max_disk_bytes=2000) for _ in range(3)]
+    for i in range(60) :
+        caches[i % 3].put(f"key {i}", answer(i))
+    db = sqlite3.connect(tmp_path / "cache.sqlite")
+    total, = db.execute("SELECT SUM(size) FROM answers").fetchone()
+    assert total <= 2000
+    # the most recent answers are kept
+    assert LLMCache(tmp_path / "cache.sqlite").get("key 59") == answer(59)
+    assert all(cache.disk_bytes <= 2000 for cache in caches)
+
+
+def test_locked_file(tmp_path, monkeypatch) :
+    monkeypatch.setattr(llmCache, "LLM_CACHE_BUSY_TIMEOUT", 0.05)
+    cache = LLMCache(tmp_path / "cache.sqlite")
+    cache.put("stored", "an answer")
+    reader = LLMCache(tmp_path / "cache.sqlite")
+
+    other = sqlite3.connect(tmp_path / "cache.sqlite", isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try :
+        # the write is skipped, the answer stays in the memory tier
+        cache.put("new", "another answer")
+        assert cache.get("new") == "another answer"
+        assert reader.get("new") is None
+        # read while another process writes, only the last use is not updated
+        assert reader.get("stored") == "an answer"
+    finally :
+        other.execute("ROLLBACK")
+        other.close()
+    cache.put("new", "another answer")
+    assert LLMCache(tmp_path / "cache.sqlite").get("new") == "another answer"
@@ -0,0 +1,74 @@
+"""
+RateLimiter.aacquire, the rate limiter wait of the asyncio server.
+"""
+import asyncio
+import time
+
+import pytest
+
+from rateLimiter import RateLimiter
+
+
+def one_per_second(max_queue = 16, timeout = 5) :
+    return RateLimiter({"groq": {"rpm": 60, "rpm_burst": 1}}, max_queue, timeout)
+
+
+def test_wait_does_not_block_the_event_loop() :
+    limiter = one_per_second()
+    async def main() :
+        ticks = 0
+        async def tick() :
+            nonlocal ticks
+            while True :
+                await asyncio.sleep(0.01)
+                ticks += 1
+        ticker = asyncio.ensure_future(tick())
+        started = time.monotonic()
+        assert await limiter.aacquire("groq", "llama-3.1-8b-instant", 10)
+        assert await limiter.aacquire("groq", "llama-3.1-8b-instant", 10)
+        waited = time.monotonic() - started
+        ticker.cancel()
+        return waited, ticks
+    waited, ticks = asyncio.run(main())
+    assert 0.8 <= waited < 2
+    # the loop kept running other tasks meanwhile
+    assert ticks >= 40
+
+
+def test_unlimited_model() :
+    assert asyncio.run(RateLimiter({}, 16, 1).aacquire("openai", "gpt-4.1", 10))
+
+
+def test_timeout() :
+    limiter = one_per_second(timeout=0.2)
+    async def main() :
+        assert await limiter.aacquire("groq", "m", 10)
+        return await limiter.aacquire("groq", "m", 10)
+    assert not asyncio.run(main())
+    assert limiter.waiters == []
+
+
+def test_full_queue() :
+    limiter = one_per_second(max_queue=1)
+    async def main() :
+        assert await limiter.aacquire("groq", "m", 10)
+        waiting = asyncio.ensure_future(limiter.aacquire("groq", "m", 10))
+        await asyncio.sleep(0.05)
+        rejected = await limiter.aacquire("groq", "m", 10)
+        waiting.cancel()
+        return rejected
+    assert not asyncio.run(main())
+
+
+def test_cancelled_call_leaves_the_queue() :
+    limiter = one_per_second()
+    async def main() :
+        assert await limiter.aacquire("groq", "m", 10)
+        waiting = asyncio.ensure_future(limiter.aacquire("groq", "m", 10))
+        await asyncio.sleep(0.05)
+        assert len(limiter.waiters) == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError) :
+            await waiting
+    asyncio.run(main())
+    assert limiter.waiters == []
@@ -0,0 +1,83 @@
+"""
+UserCache against changes made to the stored users by another process,
+with both storage backends.
+"""
+import threading
+
+import pytest
+
+import user as user_module
+from storage import JsonlStorage, SQLiteStorage
+from user import User, UserCache
+
+
+@pytest.fixture(params=["jsonl", "sqlite"])
+def cache(request, tmp_path, monkeypatch) :
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "annotators").mkdir()
+    storage = JsonlStorage() if request.param == "jsonl" else SQLiteStorage(tmp_path / "storage.sqlite")
+    cache = UserCache(max_size=2, flush_interval=60)
+    monkeypatch.setattr(user_module, "storage", storage)
+    monkeypatch.setattr(user_module, "user_cache", cache)
+    return cache
+
+
+def change_outside(token, **values) :
+    "what adminPower --reload-users or another process does: read the stored user, change it and write it back"
+    stored = user_module.storage.load_user(token)
+    for name, value in values.items() :
+        setattr(stored, name, value)
+    user_module.storage.save_user(stored)
+
+
+def test_cached_user_changed_outside(cache) :
+    User("a")
+    cache.flush()
+    assert User.load_user("a").last_used_llm is None
+    change_outside("a", last_used_llm="model-a")
+    assert User.load_user("a").last_used_llm == "model-a"
+
+
+def test_flush_does_not_overwrite_a_change_made_outside(cache) :
+    User("a")
+    cache.flush()
+    user = User.load_user("a")
+    user.current_annotation = 12
+    user.save_user()
+    change_outside("a", last_used_llm="model-a")
+
+    cache.flush()
+    stored = user_module.storage.load_user("a")
+    assert stored.last_used_llm == "model-a"
+    assert stored.current_annotation is None
+    assert User.load_user("a").last_used_llm == "model-a"
+
+
+def test_own_writes_keep_the_cached_user(cache) :
+    User("a")
+    cache.flush()
+    user = User.load_user("a")
+    for i in range(3) :
+        user.current_annotation = i
+        user.save_user()
+        cache.flush()
+        assert User.load_user("a") is user
+    assert user_module.storage.load_user("a").current_annotation == 2
+
+
+def test_evicted_users_are_written_without_the_lock(cache, monkeypatch) :
+    lock_free = []
+    write_user = User.write_user
+    def checked_write_user(self, expected_version = None) :
+        # another request thread must be able to use the cache meanwhile
+        thread = threading.Thread(target=lambda : lock_free.append(cache.lock.acquire(blocking=False) and not cache.lock.release()))
+        thread.start()
+        thread.join()
+        return write_user(self, expected_version)
+    monkeypatch.setattr(User, "write_user", checked_write_user)
+
+    for token in ["a", "b", "c"] :
+        User(token)
+    assert lock_free == [True]
+    assert "a" not in cache.users
+    assert user_module.storage.load_user("a").token == "a"
@@ -0,0 +1,107 @@
+import os
+import logging
+import threading
+import time
+from metrics import registry
+from const import ALLOWED_TOKENS_FILE, ADMIN_TOKENS_FILE, TOKEN_RECHECK_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+token_lookups_total = registry.counter("token_lookups_total", "Token checks by kind (allowed, admin).", ["kind"])
+token_reloads_total = registry.counter("token_file_reloads_total", "Token files read again after a change.")
+
+
+
+class TokenFile :
+    "set of the tokens listed in a file, one per line"
+    def __init__(self, path) :
+        self.path = path
+        self.signature = None
+        self.tokens = frozenset()
+
+    def reload_if_changed(self) :
+        "returns True if the file changed since the last call and was read again"
+        try :
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError :
+            signature = None
+
+        if signature == self.signature :
+            return False
+
+        if signature is None :
+            logger.warning("token file not found", extra={"path": str(self.path)})
+            tokens = frozenset()
+        else :
+            with open(self.path) as f:
+                tokens = frozenset(line.rstrip() for line in f if line.strip())
+        self.tokens = tokens
+        self.signature = signature
+        return True
+
+
+class TokenRegistry :
+    """
+    Allowed and admin tokens kept in memory as sets.
+    The files are only checked (one stat each) every recheck_interval seconds,
+    and read again when their mtime or size changed.
+    """
+    def __init__(self, allowed_file = ALLOWED_TOKENS_FILE, admin_file = ADMIN_TOKENS_FILE, recheck_interval = TOKEN_RECHECK_INTERVAL) :
+        self.allowed = TokenFile(allowed_file)
+        self.admin = TokenFile(admin_file)
+        self.recheck_interval = recheck_interval
+        # None until both files were read once, the callers then wait on the lock for the first read
+        self.last_check = None
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.reloads = 0
+        self.refresh(force=True)
+
+    def checked_recently(self) :
+        return self.last_check is not None and time.monotonic() - self.last_check < self.recheck_interval
+
+    def refresh(self, force = False) :
+        if (not force) and self.checked_recently() :
+            return
+        with self.lock :
+            if (not force) and self.checked_recently() :
+                # another thread checked the files while this one waited
+                return
+            for token_file in (self.allowed, self.admin) :
+                if token_file.reload_if_changed() :
+                    self.reloads += 1
+                    token_reloads_total.inc()
+            # only set once the files are read, so that no caller skips the check and looks up stale sets
+            self.last_check = time.monotonic()
+
+    def is_allowed(self, token) :
+        "annotator or admin token"
+        self.refresh()
+        self.lookups += 1
+        token_lookups_total.inc(kind="allowed")
+        return token in self.allowed.tokens or token in self.admin.tokens
+
+    def is_admin(self, token) :
+        self.refresh()
+        self.lookups += 1
+        token_lookups_total.inc(kind="admin")
+        return token in self.admin.tokens
+
+    def stats(self) :
+        return {
+            "lookups": self.lookups,
+            "reloads": self.reloads,
+            "allowed_tokens": len(self.allowed.tokens),
+            "admin_tokens": len(self.admin.tokens),
+        }
+
+    def register_metrics(self) :
+        # every process reads the same files
+        registry.gauge("tokens_loaded", "Tokens of the allowlist files in memory, by file (allowed, admin).",
+                       lambda : {("allowed",): len(self.allowed.tokens), ("admin",): len(self.admin.tokens)}, ["file"],
+                       aggregate="max")
+        return self
+
+
+token_registry = TokenRegistry().register_metrics()
@@ -1,12 +1,14 @@
-import os 
-from pathlib import Path
-import pickle
-import json
-from const import NUM_ANNOTATIONS_BEFORE_SHARED, EXAMPLES
+from const import NUM_ANNOTATIONS_BEFORE_SHARED, EXAMPLES, USER_CACHE_SIZE, USER_FLUSH_INTERVAL
+from storage import storage
+from stats import annotation_stats
 import time
 from datetime import datetime
-from filelock import FileLock
-import tempfile
+import threading
+import atexit
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
 
 class User :
     def __init__(self, token, override_already_existing = False):
@@ -25,7 +27,7 @@ class User :
 
     @classmethod
     def token_already_exist(self, token) :
-        return Path(f"./annotators/{token}").is_dir()
+        return storage.annotator_exists(token)
     
 
     def __str__(self):
@@ -35,10 +37,7 @@ class User :
 
         pass
     def create_user(self) :
-        os.makedirs(f"./annotators/{self.token}/", exist_ok=True)
-        open(f"./annotators/{self.token}/annotations.jsonl", 'a').close()
-        open(f"./annotators/{self.token}/examples_annotations.jsonl", 'a').close()
-        open(f"./annotators/{self.token}/reports.jsonl", 'a').close()
+        storage.create_annotator(self.token)
 
         # self.current_batch = None # current batch index
         # self.current_index = 0 # current index in the batch
@@ -55,37 +54,42 @@ class User :
         return len(self.done_annotations)
     
     def save_user(self) :
-        user_file = f"./annotators/{self.token}/user.pkl"
-        lock = FileLock(user_file + ".lock")
-        with lock:
-            # write to temp file first
-            with tempfile.NamedTemporaryFile('wb', delete=False, dir=os.path.dirname(user_file)) as tmp:
-                pickle.dump(self, tmp)
-                temp_name = tmp.name
-            os.replace(temp_name, user_file)  # atomic replace
+        if user_cache.flush_interval <= 0 :
+            user_cache.put(self)
+            user_cache.write(self.token, self)
+        else :
+            # written to disk by the cache's background flush
+            user_cache.mark_dirty(self)
+
+    def write_user(self, expected_version = None) :
+        "see storage.save_user"
+        return storage.save_user(self, expected_version)
 
 
     @classmethod
     def load_user(cls, token) :
-        user_file = f"./annotators/{token}/user.pkl"
-        lock = FileLock(user_file + ".lock")
-        with lock:
-            try:
-                with open(user_file, "rb") as f:
-                    return pickle.load(f)
-            except Exception:
-                
-                raise ValueError
+        user = user_cache.get(token)
+        if user is not None :
+            return user
+
+        user, version = storage.load_versioned_user(token)
+        user_cache.put(user, version)
+        return user
     
     def can_be_second_annotator(self) :
         return self.num_annotated_batch() > NUM_ANNOTATIONS_BEFORE_SHARED
 
     def new_opinion(self, opinion) :
         self.current_annotation = opinion["opinionId"]
-        print(f"new annotation for user {self.token}: {self.current_annotation}")
+        logger.debug("new annotation", extra={"token": self.token, "opinionId": self.current_annotation})
         self.start_annotation_time = time.time()
         self.save_user()
 
+    def drop_current_annotation(self) :
+        "the opinion went to another annotator after the lease expired"
+        self.current_annotation = None
+        self.save_user()
+
     def add_done_example(self, id) :
         self.passed_tutorials[id] = True
         self.save_user()
@@ -95,9 +99,8 @@ class User :
 
         for exampleid, done in self.passed_tutorials.items() :
             if not done:
-                print("nex example!!", exampleid) 
+                logger.debug("next example", extra={"token": self.token, "opinionId": exampleid})
                 self.start_annotation_time = time.time()
-                print(self.start_annotation_time)
                 self.save_user()
                 return exampleid
         return None
@@ -107,74 +110,168 @@ class User :
         self.save_user()
 
     def report_data(self, data) :
-        file_path = f"./annotators/{self.token}/reports.jsonl"
-        self.write_jsonl(data, file_path)
+        storage.append_record(self.token, "reports", data)
+        annotation_stats.add_report(self.token, data)
         # self.done_annotations.append(self.current_annotation)
         self.current_annotation = None
         self.save_user()            
 
     def save_annotation(self, data) :
-        file_path = f"./annotators/{self.token}/annotations.jsonl"
         data["time"] = time.time() - self.start_annotation_time
         data["date"] = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
 
-        self.write_jsonl(data, file_path)
+        storage.append_record(self.token, "annotations", data)
+        annotation_stats.add_annotation(self.token, data)
         self.done_annotations.append(self.current_annotation)
         self.current_annotation = None
         self.save_user()
        
     def save_example_annotation(self, data) :
-        print(self.start_annotation_time)
-        print(time.time())
-        file_path = f"./annotators/{self.token}/examples_annotations.jsonl"
         data["time"] = time.time() - self.start_annotation_time
         data["date"] = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
 
-        self.write_jsonl(data, file_path)
+        storage.append_record(self.token, "examples_annotations", data)
         self.current_annotation = None
         self.save_user()
        
     
     def read_done_annotations(self) :
-        file_path = f"./annotators/{self.token}/annotations.jsonl"
-        lock = FileLock(file_path + ".lock")
         all_data = {}
-        with lock:
-            with open(file_path, "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        data = json.loads(line)
-                        all_data[data["opinion"]["opinionId"]] = {
-                            "text": data["opinion"]["text"],
-                            "date": data["date"]
-                        }
-                    except json.JSONDecodeError:
-                        print(f"Skipping invalid JSON in {file_path}")
-                        pass
+        for data in storage.read_records(self.token, "annotations") :
+            all_data[data["opinion"]["opinionId"]] = {
+                "text": data["opinion"]["text"],
+                "date": data["date"]
+            }
         return all_data
-        
 
-    def write_jsonl(self, data, file_path) :
-        lock = FileLock(file_path + ".lock")
-        with lock:
-            # read old content (if any)
-            lines = []
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as f:
-                    lines = f.readlines()
-
-            # append new line
-            lines.append(json.dumps(data) + "\n")
-
-            # write atomically
-            with tempfile.NamedTemporaryFile('w', delete=False, dir=os.path.dirname(file_path)) as tmp:
-                tmp.writelines(lines)
-                temp_name = tmp.name
-            os.replace(temp_name, file_path)
-            
+
+class UserCache :
+    """
+    Process-wide cache of loaded users, evicting the least recently used ones.
+    save_user only marks a user dirty: dirty users are pickled by a background thread
+    every flush_interval seconds, when they are evicted, and at exit.
+    The storage version of every cached user is kept: a user changed by another process
+    (adminPower --reload-users, a manual edit) is read again instead of being served or
+    overwritten from the cache, the change made outside wins over pending ones.
+    """
+    def __init__(self, max_size, flush_interval) :
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.users = OrderedDict()
+        # token -> storage version of the cached user when it was last read or written
+        self.versions = {}
+        self.dirty = {}
+        self.lock = threading.RLock()
+        self.flush_thread = None
+        atexit.register(self.flush)
+
+    def get(self, token) :
+        with self.lock :
+            user = self.users.get(token)
+            if user is None :
+                return None
+            version = self.versions.get(token)
+        if storage.user_version(token) != version :
+            with self.lock :
+                # pending changes are checked against the stored version when they are written
+                if token not in self.dirty :
+                    logger.info("user changed in storage, reading it again", extra={"token": token})
+                    self.forget(token, user)
+                    return None
+        with self.lock :
+            if token in self.users :
+                self.users.move_to_end(token)
+        return user
+
+    def put(self, user, version = None) :
+        "caches user, read from the storage at version (None: not read from the storage)"
+        with self.lock :
+            evicted = self.insert(user)
+            if version is not None :
+                self.versions[user.token] = version
+        self.write_evicted(evicted)
+
+    def insert(self, user) :
+        "must be called with the lock, returns the (token, user, version) of the evicted dirty users"
+        self.users[user.token] = user
+        self.users.move_to_end(user.token)
+        evicted = []
+        while len(self.users) > self.max_size :
+            token, evicted_user = self.users.popitem(last=False)
+            version = self.versions.pop(token, None)
+            if self.dirty.pop(token, None) is not None :
+                evicted.append((token, evicted_user, version))
+        return evicted
+
+    def write_evicted(self, evicted) :
+        # written without the lock, so that requests of other users do not wait for the disk
+        for token, user, version in evicted :
+            if user.write_user(version) is None :
+                logger.warning("user changed in storage, changes of the evicted copy dropped", extra={"token": token})
+
+    def forget(self, token, user) :
+        "must be called with the lock, drops user unless it was replaced meanwhile"
+        if self.users.get(token) is user :
+            del self.users[token]
+            self.versions.pop(token, None)
+        if self.dirty.get(token) is user :
+            del self.dirty[token]
+
+    def write(self, token, user) :
+        """
+        Writes user unless it was changed in the storage since it was cached, in which case the
+        cached copy is dropped. Returns False when it was.
+        """
+        with self.lock :
+            expected = self.versions.get(token)
+        version = user.write_user(expected)
+        with self.lock :
+            if version is None :
+                logger.warning("user changed in storage, cached changes dropped", extra={"token": token})
+                self.forget(token, user)
+                return False
+            if self.users.get(token) is user :
+                self.versions[token] = version
+        return True
+
+    def mark_dirty(self, user) :
+        with self.lock :
+            evicted = self.insert(user)
+            self.dirty[user.token] = user
+            if self.flush_thread is None :
+                self.flush_thread = threading.Thread(target=self.flush_loop, daemon=True)
+                self.flush_thread.start()
+        self.write_evicted(evicted)
+
+    def flush(self) :
+        with self.lock :
+            dirty = self.dirty
+            self.dirty = {}
+        for token, user in dirty.items() :
+            try :
+                self.write(token, user)
+            except Exception :
+                logger.exception("could not save user", extra={"token": token})
+                with self.lock :
+                    self.dirty.setdefault(token, user)
+
+    def disable(self) :
+        "load and save users from disk on every call, needed when several processes serve users"
+        self.flush()
+        with self.lock :
+            self.max_size = 0
+            self.flush_interval = 0
+            self.users.clear()
+            self.versions.clear()
+
+    def flush_loop(self) :
+        while self.flush_interval > 0 :
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_FLUSH_INTERVAL)
+
 
 
             
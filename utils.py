@@ -1,14 +1,25 @@
+import os
 import json
+import zlib
+import asyncio
+import logging
 import datetime
 from collections import defaultdict
-from const import ALL_ANNOTATIONS_OUTPUT_FILE, RESULTS_EXAMPLES
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from tokens import token_registry
+from const import ALL_ANNOTATIONS_OUTPUT_FILE, RESULTS_EXAMPLES, LLM_MAX_WORKERS, LLM_REQUEST_DEADLINE
+
+logger = logging.getLogger(__name__)
+
+# shared by all requests, bounds the number of LLM calls in flight
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS)
 
 def get_new_batch() :
     NotImplemented
     
 
-def extract_argument(opinion_text, segments, theme, llm):
-    """Use the LLM to extract the argument from the text."""
+def argument_prompt(opinion_text, segments, theme):
+    """Prompt asking the LLM for the argument of the segments."""
 
     texts = {"claim": "",
             "premise": "",
@@ -41,9 +52,81 @@ def extract_argument(opinion_text, segments, theme, llm):
         prompt += f"- solution(s): {solution}\n"
     
     
-    argument = llm.query(prompt)
+    return prompt
+
+def extract_argument(opinion_text, segments, theme, llm):
+    """Use the LLM to extract the argument from the text."""
+    return llm.query(argument_prompt(opinion_text, segments, theme))
+
+def argument_result(segs, color, argument) :
+    return {
+        'segments': segs,
+        'color': color,
+        'LLMtext': argument,
+        'text': argument
+    }
+
+def iter_arguments(opinion_text, color_grouped_segments, theme, llm, deadline = LLM_REQUEST_DEADLINE) :
+    """Run extract_argument for every color group concurrently and yield (index, result)
+    as soon as each one is done. Groups not done after deadline seconds are yielded with a None argument."""
+
+    pending = {}
+    for index, (color, segs) in enumerate(color_grouped_segments.items()) :
+        future = llm_executor.submit(extract_argument, opinion_text, segs, theme, llm)
+        pending[future] = (index, color, segs)
 
-    return argument
+    try :
+        for future in as_completed(list(pending), timeout=deadline) :
+            index, color, segs = pending.pop(future)
+            yield index, argument_result(segs, color, future.result())
+    except FuturesTimeoutError :
+        for future, (index, color, segs) in pending.items() :
+            if future.done() :
+                argument = future.result()
+            else :
+                future.cancel()
+                logger.warning("llm deadline missed", extra={"model": llm.model, "color": color, "deadline": deadline})
+                argument = None
+            yield index, argument_result(segs, color, argument)
+
+def extract_arguments(opinion_text, color_grouped_segments, theme, llm, deadline = LLM_REQUEST_DEADLINE) :
+    "Same as iter_arguments, but returns all the results in the color order."
+
+    results = [None] * len(color_grouped_segments)
+    for index, result in iter_arguments(opinion_text, color_grouped_segments, theme, llm, deadline) :
+        results[index] = result
+    return results
+
+async def aiter_arguments(opinion_text, color_grouped_segments, theme, llm, deadline = LLM_REQUEST_DEADLINE) :
+    "asyncio version of iter_arguments, the LLM calls are awaited on the running event loop"
+
+    pending = {}
+    for index, (color, segs) in enumerate(color_grouped_segments.items()) :
+        task = asyncio.ensure_future(llm.aquery(argument_prompt(opinion_text, segs, theme)))
+        pending[task] = (index, color, segs)
+
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+    while pending :
+        done, _ = await asyncio.wait(list(pending), timeout=max(0, end - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+        if not done :
+            break
+        for task in done :
+            index, color, segs = pending.pop(task)
+            yield index, argument_result(segs, color, task.result())
+
+    for task, (index, color, segs) in pending.items() :
+        task.cancel()
+        logger.warning("llm deadline missed", extra={"model": llm.model, "color": color, "deadline": deadline})
+        yield index, argument_result(segs, color, None)
+
+async def aextract_arguments(opinion_text, color_grouped_segments, theme, llm, deadline = LLM_REQUEST_DEADLINE) :
+    "Same as aiter_arguments, but returns all the results in the color order."
+
+    results = [None] * len(color_grouped_segments)
+    async for index, result in aiter_arguments(opinion_text, color_grouped_segments, theme, llm, deadline) :
+        results[index] = result
+    return results
 
 def process_segments(segments) :
     # group the segments per color (instead of hex)
@@ -62,24 +145,101 @@ def get_token(request) :
         return None
 
 
-def load_admin_opinion_results(path: str = ALL_ANNOTATIONS_OUTPUT_FILE):
-    results = []
-    with open(path, "r", encoding="utf-8") as f:
+ANNOTATION_FILTERS = ["annotator", "llm", "opinionId", "date_from", "date_to"]
+
+def annotation_filters(args) :
+    "filters given as query arguments; dates are compared as 'YYYY-MM-DD HH:MM:SS' strings, date_to included"
+    filters = {key: args.get(key) for key in ANNOTATION_FILTERS if args.get(key)}
+    if "date_to" in filters and len(filters["date_to"]) == len("YYYY-MM-DD") :
+        filters["date_to"] += " 23:59:59"
+    return filters
+
+def annotation_matches(annotation, filters) :
+    if "annotator" in filters and annotation.get("annotator") != filters["annotator"] :
+        return False
+    if "llm" in filters and annotation.get("llm") != filters["llm"] :
+        return False
+    if "opinionId" in filters and str(annotation["opinion"]["opinionId"]) != filters["opinionId"] :
+        return False
+    date = annotation.get("date", "")
+    if "date_from" in filters and date < filters["date_from"] :
+        return False
+    if "date_to" in filters and date > filters["date_to"] :
+        return False
+    return True
+
+class InvalidCursor(ValueError) :
+    "a cursor that is not the start of a line of the aggregated annotations"
+
+def check_line_start(path, cursor) :
+    "raises InvalidCursor unless cursor is 0 or right after a newline of path"
+    with open(path, "rb") as f:
+        if cursor > f.seek(0, os.SEEK_END) :
+            raise InvalidCursor(cursor)
+        if cursor > 0 :
+            f.seek(cursor - 1)
+            if f.read(1) != b"\n" :
+                raise InvalidCursor(cursor)
+
+def iter_admin_opinion_results(path: str = ALL_ANNOTATIONS_OUTPUT_FILE, cursor: int = 0, filters: dict = {}):
+    """Iterator of (offset, annotation) for the annotations matching filters, reading one line at a time
+    from the byte offset cursor. offset is where the line after the annotation starts,
+    and is a valid cursor until the file is rebuilt. The cursor is checked right away (see check_line_start)."""
+    check_line_start(path, cursor)
+    return read_admin_opinion_results(path, cursor, filters)
+
+def read_admin_opinion_results(path, cursor, filters):
+    with open(path, "rb") as f:
+        f.seek(cursor)
+        offset = cursor
         for line in f:
-            if line.strip():  # avoid empty lines
-                dict = json.loads(line)
-                del dict
-                results.append(json.loads(line))
-    return results
+            offset += len(line)
+            if not line.strip():  # avoid empty lines
+                continue
+            annotation = json.loads(line)
+            if annotation_matches(annotation, filters) :
+                yield offset, annotation
 
-def token_is_admin(token):
-    with open("./annotators/admin_tokens.txt") as f:
-        admin_tokens = [line.rstrip() for line in f]
-    
-    if token in admin_tokens :
-        return True
+def load_admin_opinion_results(annotations):
+    "annotations from (cursor, annotation) pairs, as given by the storage's iter_annotations"
+    return [annotation for _, annotation in annotations]
 
-    return False
+def load_admin_opinion_page(annotations, limit: int = 100):
+    "at most limit annotations from (cursor, annotation) pairs, and the cursor of the next page (None on the last page)"
+    results = []
+    next_cursor = None
+    for offset, annotation in annotations :
+        if len(results) == limit :
+            break
+        results.append(annotation)
+        next_cursor = offset
+    else :
+        next_cursor = None
+    return results, next_cursor
+
+def ndjson_chunks(annotations, compress = False, chunk_size = 65536) :
+    "encodes annotations as NDJSON (gzip-compressed if compress) in chunks of about chunk_size bytes"
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = []
+    buffered = 0
+    for annotation in annotations :
+        line = (json.dumps(annotation) + "\n").encode("utf-8")
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= chunk_size :
+            chunk = b"".join(buffer)
+            buffer, buffered = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk :
+                yield chunk
+    chunk = b"".join(buffer)
+    if compressor :
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk :
+        yield chunk
+
+def token_is_admin(token):
+    return token_registry.is_admin(token)
 
 def is_valid_example(example_output) :
     expected = RESULTS_EXAMPLES[example_output["opinion"]["opinionId"]]
@@ -93,7 +253,8 @@ def is_valid_example(example_output) :
         num_premises += len([seg for seg in segments.values() if seg["type"] == "premise"])
         num_solutions += len([seg for seg in segments.values() if seg["type"] == "solution"])
 
-    print(num_argumentative_units, num_claims, num_premises, num_solutions, expected)
+    logger.debug("example checked", extra={"units": num_argumentative_units, "claims": num_claims, "premises": num_premises,
+                                           "solutions": num_solutions, "expected": expected})
     if ((expected["num_argumentative_units"] != num_argumentative_units) 
         or (expected["num_claims"] != num_claims) 
         or (expected["num_premises"] != num_premises) 